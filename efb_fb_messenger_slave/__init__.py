@@ -2,14 +2,15 @@
 
 import logging
 import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from gettext import translation
-from io import BytesIO
-from typing import Optional, List, Dict, Any, Tuple, BinaryIO, Callable, cast
+from itertools import islice
+from typing import Optional, List, Dict, Any, Tuple, BinaryIO, Callable, Iterator, Set, cast
 
-import requests
 import yaml
 from fbchat import FBchatUserError, ThreadLocation, MessageReaction, FBchatException, Message
-from fbchat.models import Thread
+from fbchat.models import Thread, Group
 from pkg_resources import resource_filename
 
 from ehforwarderbot import Chat, Message, Status
@@ -24,7 +25,9 @@ from . import utils as efms_utils
 from .__version__ import __version__
 from .efms_chat import EFMSChatManager
 from .efms_client import EFMSClient
+from .media import AvatarCache
 from .extra_functions import ExtraFunctionsManager
+from .thread_sync import ThreadListSync
 from .master_messages import MasterMessageManager
 from .utils import ExperimentalFlagsManager
 
@@ -59,6 +62,9 @@ class FBMessengerChannel(SlaveChannel):
 
     def __init__(self, instance_id: InstanceID = None):
         super().__init__(instance_id)
+        self.load_config()
+        self.flag: ExperimentalFlagsManager = ExperimentalFlagsManager(self)
+
         session_path = efb_utils.get_data_path(self.channel_id) / "session.pickle"
         try:
             data = pickle.load(session_path.open('rb'))
@@ -72,14 +78,25 @@ class FBMessengerChannel(SlaveChannel):
                              "To do so, run: efms-auth")
             raise EFBException(message)
 
-        self.load_config()
-        self.chat_manager: EFMSChatManager = EFMSChatManager(self)
-        self.flag: ExperimentalFlagsManager = ExperimentalFlagsManager(self)
-        self.master_message: MasterMessageManager = MasterMessageManager(self)
-        self.extra_functions: ExtraFunctionsManager = ExtraFunctionsManager(self)
-
-        # Initialize list of chat from server
-        self.get_chats()
+        try:
+            self.avatar_cache: AvatarCache = self.client.acquire_resource(
+                "avatar_cache", lambda: AvatarCache(self.client.resources_path / "avatars",
+                                                    downloader=self.client.downloader))
+            self.chat_manager: EFMSChatManager = EFMSChatManager(self)
+            self.thread_sync: ThreadListSync = ThreadListSync(self.client,
+                                                              efb_utils.get_data_path(self.channel_id) / "threads.json",
+                                                              max_threads=self.flag('thread_sync_max_threads'))
+            self.master_message: MasterMessageManager = MasterMessageManager(self)
+            self.extra_functions: ExtraFunctionsManager = ExtraFunctionsManager(self)
+
+            # Initialize list of chat from server, unless loaded from cache.
+            # Cached chats are refreshed in background after polling starts.
+            if not self.chat_manager.cache_loaded:
+                self.get_chats()
+                self.chat_manager.save_cache()
+        except BaseException:
+            self.client.release_resources()
+            raise
 
         # Monkey patching
         Thread.__eq__ = lambda a, b: a.uid == b.uid
@@ -97,20 +114,78 @@ class FBMessengerChannel(SlaveChannel):
         with config_path.open() as f:
             self.config: Dict[str, Any] = yaml.full_load(f) or dict()
 
-    def get_chats(self) -> List[Chat]:
+    @property
+    def thread_locations(self) -> Tuple[ThreadLocation, ...]:
+        """Locations of threads to show as chats."""
         locations: Tuple[ThreadLocation, ...] = (ThreadLocation.INBOX,)
         if self.flag('show_pending_threads'):
             locations += (ThreadLocation.PENDING, ThreadLocation.OTHER)
         if self.flag('show_archived_threads'):
             locations += (ThreadLocation.ARCHIVED,)
-        chats: List[Chat] = []
-        for i in self.client.fetchThreadList(thread_location=locations):
-            chats.append(self.chat_manager.build_and_cache_thread(i))
-        loaded_chats = set(i.uid for i in chats)
-        for i in self.client.fetchAllUsers():
-            if i.uid not in loaded_chats:
-                chats.append(self.chat_manager.build_and_cache_thread(i))
-        return chats
+        return locations
+
+    def get_chats(self) -> List[Chat]:
+        return list(self.iter_chats())
+
+    def iter_chats(self) -> Iterator[Chat]:
+        """
+        Load chats from the server, and yield them page by page as threads
+        arrive, from the latest updated thread.
+
+        Threads updated since the last sync come first, followed by other
+        threads in the index, and then friends without a thread. Friends
+        are fetched in background, and only waited for before the last part.
+        """
+        locations = self.thread_locations
+        batch_size = self.chat_manager.user_resolver.batch_size
+        loaded_chats: Set[str] = set()
+        with ThreadPoolExecutor(max_workers=self.flag('chat_build_workers'),
+                                thread_name_prefix="EFMS chat build") as pool:
+            users_future = pool.submit(self.client.fetchAllUsers)
+            primed = False
+            threads = self.thread_sync.iter_sync(locations)
+            batch = list(islice(threads, ThreadListSync.page_size))
+            while batch:
+                # Names of friends save lookups of group members once they arrive.
+                if not primed and users_future.done():
+                    self.chat_manager.user_resolver.prime(users_future.result())
+                    primed = True
+                yield from self._build_chats(pool, batch, loaded_chats)
+                batch = list(islice(threads, ThreadListSync.page_size))
+
+            # Threads not updated since the last sync are taken from the chat
+            # cache, and fetched again only if missing from there.
+            missing: List[str] = []
+            for i in self.thread_sync.thread_ids(locations):
+                if i in loaded_chats:
+                    continue
+                chat = self.chat_manager.cache.get(i)
+                if chat is None:
+                    missing.append(i)
+                    continue
+                loaded_chats.add(i)
+                yield chat
+            for offset in range(0, len(missing), batch_size):
+                batch = list(self.client.fetchThreadInfo(*missing[offset:offset + batch_size]).values())
+                yield from self._build_chats(pool, batch, loaded_chats)
+
+            users = users_future.result()
+            if not primed:
+                self.chat_manager.user_resolver.prime(users)
+            yield from self._build_chats(pool, [i for i in users if i.uid not in loaded_chats], loaded_chats)
+
+    def _build_chats(self, pool: ThreadPoolExecutor, threads: List[Thread],
+                     loaded_chats: Set[str]) -> Iterator[Chat]:
+        # Resolve members of groups in the batch at once, to share lookups of
+        # users across groups. Members of lazily loaded groups are left for later.
+        self.chat_manager.user_resolver.resolve(
+            i for thread in threads
+            if isinstance(thread, Group) and not self.chat_manager.is_lazy_group(thread)
+            for i in thread.participants if i != self.client.uid
+        )
+        for chat in pool.map(self.chat_manager.build_and_cache_thread, threads):
+            loaded_chats.add(chat.uid)
+            yield chat
 
     def get_chat(self, chat_uid: str) -> Chat:
         try:
@@ -123,14 +198,12 @@ class FBMessengerChannel(SlaveChannel):
 
     def send_status(self, status: Status):
         if isinstance(status, MessageRemoval):
-            uid: str = cast(str, status.message.uid)
-            rfind = uid.rfind('.')
-            if rfind > 0 and uid[rfind+1:].isdecimal():
-                uid = uid[:rfind]
+            uid, _ = self.client.message_store.resolve(cast(str, status.message.uid))
             return self.client.unsend(uid)
         elif isinstance(status, ReactToMessage):
             try:
-                self.client.reactToMessage(status.msg_id, status.reaction and MessageReaction(status.reaction))
+                uid, _ = self.client.message_store.resolve(status.msg_id)
+                self.client.reactToMessage(uid, status.reaction and MessageReaction(status.reaction))
             except (FBchatException, ValueError) as e:
                 self.logger.error(f"Error occurred while sending status: {e}")
                 raise EFBMessageReactionNotPossible(*e.args)
@@ -139,35 +212,48 @@ class FBMessengerChannel(SlaveChannel):
         raise EFBOperationNotSupported()
 
     def poll(self):
+        if self.chat_manager.cache_loaded:
+            threading.Thread(target=self.refresh_chats, name="EFMS chat cache refresh", daemon=True).start()
         self.client.listen(False)
 
+    def refresh_chats(self):
+        try:
+            self.chat_manager.refresh_cache()
+        except Exception:
+            self.logger.exception("Error occurred while refreshing chats from server.")
+
     def stop_polling(self):
         self.client.listening = False
+        self.master_message.stop()
+        self.client.release_resources()
+        self.chat_manager.save_cache()
 
     def get_chat_picture(self, chat: Chat) -> BinaryIO:
         self.logger.debug("Getting picture of chat %s", chat)
         photo_url = chat.vendor_specific.get('profile_picture_url')
         self.logger.debug("[%s] has photo_url from cache: %s", chat.uid, photo_url)
+        if photo_url:
+            cached = self.avatar_cache.get_cached(chat.uid, photo_url)
+            if cached is not None:
+                return cached
+        elif self.avatar_cache.is_missing(chat.uid):
+            raise EFBOperationNotSupported('This chat has no picture.')
         if not photo_url:
-            thread = self.client.get_thread_info(chat.uid)
-            photo_url = efms_utils.get_value(thread, ('messaging_actor', 'big_image_src', 'uri'))
-        self.logger.debug("[%s] has photo_url from GraphQL: %s", chat.uid, photo_url)
-        if not photo_url:
-            thread = self.client.fetchThreadInfo(chat.uid)[chat.uid]
-            photo_url = getattr(thread, 'photo', None)
-        self.logger.debug("[%s] has photo_url from legacy API: %s", chat.uid, photo_url)
+            thread_info = self.client.get_thread_info(chat.uid)
+            photo_url = efms_utils.get_value(thread_info, ('messaging_actor', 'big_image_src', 'uri'))
+            self.logger.debug("[%s] has photo_url from GraphQL: %s", chat.uid, photo_url)
+            if not photo_url:
+                legacy_info = self.client.fetchThreadInfo(chat.uid)
+                photo_url = getattr(legacy_info[chat.uid], 'photo', None)
+                self.logger.debug("[%s] has photo_url from legacy API: %s", chat.uid, photo_url)
         if not photo_url:
+            self.avatar_cache.mark_missing(chat.uid)
             raise EFBOperationNotSupported('This chat has no picture.')
-        photo = BytesIO(requests.get(photo_url).content)
-        photo.seek(0)
-        return photo
+        return self.avatar_cache.get(chat.uid, photo_url)
 
     def get_message_by_id(self, chat: Chat, msg_id: MessageID) -> Optional['Message']:
-        index = None
-        if msg_id.split('.')[-1].isdecimal():
-            # is sub-message
-            index = int(msg_id.split('.')[-1])
-            msg_id = MessageID('.'.join(msg_id.split('.')[:-1]))
+        mid, index = self.client.message_store.resolve(msg_id)
+        msg_id = MessageID(mid)
 
         thread_id, thread_type = self.client._getThread(chat.uid, None)
         message_info = self.client._forcedFetch(thread_id, msg_id).get("message")
@@ -179,7 +265,7 @@ class FBMessengerChannel(SlaveChannel):
         attachments = message_info.get('delta', {}).get('attachments', [])
 
         if attachments:
-            attachment = attachments[index]
+            attachment = attachments[index or 0]
             self.client.attach_media(efb_msg, attachment)
 
         efb_msg.uid = msg_id
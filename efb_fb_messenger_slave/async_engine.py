@@ -0,0 +1,135 @@
+# coding=utf-8
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+from typing import Callable, Mapping, Optional
+
+from .media import DownloadedFile, FetchResult, MediaTooLargeError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncEngine:
+    """
+    An asyncio event loop running on a dedicated thread, for network I/O
+    of synchronous callers.
+
+    HTTP downloads are run on the loop with a pooled ``aiohttp`` session,
+    so that any number of slow downloads are in progress without a thread
+    each. Blocking steps around downloads, like lookups in the media cache
+    and resolving URLs, are run in a bounded executor of the loop. Both are
+    returned as futures.
+
+    Without ``aiohttp`` installed, only blocking calls are supported, and
+    :attr:`native_http` is ``False``.
+    """
+
+    logger = logging.getLogger("AsyncEngine")
+
+    def __init__(self, max_connections: int = 100, executor_workers: int = 8):
+        """
+        Args:
+            max_connections: Maximum number of simultaneous HTTP connections
+            executor_workers: Maximum number of blocking calls run at the same time
+        """
+        self.max_connections = max_connections
+        self.native_http = aiohttp is not None
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers,
+                                           thread_name_prefix="EFMS async engine executor")
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self.thread = threading.Thread(target=self._run, name="EFMS async engine", daemon=True)
+        self.thread.start()
+        if not self.native_http:
+            self.logger.warning("aiohttp is not installed, HTTP downloads are not run by the async engine.")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """Schedule a coroutine on the event loop, and return a future of its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_blocking(self, fn: Callable, *args, **kwargs) -> Future:
+        """Run a blocking call in the executor of the engine, and return a future of its result."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def fetch(self, url: str, suffix: str = '', headers: Optional[Mapping[str, str]] = None,
+              max_size: int = 0, timeout: float = 30, chunk_size: int = 64 * 1024) -> Future:
+        """
+        Download a file into a temporary file on the event loop.
+
+        Args:
+            url: URL of the file
+            suffix: Suffix of the temporary file name
+            headers: Additional request headers
+            max_size: Maximum size of the file in bytes, 0 for unlimited
+            timeout: Seconds to wait for the server to connect or send data
+            chunk_size: Size of chunks to write to the file
+
+        Returns:
+            A future of :class:`.FetchResult`, raising :exc:`.MediaTooLargeError`
+            if the file is larger than the size limit, or
+            :exc:`aiohttp.ClientError` if the request failed.
+        """
+        if not self.native_http:
+            raise RuntimeError("aiohttp is required to download files in the async engine.")
+        return self.submit(self._fetch(url, suffix, headers, max_size, timeout, chunk_size))
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _fetch(self, url: str, suffix: str, headers: Optional[Mapping[str, str]],
+                     max_size: int, timeout: float, chunk_size: int) -> FetchResult:
+        self.logger.debug("Downloading %s", url)
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        async with self._get_session().get(url, headers=headers, timeout=client_timeout) as response:
+            if response.status == 304:
+                return FetchResult(status=response.status, headers=response.headers.copy(), download=None)
+            response.raise_for_status()
+            length = response.content_length
+            if max_size and length and length > max_size:
+                raise MediaTooLargeError(url, length)
+            file = NamedTemporaryFile(suffix=suffix)
+            size = 0
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise MediaTooLargeError(url, size)
+                    file.write(chunk)
+            except BaseException:
+                file.close()
+                raise
+            file.seek(0)
+            self.logger.debug("Downloaded %s bytes from %s", size, url)
+            download = DownloadedFile(file=file, mime=response.headers.get('Content-Type'), size=size)
+            return FetchResult(status=response.status, headers=response.headers.copy(), download=download)
+
+    async def _close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stop(self):
+        """Close the HTTP session, and stop the event loop and executor."""
+        if not self.loop.is_running():
+            return
+        try:
+            self.submit(self._close()).result(timeout=5)
+        except Exception as e:
+            self.logger.warning("Failed to close HTTP session: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,182 @@
+# coding=utf-8
+
+import os
+import re
+import urllib.parse
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+from fbchat.models import EmojiSize
+from ehforwarderbot import MsgType
+from .utils import compile_path
+
+LOCATION_MARKERS = re.compile(r'markers=([\d.-]+)%2C([\d.-]+)')
+"""Coordinates of the marker in the URL of a location preview."""
+
+LIKE_STICKER_PACK = "227877430692340"
+"""ID of the sticker pack of "Like" stickers."""
+
+LIKE_STICKERS = {i.value: i.name[0] for i in EmojiSize}
+"""Size of "Like" stickers by their IDs."""
+
+
+class AttachmentInfo(NamedTuple):
+    type: Optional[str]
+    """
+    Type of the attachment, either ``__typename`` of the blob attachment,
+    or ``'__Sticker'``, ``'__Link'`` or ``'MessageLocation'``.
+    """
+    msg_type: MsgType
+    """Type of the EFB message to deliver the attachment in."""
+    id: Optional[str] = None
+    """ID of the attachment."""
+    blob: Dict[str, Any] = {}
+    """Blob attachment of the attachment, empty if not applicable."""
+    filename: Optional[str] = None
+    mime: Optional[str] = None
+    url: Optional[str] = None
+    """URL of the file, or the link."""
+    text: Optional[str] = None
+    """Text of the message, if replaced by the attachment."""
+    sticker_id: Optional[str] = None
+    attribution_app: Optional[str] = None
+    """Name of the app the image is sent from."""
+    title: str = ''
+    description: str = ''
+    preview: Optional[str] = None
+    """URL of the preview image of a link or a location."""
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+_new_info = tuple.__new__
+"""
+Build an :class:`AttachmentInfo` from a tuple of all of its fields in order.
+
+The ``__new__`` generated for named tuples costs more than the rest of
+classifying most attachments, so attachments are built with this instead.
+"""
+
+
+_extensible_target_type = compile_path(('mercury', 'extensible_attachment', 'story_attachment',
+                                        'target', '__typename'))
+_story_attachment = compile_path(('mercury', 'extensible_attachment', 'story_attachment'))
+_title = compile_path(('title_with_entities', 'text'))
+_description = compile_path(('description', 'text'))
+_source = compile_path(('source', 'text'))
+_media_is_playable = compile_path(('media', 'is_playable'))
+_media_playable_url = compile_path(('media', 'playable_url'))
+_media_image = compile_path(('media', 'image', 'uri'))
+_attribution_app = compile_path(('attribution_app', 'name'))
+_sticker_pack_id = compile_path(('pack', 'id'))
+
+
+class BlobType(NamedTuple):
+    msg_type: MsgType
+    """Type of the EFB message to deliver the attachment in."""
+    filename: str
+    """Default file name."""
+    mime: str
+    """Default MIME type."""
+    url_key: Optional[str]
+    """Key of the URL of the file in the blob attachment, if the URL is in the blob."""
+    url_subkey: Optional[str] = None
+    """Key of the URL in the value of ``url_key``, if the URL is nested."""
+    attribution: bool = False
+    """If the blob may have the name of the app it is sent from."""
+
+
+BLOB_TYPES: Dict[str, BlobType] = {
+    'MessageAudio': BlobType(MsgType.Voice, 'audio.mp3', 'audio/mpeg', 'playable_url'),
+    'MessageImage': BlobType(MsgType.Image, 'image.png', 'image/png', None, attribution=True),
+    'MessageAnimatedImage': BlobType(MsgType.Animation, 'image.gif', 'image/gif', 'animated_image', 'uri'),
+    'MessageFile': BlobType(MsgType.File, 'file', 'application/octet-stream', 'url'),
+    'MessageVideo': BlobType(MsgType.Image, 'video.mp4', 'video/mpeg', 'playable_url'),
+}
+"""Types of blob attachments supported by their ``__typename``."""
+
+_UNSUPPORTED = MsgType.Unsupported
+"""Looked up once, as looking up members of enums is slow."""
+
+
+def _sticker(attachment: Dict[str, Any], sticker: Dict[str, Any]) -> AttachmentInfo:
+    sticker_id = sticker.get('id')
+    if _sticker_pack_id(sticker) == LIKE_STICKER_PACK and sticker_id in LIKE_STICKERS:
+        return _new_info(AttachmentInfo, ('__Sticker', MsgType.Text, attachment.get('id'), {},
+                                          None, None, None, "👍 (%s)" % LIKE_STICKERS[sticker_id], sticker_id,
+                                          None, '', '', None, None, None))
+    url = sticker.get('url')
+    return _new_info(AttachmentInfo, ('__Sticker', MsgType.Sticker, attachment.get('id'), {},
+                                      url and os.path.split(urllib.parse.urlparse(url).path)[1],
+                                      attachment.get('mimeType'), url, sticker.get('label', ''), sticker_id,
+                                      None, '', '', None, None, None))
+
+
+def _link(attachment: Dict[str, Any], story: Dict[str, Any]) -> AttachmentInfo:
+    description = _description(story) or ''
+    source = _source(story)
+    if source:
+        description += " (via %s)" % source
+    preview = _media_playable_url(story) if _media_is_playable(story) else None
+    preview = preview or _media_image(story)
+    return _new_info(AttachmentInfo, ('__Link', MsgType.Link, attachment.get('id'), {},
+                                      None, None, story.get('url', preview), None, None,
+                                      None, _title(story) or '', description, preview, None, None))
+
+
+def _location(attachment: Dict[str, Any], story: Dict[str, Any]) -> AttachmentInfo:
+    title = _title(story) or ''
+    description = _description(story) or ''
+    text = '\n'.join([title, description])
+    preview = _media_image(story)
+    matches = LOCATION_MARKERS.search(preview) if preview else None
+    if not matches:
+        return _new_info(AttachmentInfo, ('MessageLocation', MsgType.Unsupported, attachment.get('id'), {},
+                                          None, None, None, text, None,
+                                          None, title, description, preview, None, None))
+    latitude, longitude = map(float, matches.groups())
+    return _new_info(AttachmentInfo, ('MessageLocation', MsgType.Location, attachment.get('id'), {},
+                                      None, None, None, text, None,
+                                      None, title, description, preview, latitude, longitude))
+
+
+EXTENSIBLE_PARSERS: Dict[Optional[str], Callable[[Dict[str, Any], Dict[str, Any]], AttachmentInfo]] = {
+    'MessageLocation': _location,
+    # TODO: Change if live location is supported by framework.
+    'MessageLiveLocation': _location,
+}
+"""Parsers of extensible attachments by the ``__typename`` of their targets, links by default."""
+
+
+def classify_attachment(attachment: Dict[str, Any]) -> AttachmentInfo:
+    """
+    Classify an attachment, and extract information needed to deliver it.
+
+    Args:
+        attachment:
+            Dict of information of the attachment
+            ``fbchat`` entity is not used as it is not completed.
+    """
+    mercury = attachment.get('mercury') or {}
+    if 'extensible_attachment' in mercury:
+        parser = EXTENSIBLE_PARSERS.get(_extensible_target_type(attachment), _link)
+        return parser(attachment, _story_attachment(attachment) or {})
+    if 'sticker_attachment' in mercury:
+        return _sticker(attachment, mercury['sticker_attachment'] or {})
+    # Payloads without ``mercury`` have fields of the blob in the attachment itself.
+    blob = mercury.get('blob_attachment', attachment) or {}
+    attachment_type = blob.get('__typename')
+    blob_type = BLOB_TYPES.get(attachment_type)
+    if blob_type is None:
+        return _new_info(AttachmentInfo, (attachment_type, _UNSUPPORTED, attachment.get('id'), blob,
+                                          None, None, None, None, None,
+                                          None, '', '', None, None, None))
+    msg_type, filename, mime, url_key, url_subkey, attribution = blob_type
+    url = blob.get(url_key) if url_key else None
+    if url_subkey and url:
+        url = url.get(url_subkey)
+    return _new_info(AttachmentInfo, (attachment_type, msg_type, attachment.get('id'), blob,
+                                      attachment.get('filename') or filename,
+                                      attachment.get('mimeType') or mime,
+                                      url, None, None,
+                                      _attribution_app(blob) if attribution else None,
+                                      '', '', None, None, None))
@@ -0,0 +1,124 @@
+# coding=utf-8
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Iterator, List, MutableMapping, Optional, Tuple, TypeVar
+
+KT = TypeVar('KT', bound=Hashable)
+VT = TypeVar('VT')
+
+
+class LRUCache(MutableMapping[KT, VT], Generic[KT, VT]):
+    """
+    A thread-safe mapping with a size bound and expiry time of entries.
+
+    When the cache is full, the least recently used entry is evicted.
+    Entries expire ``ttl`` seconds after they are set, and are treated
+    as missing since then.
+    """
+
+    def __init__(self, max_size: int = 0, ttl: float = 0,
+                 on_evict: Optional[Callable[[KT, VT], None]] = None):
+        """
+        Args:
+            max_size: Maximum number of entries, 0 for unlimited
+            ttl: Seconds for an entry to expire, 0 to never expire
+            on_evict: Function called with the key and value of each entry
+                evicted when the cache is full
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._lock = threading.RLock()
+        self._data: 'OrderedDict[KT, Tuple[VT, Optional[float]]]' = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key: KT) -> VT:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __setitem__(self, key: KT, value: VT):
+        self.set(key, value)
+
+    def set(self, key: KT, value: VT, ttl: Optional[float] = None):
+        """Set an entry, optionally with a TTL different from the default."""
+        ttl = self.ttl if ttl is None else ttl
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while self.max_size and len(self._data) > self.max_size:
+                evicted.append(self._data.popitem(last=False))
+                self.evictions += 1
+        if self.on_evict is not None:
+            for evicted_key, entry in evicted:
+                self.on_evict(evicted_key, entry[0])
+
+    def __delitem__(self, key: KT):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            entry = self._data.get(key)  # type: ignore
+            return entry is not None and not self._expired(entry)
+
+    def __iter__(self) -> Iterator[KT]:
+        return iter(self.keys_snapshot())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def keys_snapshot(self) -> List[KT]:
+        """List of keys of unexpired entries, from the least recently used."""
+        with self._lock:
+            return [k for k, v in self._data.items() if not self._expired(v)]
+
+    def items(self) -> List[Tuple[KT, VT]]:  # type: ignore
+        """List of unexpired entries, without affecting their order and counters."""
+        with self._lock:
+            return [(k, v[0]) for k, v in self._data.items() if not self._expired(v)]
+
+    def values(self) -> List[VT]:  # type: ignore
+        """List of unexpired values, without affecting their order and counters."""
+        return [v for k, v in self.items()]
+
+    def invalidate(self, key: KT) -> Optional[VT]:
+        """Remove an entry if exists, and return its value."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit/miss counters of the cache."""
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    @staticmethod
+    def _expired(entry: Tuple[Any, Optional[float]]) -> bool:
+        return entry[1] is not None and entry[1] <= time.monotonic()
+
+    def __repr__(self):
+        return f"<LRUCache: {self.stats!r}>"
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator
+
+
+class EchoSuppressor:
+    """
+    Recognize messages sent by EFMS when they are received again from Messenger.
+
+    Messages sent are registered with their message ID, and expire after
+    ``ttl`` seconds if the echo is never received. While a message is being
+    sent to a thread, messages from the user themself in the same thread may
+    be its echo, and are held until the send request finishes, or until
+    ``wait_timeout`` seconds have passed. All other messages are released
+    immediately.
+    """
+
+    logger = logging.getLogger("EchoSuppressor")
+
+    def __init__(self, ttl: float = 300.0, wait_timeout: float = 5.0):
+        """
+        Args:
+            ttl: Seconds to remember a sent message ID
+            wait_timeout: Max seconds to hold a message that is possibly an echo
+        """
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._condition = threading.Condition(threading.Lock())
+        # Number of send requests in progress by thread ID
+        self._pending: Dict[Hashable, int] = dict()
+        # Expiry time of sent message IDs, in the order of registration
+        self._sent: 'OrderedDict[str, float]' = OrderedDict()
+
+    @contextmanager
+    def sending(self, thread_id: Hashable) -> Iterator[None]:
+        """Mark a send request to ``thread_id`` as in progress within the context."""
+        with self._condition:
+            self._pending[thread_id] = self._pending.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._pending[thread_id] -= 1
+                if not self._pending[thread_id]:
+                    del self._pending[thread_id]
+                self._condition.notify_all()
+
+    def register(self, mid: str):
+        """Register the ID of a message sent by EFMS."""
+        with self._condition:
+            self._sent[mid] = time.monotonic() + self.ttl
+            self._sent.move_to_end(mid)
+            self._condition.notify_all()
+
+    def is_echo(self, mid: str, thread_id: Hashable, from_self: bool) -> bool:
+        """
+        Check if a message received is sent by EFMS, and forget it if so.
+
+        Args:
+            mid: ID of the message received
+            thread_id: ID of the thread where the message is received
+            from_self: If the message is sent by the user themself
+        """
+        with self._condition:
+            self._expire()
+            if self._sent.pop(mid, None) is not None:
+                return True
+            if not from_self:
+                return False
+            deadline = time.monotonic() + self.wait_timeout
+            while self._pending.get(thread_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.logger.debug("[%s] Timed out waiting for send requests to %s.", mid, thread_id)
+                    break
+                self._condition.wait(remaining)
+                if self._sent.pop(mid, None) is not None:
+                    return True
+            return False
+
+    def __len__(self):
+        return len(self._sent)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sent:
+            mid, expiry = next(iter(self._sent.items()))
+            if expiry > now:
+                break
+            del self._sent[mid]
@@ -1,26 +1,41 @@
 # coding=utf-8
 
+import gzip
+import json
 import logging
-from typing import TYPE_CHECKING, Dict, Any, Optional, Tuple, Union
+import os
+import threading
+from contextlib import suppress
+from pathlib import Path
+from tempfile import mkstemp
+from typing import TYPE_CHECKING, Dict, Any, Iterable, List, MutableSequence, NamedTuple, Optional, Tuple, Union
 
 from fbchat import FBchatException
 
 from ehforwarderbot import Chat, coordinator
-from fbchat.models import Thread, User, Page, Group, Room
+from fbchat.models import Thread, ThreadType, User, Page, Group, Room
 
-from ehforwarderbot.chat import PrivateChat, GroupChat, SystemChat
+from ehforwarderbot import utils as efb_utils
+from ehforwarderbot.chat import PrivateChat, GroupChat, SystemChat, ChatMember, SelfChatMember
+from ehforwarderbot.status import ChatUpdates
 from ehforwarderbot.types import ChatID
-from .utils import get_value, ThreadID
+from .cache import LRUCache
+from .search_index import ChatSearchIndex, SearchEntry
+from .utils import compile_path, ThreadID
 
 if TYPE_CHECKING:
     from . import FBMessengerChannel
     from .efms_client import EFMSClient
 
 
+_image_uri = compile_path(('image', 'uri'))
+_actor_picture_uri = compile_path(('messaging_actor', 'big_image_src', 'uri'))
+
+
 class EFMSChat(Chat):
     logger = logging.getLogger("EFMSChat")
 
-    cache: Dict[Tuple[str, Optional[str]], 'EFMSChat'] = dict()
+    cache: LRUCache[Tuple[str, Optional[str]], 'EFMSChat'] = LRUCache(max_size=1000)
 
     def __init__(self, channel: 'FBMessengerChannel', thread: Thread = None,
                  graph_ql_thread: Dict[str, Any] = None,
@@ -92,8 +107,7 @@ class EFMSChat(Chat):
                 # self.chat_type = ChatType.Group
                 self.chat_uid = self.graph_ql_thread['thread_key']['thread_fbid']
                 self.vendor_specific['chat_type'] = 'Group'
-                self.vendor_specific['profile_picture_url'] = \
-                    get_value(self.graph_ql_thread, ('image', 'uri'))
+                self.vendor_specific['profile_picture_url'] = _image_uri(self.graph_ql_thread)
                 for i in self.graph_ql_thread['all_participants']['nodes']:
                     self.members.append(EFMSChat(self.channel,
                                                  graph_ql_thread=i,
@@ -114,8 +128,7 @@ class EFMSChat(Chat):
                 self.chat_name = self.graph_ql_thread['messaging_actor']['name']
                 # self.chat_type = ChatType.User
                 self.vendor_specific['chat_type'] = self.graph_ql_thread['messaging_actor'].get('__typename')
-                self.vendor_specific['profile_picture_url'] = \
-                    get_value(self.graph_ql_thread, ('messaging_actor', 'big_image_src', 'uri'))
+                self.vendor_specific['profile_picture_url'] = _actor_picture_uri(self.graph_ql_thread)
             elif recursive:
                 self.logger.debug('[%s] Thread member information is incomplete.', self.chat_uid)
                 self.graph_ql_thread = self.client.get_thread_info(self.chcat_uid)
@@ -152,23 +165,257 @@ class EFMSChat(Chat):
         self.__dict__.update(state)
 
 
+class LazyGroupChat(GroupChat):
+    """
+    A group chat with members loaded on demand.
+
+    Members are resolved one by one when looked up with :meth:`get_member`,
+    or in pages when the list of members is enumerated.
+    """
+
+    def __init__(self, *, resolver: 'UserInfoResolver',
+                 participants: Dict[ChatID, Optional[str]], **kwargs):
+        """
+        Args:
+            resolver: Resolver of user information
+            participants: IDs of members to be loaded, and their nicknames in the group if any
+            kwargs: Arguments of :class:`GroupChat`
+        """
+        self._lock = threading.RLock()
+        self._pending: Dict[ChatID, Optional[str]] = dict()
+        self._resolver: Optional[UserInfoResolver] = resolver
+        super().__init__(**kwargs)
+        self._pending.update(participants)
+
+    @property  # type: ignore
+    def members(self) -> MutableSequence[ChatMember]:  # type: ignore
+        if self._pending:
+            self.load_members()
+        return self._members
+
+    @members.setter
+    def members(self, value: MutableSequence[ChatMember]):
+        self._members = value
+
+    @property
+    def loaded_members(self) -> MutableSequence[ChatMember]:
+        """Members loaded so far, without loading the rest."""
+        return self._members
+
+    @property
+    def pending_members(self) -> Dict[ChatID, Optional[str]]:
+        """IDs of members not yet loaded, and their nicknames in the group if any."""
+        return self._pending
+
+    @property
+    def resolver(self) -> 'UserInfoResolver':
+        if self._resolver is None:
+            # Unpickled chat
+            self._resolver = coordinator.get_module_by_id(self.module_id).chat_manager.user_resolver
+        return self._resolver
+
+    @property
+    def has_self(self) -> bool:
+        # The user is never a pending member.
+        return any(isinstance(member, SelfChatMember) for member in self.loaded_members)
+
+    def verify(self):
+        # Skip GroupChat.verify, which enumerates members and loads all of them.
+        super(GroupChat, self).verify()
+        assert all(isinstance(member, ChatMember) for member in self.loaded_members)
+
+    def get_member(self, member_id: ChatID) -> ChatMember:
+        with self._lock:
+            for i in self._members:
+                if i.uid == member_id:
+                    return i
+            if member_id not in self._pending:
+                raise KeyError(member_id)
+            self.load_members([member_id])
+            return self._members[-1]
+
+    def load_members(self, member_ids: Optional[Iterable[ChatID]] = None):
+        """
+        Load members pending, in pages of the batch size of the resolver.
+
+        Args:
+            member_ids: Only load these members if provided.
+        """
+        with self._lock:
+            pending = [i for i in member_ids if i in self._pending] if member_ids is not None \
+                else list(self._pending)
+            page_size = self.resolver.batch_size
+            for offset in range(0, len(pending), page_size):
+                page = pending[offset:offset + page_size]
+                users = self.resolver.resolve(page)
+                for i in page:
+                    nickname = self._pending.pop(i)
+                    user = users.get(i)
+                    if user is None:
+                        self._members.append(ChatMember(self, name=str(i), alias=nickname, uid=ChatID(i)))
+                    else:
+                        alias = nickname or user.own_nickname or user.nickname or None
+                        self._members.append(ChatMember(self, name=user.name, alias=alias, uid=ChatID(i)))
+
+    def __repr__(self):
+        # Chat.__repr__ enumerates members, and loads all of them.
+        return (
+            f"{self.__class__.__name__}("
+            f"module_name={self.module_name!r}, "
+            f"module_id={self.module_id!r}, "
+            f"channel_emoji={self.channel_emoji!r}, "
+            f"name={self.name!r}, "
+            f"alias={self.alias!r}, "
+            f"uid={self.uid!r}, "
+            f"vendor_specific={self.vendor_specific!r}, "
+            f"loaded_members={self.loaded_members!r}, "
+            f"pending_members={len(self.pending_members)}, "
+            f"notification={self.notification!r}, "
+            f"description={self.description!r}"
+            f")"
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_resolver'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+class UserInfo(NamedTuple):
+    """Name and picture of a user, without nicknames."""
+    uid: str
+    name: str
+    photo: Optional[str] = None
+    nickname: Optional[str] = None
+    own_nickname: Optional[str] = None
+
+
+class UserInfoResolver:
+    """
+    Resolve user information of group members in batches, with a shared
+    cache of user records.
+
+    IDs to look up are deduplicated, and those not in cache are fetched
+    with ``batch_size`` IDs per request.
+    """
+
+    logger = logging.getLogger("UserInfoResolver")
+
+    def __init__(self, client: 'EFMSClient', batch_size: int = 50, cache_size: int = 0, ttl: float = 0):
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.cache: LRUCache[ThreadID, Union[Thread, UserInfo]] = LRUCache(max_size=cache_size, ttl=ttl)
+
+    def prime(self, users: Iterable[User]):
+        """
+        Add names and pictures of users from a list of users to the cache,
+        e.g. from ``fetchAllUsers``.
+
+        Such lists do not include nicknames, so records already in cache are
+        kept, and aliases of group members are left to nicknames in groups.
+        """
+        for i in users:
+            if i.uid not in self.cache:
+                self.cache[i.uid] = UserInfo(uid=i.uid, name=i.name, photo=i.photo)
+
+    def resolve(self, user_ids: Iterable[ThreadID]) -> Dict[ThreadID, Union[Thread, UserInfo]]:
+        """
+        Get user records of a list of IDs.
+
+        Returns:
+            User records by their IDs. IDs that failed to resolve are omitted.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        missing = [i for i in user_ids if i not in self.cache]
+        for offset in range(0, len(missing), self.batch_size):
+            batch = missing[offset:offset + self.batch_size]
+            self.logger.debug("Fetching information of %s users: %s", len(batch), batch)
+            try:
+                for user in self.client.fetchThreadInfo(*batch).values():
+                    self.cache[user.uid] = user
+            except FBchatException:
+                self.logger.exception("Error occurred while fetching information of users %s.", batch)
+        result: Dict[ThreadID, Union[Thread, UserInfo]] = dict()
+        for i in user_ids:
+            user = self.cache.get(i)
+            if user is not None:
+                result[i] = user
+        return result
+
+
 class EFMSChatManager:
     logger = logging.getLogger("EFMSChatManager")
 
-    cache: Dict[Union[ChatID, ThreadID], Chat] = dict()
+    CACHE_VERSION = 2
+    """Version of the format of the chat cache file, bumped on incompatible changes."""
 
     def __init__(self, channel: 'FBMessengerChannel'):
         self.channel: 'FBMessengerChannel' = channel
         self.client = self.channel.client
         self._ = self.channel._
         self.ngettext = self.channel.ngettext
+        self.cache: LRUCache[Union[ChatID, ThreadID], Chat] = LRUCache(max_size=channel.flag('chat_cache_size'),
+                                                                      ttl=channel.flag('chat_cache_ttl'),
+                                                                      on_evict=self.on_chat_evicted)
+        self.user_resolver = UserInfoResolver(self.client,
+                                              batch_size=channel.flag('user_info_batch_size'),
+                                              cache_size=channel.flag('chat_cache_size'),
+                                              ttl=channel.flag('chat_cache_ttl'))
+        self.thread_types: LRUCache[ThreadID, ThreadType] = LRUCache(max_size=channel.flag('chat_cache_size'))
+        # Names of chats in cache, to search without requests.
+        self.search_index = ChatSearchIndex()
+        self.cache_path: Path = efb_utils.get_data_path(self.channel.channel_id) / "chats.json.gz"
+        # Saves from the refresh thread and on shutdown must not interleave.
+        self._save_lock = threading.Lock()
+        self.cache_loaded: bool = self.load_cache()
         self.get_thread(self.client.uid)
 
     def get_thread(self, thread_id: ThreadID) -> Chat:
-        if thread_id not in self.cache:
+        chat = self.cache.get(thread_id)
+        if chat is None:
+            self.logger.debug("[%s] Chat is not in cache, fetching from server. Cache: %s", thread_id, self.cache)
             chat = self.build_chat_by_thread_id(thread_id)
-            self.cache[thread_id] = chat
-        return self.cache[thread_id]
+            self.cache_chat(chat)
+        return chat
+
+    def get_thread_type(self, thread_id: ThreadID) -> ThreadType:
+        """
+        Get the type of a thread for sending messages, from cached chats
+        when possible.
+
+        Types fetched from the server are remembered for chats not in
+        cache, e.g. those removed from cache when they are changed.
+        """
+        chat = self.cache.get(thread_id)
+        if chat is not None:
+            chat_type = chat.vendor_specific.get('chat_type', '').upper()
+            if chat_type in ThreadType.__members__:
+                return ThreadType[chat_type]
+            if isinstance(chat, GroupChat):
+                return ThreadType.GROUP
+            return ThreadType.USER
+        thread_type = self.thread_types.get(thread_id)
+        if thread_type is None:
+            self.logger.debug("[%s] Chat is not in cache, fetching thread type from server.", thread_id)
+            thread_type = self.client.fetchThreadInfo(thread_id)[thread_id].type
+            self.thread_types[thread_id] = thread_type
+        return thread_type
+
+    def invalidate(self, thread_id: ThreadID):
+        """
+        Remove a chat from cache when it is changed, and notify the master
+        channel about it.
+        """
+        self.search_index.remove(str(thread_id))
+        if self.cache.invalidate(str(thread_id)) is not None:
+            self.logger.debug("[%s] Chat is removed from cache.", thread_id)
+            coordinator.send_status(ChatUpdates(channel=self.channel,
+                                                modified_chats=[ChatID(str(thread_id))]))
 
     def build_chat_by_thread_id(self, thread_id: ThreadID) -> Chat:
         thread: Thread = self.client.fetchThreadInfo(thread_id)[thread_id]
@@ -176,9 +423,51 @@ class EFMSChatManager:
 
     def build_and_cache_thread(self, thread: Thread) -> Chat:
         chat = self.build_chat_by_thread_obj(thread)
-        self.cache[chat.uid] = chat
+        self.cache_chat(chat)
         return chat
 
+    def cache_chat(self, chat: Chat):
+        """Save a chat to cache, and update it in the search index."""
+        self.cache[chat.uid] = chat
+        self.search_index.add(SearchEntry(uid=chat.uid, name=chat.name, alias=chat.alias,
+                                          chat_type=chat.vendor_specific.get('chat_type'),
+                                          keywords=self.search_keywords(chat)))
+
+    def on_chat_evicted(self, thread_id: Union[ChatID, ThreadID], chat: Chat):
+        self.search_index.remove(str(thread_id))
+
+    @staticmethod
+    def search_keywords(chat: Chat) -> Tuple[str, ...]:
+        """
+        Names and nicknames of members of a group to find it by, without
+        loading pending members of lazy groups.
+        """
+        if isinstance(chat, LazyGroupChat):
+            members: Iterable[ChatMember] = chat.loaded_members
+            keywords = [i for i in chat.pending_members.values() if i]
+        elif isinstance(chat, GroupChat):
+            members = chat.members
+            keywords = []
+        else:
+            return ()
+        for member in members:
+            if not isinstance(member, SelfChatMember):
+                keywords.append(member.name)
+                if member.alias:
+                    keywords.append(member.alias)
+        return tuple(keywords)
+
+    def is_lazy_group(self, thread: Thread) -> bool:
+        """
+        Check if members of a group should be loaded on demand.
+
+        Groups without a name are always loaded in full, as their names are
+        made from names of members.
+        """
+        threshold = self.channel.flag('lazy_group_members_threshold')
+        return isinstance(thread, Group) and bool(thread.name) and \
+            0 < threshold < len(thread.participants)
+
     def build_chat_by_thread_obj(self, thread: Thread) -> Chat:
         vendor_specific = {
             "chat_type": thread.type.name.capitalize(),
@@ -208,23 +497,33 @@ class EFMSChatManager:
         elif isinstance(thread, Group):
             name = thread.name or ""
 
+            participant_ids = thread.participants - {self.client.uid}
+            if self.is_lazy_group(thread):
+                nicknames = thread.nicknames or dict()
+                chat = LazyGroupChat(channel=self.channel,
+                                     name=name,
+                                     uid=ChatID(thread.uid),
+                                     vendor_specific=vendor_specific,
+                                     resolver=self.user_resolver,
+                                     participants={ChatID(i): nicknames.get(str(i)) or None
+                                                   for i in participant_ids})
+                chat.self.uid = self.client.uid
+                return chat
+
             group = GroupChat(channel=self.channel,
                               name=name,
                               uid=ChatID(thread.uid),
                               vendor_specific=vendor_specific)
-            participant_ids = thread.participants - {self.client.uid}
-            try:
-                participants: Dict[ThreadID, User] = self.client.fetchThreadInfo(*participant_ids)
-                for i in participant_ids:
-                    member = participants[i]
-                    alias = member.own_nickname or member.nickname or None
-                    if thread.nicknames and i in thread.nicknames:
-                        alias = thread.nicknames[str(i)] or None
-                    group.add_member(name=member.name, alias=alias, uid=ChatID(i))
-            except FBchatException:
-                self.logger.exception("Error occurred while building chat members.")
-                for i in participant_ids:
+            participants = self.user_resolver.resolve(participant_ids)
+            for i in participant_ids:
+                member = participants.get(i)
+                if member is None:
                     group.add_member(name=str(i), uid=ChatID(i))
+                    continue
+                alias = member.own_nickname or member.nickname or None
+                if thread.nicknames and i in thread.nicknames:
+                    alias = thread.nicknames[str(i)] or None
+                group.add_member(name=member.name, alias=alias, uid=ChatID(i))
 
             if thread.name is None:
                 names = sorted(i.name for i in group.members)
@@ -246,3 +545,143 @@ class EFMSChatManager:
         if chat.self:
             chat.self.uid = self.client.uid
         return chat
+
+    # region [Persistent cache]
+
+    def export_chat(self, chat: Chat) -> Dict[str, Any]:
+        """Convert a chat into a JSON-serializable record for the cache file."""
+        record: Dict[str, Any] = {
+            "type": type(chat).__name__,
+            "uid": chat.uid,
+            "name": chat.name,
+            "alias": chat.alias,
+            "description": chat.description,
+            "vendor_specific": chat.vendor_specific,
+        }
+        if isinstance(chat, LazyGroupChat):
+            record["members"] = [[i.uid, i.name, i.alias] for i in chat.loaded_members
+                                 if not isinstance(i, SelfChatMember)]
+            record["pending_members"] = chat.pending_members
+        elif isinstance(chat, GroupChat):
+            record["members"] = [[i.uid, i.name, i.alias] for i in chat.members
+                                 if not isinstance(i, SelfChatMember)]
+        return record
+
+    @staticmethod
+    def chat_signature(record: Dict[str, Any]) -> Tuple:
+        """
+        Summary of a chat record to compare with another one, regardless of
+        whether its members are loaded.
+        """
+        member_ids = sorted([i[0] for i in record.get("members", [])] + list(record.get("pending_members", {})))
+        return (record["name"], record["alias"], record["description"],
+                json.dumps(record["vendor_specific"], sort_keys=True), member_ids)
+
+    def import_chat(self, record: Dict[str, Any]) -> Chat:
+        """Build a chat from a record of the cache file."""
+        chat: Chat
+        if record["type"] == "PrivateChat":
+            chat = PrivateChat(channel=self.channel,
+                               name=record["name"],
+                               uid=ChatID(record["uid"]),
+                               alias=record["alias"],
+                               description=record["description"],
+                               vendor_specific=record["vendor_specific"],
+                               other_is_self=record["uid"] == self.client.uid)
+        elif record["type"] == "LazyGroupChat":
+            chat = LazyGroupChat(channel=self.channel,
+                                 name=record["name"],
+                                 uid=ChatID(record["uid"]),
+                                 alias=record["alias"],
+                                 description=record["description"],
+                                 vendor_specific=record["vendor_specific"],
+                                 resolver=self.user_resolver,
+                                 participants=record["pending_members"])
+            for uid, name, alias in record["members"]:
+                chat.loaded_members.append(ChatMember(chat, name=name, alias=alias, uid=ChatID(uid)))
+        elif record["type"] == "GroupChat":
+            chat = GroupChat(channel=self.channel,
+                             name=record["name"],
+                             uid=ChatID(record["uid"]),
+                             alias=record["alias"],
+                             description=record["description"],
+                             vendor_specific=record["vendor_specific"])
+            for uid, name, alias in record["members"]:
+                chat.add_member(name=name, alias=alias, uid=ChatID(uid))
+        else:
+            chat = SystemChat(channel=self.channel,
+                              name=record["name"],
+                              uid=ChatID(record["uid"]),
+                              alias=record["alias"],
+                              description=record["description"],
+                              vendor_specific=record["vendor_specific"])
+        if chat.self:
+            chat.self.uid = self.client.uid
+        return chat
+
+    def load_cache(self) -> bool:
+        """
+        Load chats from the cache file.
+
+        Returns:
+            If the cache is loaded.
+        """
+        try:
+            with gzip.open(str(self.cache_path), 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != self.CACHE_VERSION:
+                self.logger.info("Chat cache is in version %s, expecting %s. Ignored.",
+                                 data.get("version"), self.CACHE_VERSION)
+                return False
+            for record in data["chats"]:
+                self.cache_chat(self.import_chat(record))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError, AssertionError):
+            self.logger.exception("Failed to load chat cache from %s.", self.cache_path)
+            return False
+        self.logger.debug("Loaded %s chats from cache.", len(data["chats"]))
+        return True
+
+    def save_cache(self):
+        """Save all chats in cache to the cache file."""
+        data = {
+            "version": self.CACHE_VERSION,
+            "chats": [self.export_chat(i) for i in list(self.cache.values())],
+        }
+        with self._save_lock:
+            fd, temp_path = mkstemp(dir=str(self.cache_path.parent), prefix='.')
+            try:
+                with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(temp_path, str(self.cache_path))
+            except Exception:
+                with suppress(OSError):
+                    os.unlink(temp_path)
+                raise
+        self.logger.debug("Saved %s chats to cache.", len(data["chats"]))
+
+    def refresh_cache(self):
+        """
+        Reload the chat list from the server, and notify the master channel
+        of chats that are new or modified since the cache is loaded.
+
+        Chats missing from the list are not reported as removed, as the
+        list from the server does not include every chat known.
+        """
+        old_records = {uid: self.export_chat(chat) for uid, chat in list(self.cache.items())}
+        new_chats: List[ChatID] = []
+        modified_chats: List[ChatID] = []
+        for chat in self.channel.iter_chats():
+            if chat.uid not in old_records:
+                new_chats.append(chat.uid)
+            elif self.chat_signature(self.export_chat(chat)) != self.chat_signature(old_records[chat.uid]):
+                modified_chats.append(chat.uid)
+        self.logger.debug("Chat cache refreshed, new: %s, modified: %s.", new_chats, modified_chats)
+        if new_chats or modified_chats:
+            coordinator.send_status(ChatUpdates(channel=self.channel,
+                                                new_chats=new_chats,
+                                                modified_chats=modified_chats))
+        self.save_cache()
+
+    # endregion [Persistent cache]
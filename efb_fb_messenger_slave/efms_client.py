@@ -3,28 +3,34 @@
 import logging
 import copy
 import os
-import re
-import urllib.parse
 import threading
-import time
+import urllib.parse
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, Tuple, Set, List, DefaultDict, cast, Collection
-from tempfile import NamedTemporaryFile
+from typing import TYPE_CHECKING, Any, Dict, Tuple, List, DefaultDict, Optional, Union, Callable, cast, Collection
 
-import requests
 from fbchat import Client, _graphql
 from fbchat._exception import FBchatException, FBchatUserError
 from fbchat._thread import ThreadType, ThreadLocation, Thread
-from fbchat.models import Message, EmojiSize, Group, User
+from fbchat.models import Message, Group, User
 from ehforwarderbot import MsgType, coordinator
+from ehforwarderbot import utils as efb_utils
 from ehforwarderbot.chat import ChatMember
 from ehforwarderbot.message import Message as EFBMessage, Substitutions
 from ehforwarderbot.message import LinkAttribute, LocationAttribute
 from ehforwarderbot.status import MessageRemoval, MessageReactionsUpdate, ChatUpdates
 from ehforwarderbot.types import MessageID, ReactionName, ChatID
 
-from .utils import get_value, PahoMQTTPingFilter
+from .async_engine import AsyncEngine
+from .attachments import AttachmentInfo, classify_attachment
+from .cache import LRUCache
+from .echo import EchoSuppressor
+from .media import LazyFile, MediaCache, MediaDownloader, MediaTooLargeError
+from .message_store import MessageStore
+from .shared import shared_resources
+from .utils import PahoMQTTPingFilter
+from .workers import KeyedWorkerPool, KeyedDebouncer
 
 if TYPE_CHECKING:
     from . import FBMessengerChannel
@@ -35,9 +41,6 @@ class EFMSClient(Client):
 
     logger = logging.getLogger("EFMSClient")
 
-    sent_messages: Set[str] = set()
-    """Set of messages IDs sent by EFMS, popped when message is received again."""
-
     # Overrides for patches
 
     def __init__(self, channel: 'FBMessengerChannel', *args, **kwargs):
@@ -47,15 +50,100 @@ class EFMSClient(Client):
         self._ = self.channel._
         self.ngettext = self.channel.ngettext
 
-        # Mapping of message ID to number of EFB Messages sent.
+        # Messages split into multiple EFB messages.
         # Used when messages recalls from FB server
-        self.message_mappings: Dict[str, int] = dict()
+        self.message_store = MessageStore(efb_utils.get_data_path(channel.channel_id) / "messages.sqlite3",
+                                          retention=channel.flag('message_store_retention_days') * 86400)
+
+        # Messages sent by EFMS, ignored when received again.
+        self.echo_suppressor = EchoSuppressor()
+
+        # Pools, engines and caches below are shared with other accounts
+        # in the same process if enabled, and stored in the data path of
+        # the module instead of the instance.
+        if channel.flag('share_resources'):
+            self.resources_path: Path = efb_utils.get_data_path(type(channel).channel_id)
+        else:
+            self.resources_path = efb_utils.get_data_path(channel.channel_id)
+
+        # Process incoming messages in parallel, while keeping messages
+        # of the same thread in order.
+        self.inbound_pool: KeyedWorkerPool = self.acquire_resource(
+            "inbound_pool",
+            lambda: KeyedWorkerPool(max_workers=channel.flag('inbound_worker_threads'),
+                                    max_queue_size=channel.flag('inbound_queue_size'),
+                                    name="EFMS slave message thread"),
+            close=KeyedWorkerPool.shutdown)
+
+        # Run HTTP downloads and GraphQL requests on an event loop if enabled.
+        self.async_engine: Optional[AsyncEngine] = None
+        if channel.flag('async_engine'):
+            self.async_engine = self.acquire_resource("async_engine", AsyncEngine, close=AsyncEngine.stop)
+
+        # Download attachments through a shared connection pool.
+        self.downloader: MediaDownloader = self.acquire_resource("downloader", self.build_downloader,
+                                                                 close=MediaDownloader.close)
+
+        # Download attachments of the same message in parallel.
+        self.attachment_pool: ThreadPoolExecutor = self.acquire_resource(
+            "attachment_pool",
+            lambda: ThreadPoolExecutor(max_workers=channel.flag('attachment_download_workers'),
+                                       thread_name_prefix="EFMS attachment download"),
+            close=lambda pool: pool.shutdown(wait=False))
+
+        # URLs of original images resolved recently, by attachment ID.
+        # URLs expire after a while, so they are only kept for an hour.
+        self.image_urls: LRUCache[str, str] = LRUCache(max_size=1000, ttl=3600)
+
+        # Reactions of recent messages, as user ID to reaction, by message ID.
+        # Updated with reaction events to avoid fetching messages again.
+        self.reactions: LRUCache[str, Dict[str, str]] = LRUCache(max_size=1000)
+        self.reactions_lock = threading.Lock()
+        # Messages with reactions being fetched, and if reaction events
+        # arrived during the fetch.
+        self.reaction_fetches: Dict[str, bool] = dict()
+
+        # Collapse bursts of reactions to the same message into one update.
+        self.reaction_debouncer = KeyedDebouncer(self.on_message_reaction,
+                                                 window=channel.flag('reaction_coalesce_window'))
 
         # Suppress ping logs from paho.mqtt.client
         logging.getLogger("paho.mqtt.client").addFilter(PahoMQTTPingFilter())
-        super().__init__(*args, **kwargs)
+        try:
+            super().__init__(*args, **kwargs)
+        except BaseException:
+            # Login failed, nothing else would release the resources.
+            self.release_resources()
+            raise
         self.logger = logging.getLogger(__name__)
 
+    def acquire_resource(self, name: str, factory: Callable[[], Any],
+                         close: Optional[Callable[[Any], None]] = None) -> Any:
+        """
+        Get a resource shared with other accounts in the same process if
+        enabled, or a resource of this account otherwise.
+
+        Shared resources are created with the flags of the first account.
+        """
+        if not self.channel.flag('share_resources'):
+            name = f"{self.channel.channel_id}:{name}"
+        return shared_resources.acquire(name, self.channel.channel_id, factory, close)
+
+    def release_resources(self):
+        """Release resources of this account, closing those no longer used by other accounts."""
+        shared_resources.release(self.channel.channel_id)
+        self.message_store.close()
+
+    def build_downloader(self) -> MediaDownloader:
+        media_cache = None
+        if self.channel.flag('media_cache_size'):
+            media_cache = MediaCache(self.resources_path / "media_cache",
+                                     max_size=self.channel.flag('media_cache_size') * 1024 * 1024)
+        return MediaDownloader(max_size=self.channel.flag('media_max_size') * 1024 * 1024,
+                               timeout=self.channel.flag('media_download_timeout'),
+                               cache=media_cache,
+                               engine=self.async_engine)
+
     @property
     def chat_manager(self):
         # Using property to avoid cyclic reference.
@@ -84,6 +172,19 @@ class EFMSClient(Client):
         file_ids = self._upload(files)
         return self._sendFiles(files=file_ids, message=message, thread_id=thread_id, thread_type=thread_type)
 
+    def _doSendRequest(self, data, get_thread_id=False):
+        """Send the data to `SendURL`, and register the message ID to ignore its echo."""
+        thread_id = str(data.get('thread_fbid') or data.get('other_user_fbid'))
+        with self.echo_suppressor.sending(thread_id):
+            mid, new_thread_id = super()._doSendRequest(data, get_thread_id=True)
+            if mid:
+                self.echo_suppressor.register(mid)
+                self.remember_reactions(mid, dict())
+                self.logger.debug("Sent message with ID %s", mid)
+        if get_thread_id:
+            return mid, new_thread_id
+        return mid
+
     def markAsDelivered(self, thread_id, message_id):
         """Mark message as delivered"""
         super().markAsDelivered(thread_id, message_id)
@@ -138,9 +239,33 @@ class EFMSClient(Client):
         else:
             return url
 
-    def attach_msg_type(self, msg: Message, attachment: Dict[str, Any]):
+    def apply_attachment_info(self, msg: Message, info: AttachmentInfo):
+        """Set type, text, attributes and file information of a message from an attachment, without its file."""
+        msg.type = info.msg_type
+        msg.filename = info.filename
+        msg.mime = info.mime
+        if info.msg_type == MsgType.Unsupported:
+            content = info.text if info.text is not None else msg.text
+            msg.text = self._("Message type unsupported.\n{content}").format(content=content or "")
+        elif info.msg_type == MsgType.Link:
+            msg.attributes = LinkAttribute(title=info.title,
+                                           description=info.description,
+                                           image=self.process_url(info.preview),
+                                           url=self.process_url(info.url))
+        elif info.msg_type == MsgType.Location:
+            msg.text = info.text
+            msg.attributes = LocationAttribute(latitude=info.latitude, longitude=info.longitude)
+        elif info.text is not None:
+            msg.text = info.text
+        if info.attribution_app:
+            if msg.text:
+                msg.text += " (via %s)" % info.attribution_app
+            else:
+                msg.text = "via %s" % info.attribution_app
+
+    def attach_media(self, msg: Message, attachment: Dict[str, Any]):
         """
-        Attach message_type to a message.
+        Attach an attachment to a message.
 
         Args:
             msg: Message to be attached to
@@ -148,218 +273,145 @@ class EFMSClient(Client):
                 Dict of information of the attachment
                 ``fbchat`` entity is not used as it is not completed.
         """
-        blob_attachment: Dict[str, Any] = attachment.get('mercury', {}).get('blob_attachment', attachment)
-        attachment_type: str = blob_attachment.get("__typename", None)
-        if 'sticker_attachment' in attachment.get('mercury', {}):
-            attachment_type = '__Sticker'
-        if 'extensible_attachment' in attachment.get('mercury', {}):
-            attachment_type = '__Link'
-            if get_value(attachment, ('mercury', 'extensible_attachment',
-                                      'story_attachment', 'target', '__typename')) == 'MessageLocation':
-                attachment_type = 'MessageLocation'
-
-        if attachment_type == "MessageAudio":
-            msg.type = MsgType.Voice
-        elif attachment_type == 'MessageImage':
-            msg.type = MsgType.Image
-        elif attachment_type == 'MessageAnimatedImage':
-            msg.type = MsgType.Image
-        elif attachment_type == 'MessageFile':
-            msg.type = MsgType.File
-        elif attachment_type == 'MessageVideo':
-            msg.type = MsgType.Image
-        elif attachment_type == '__Sticker':
-            msg.type = MsgType.Sticker
-            msg.text = attachment['mercury']['sticker_attachment'].get('label', '')
-        elif attachment_type == '__Link':
-            msg.type = MsgType.Link
-            link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
-            title = get_value(link_information, ('title_with_entities', 'text'), '')
-            description = get_value(link_information, ('description', 'text'), '')
-            source = get_value(link_information, ('source', 'text'), None)
-            if source:
-                description += " (via %s)" % source
-            preview = get_value(link_information, ('media', 'playable_url'), None) if \
-                get_value(link_information, ('media', 'is_playable'), False) else None
-            preview = preview or get_value(link_information, ('media', 'image', 'uri'), None)
-            url = link_information['media'].get('url', preview)
-            msg.attributes = LinkAttribute(title=title,
-                                           description=description,
-                                           image=self.process_url(preview),
-                                           url=self.process_url(url))
-        elif attachment_type == 'MessageLocation':
-            msg.type = MsgType.Location
-            link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
-            title = get_value(link_information, ('title_with_entities', 'text'), '')
-            description = get_value(link_information, ('description', 'text'), '')
-            msg.text = '\n'.join([title, description])
-            preview = get_value(link_information, ('media', 'image', 'uri'), None)
-            matches = re.search(r'markers=([\d.-]+)%2C([\d.-]+)', preview)
-            if matches:
-                latitude, longitude = map(float, matches.groups())
-            else:
-                msg.type = MsgType.Unsupported
-                msg.text = self._("Message type unsupported.\n{content}").format(msg.text)
-                return
-            msg.attributes = LocationAttribute(
-                latitude=latitude, longitude=longitude
-            )
+        self.logger.debug("[%s] Trying to attach media: %s", msg.uid, attachment)
+
+        info = classify_attachment(attachment)
+        self.logger.debug("[%s] The attachment has type %s", msg.uid, info.type)
+        if info.msg_type == MsgType.Text and info.type == '__Sticker':
+            self.logger.debug("[%s] Sticker received is a \"Like\" sticker. Converting message to text.", msg.uid)
+        self.apply_attachment_info(msg, info)
+
+        if info.type == 'MessageImage':
+            quality = self.channel.flag('image_quality')
+            cache_key = f"attachment:{info.id}"
+            if quality != 'original':
+                cache_key += f":{quality}"
+            self.download_file(msg, self.get_image_url(info.id, info.blob, quality), cache_key=cache_key)
+        elif msg.type not in (MsgType.Voice, MsgType.Image, MsgType.Animation, MsgType.File, MsgType.Sticker):
+            return
+        elif not info.url:
+            self.logger.warning("[%s] Attachment of type %s has no URL: %s", msg.uid, info.type, attachment)
+            self.apply_attachment_info(msg, info._replace(msg_type=MsgType.Unsupported, filename=None, mime=None))
+        elif info.type == 'MessageAnimatedImage':
+            self.download_file(msg, info.url, cache_key=info.id and f"attachment:{info.id}")
+        elif info.type == 'MessageFile':
+            self.download_file(msg, self.process_url(info.url, True))
+        elif info.type == '__Sticker':
+            msg.mime = self.download_file(msg, info.url, cache_key=info.sticker_id and f"sticker:{info.sticker_id}",
+                                          allow_lazy=False) or msg.mime
         else:
-            msg.type = MsgType.Unsupported
-            msg.text = self._("Message type unsupported.\n{content}").format(msg.text)
+            self.download_file(msg, info.url)
 
-    def attach_media(self, msg: Message, attachment: Dict[str, Any]):
+    def get_image_url(self, attachment_id: str, blob_attachment: Dict[str, Any],
+                      quality: str = 'original') -> Union[str, Callable[[], str]]:
         """
-        Attach an attachment to a message.
+        Choose the URL to download an image attachment in a quality tier.
+
+        URLs in the message payload are preferred, to save a request to
+        resolve the URL of the original image. The large preview is used
+        as the original image when it is in the original size.
 
         Args:
-            msg: Message to be attached to
-            attachment:
-                Dict of information of the attachment
-                ``fbchat`` entity is not used as it is not completed.
+            attachment_id: ID of the attachment
+            blob_attachment: Payload of the attachment
+            quality: ``'original'``, ``'large'`` or ``'preview'``
+
+        Returns:
+            URL of the image, or a function resolving the URL of the original
+            image if it is not in the payload.
         """
-        self.logger.debug("[%s] Trying to attach media: %s", msg.uid, attachment)
+        large = blob_attachment.get('large_preview') or {}
+        preview = blob_attachment.get('preview') or {}
+        if quality == 'preview':
+            candidates = [preview, large]
+        elif quality == 'large':
+            candidates = [large, preview]
+        else:
+            original = blob_attachment.get('original_dimensions') or {}
+            full_size = bool(original.get('width') and original.get('height')) and \
+                (large.get('width') or 0) >= original['width'] and \
+                (large.get('height') or 0) >= original['height']
+            candidates = [large] if full_size else []
+        for i in candidates:
+            if i.get('uri'):
+                return i['uri']
+        return lambda: self.resolve_image_url(attachment_id)
+
+    def resolve_image_url(self, attachment_id: str) -> str:
+        """Get the URL of the original image of an attachment, from cache if resolved recently."""
+        url = self.image_urls.get(attachment_id)
+        if url is None:
+            url = self.fetchImageUrl(attachment_id)
+            self.image_urls[attachment_id] = url
+        return url
+
+    def download_file(self, msg: EFBMessage, url: Union[str, Callable[[], str]],
+                      cache_key: Optional[str] = None, allow_lazy: bool = True) -> Optional[str]:
+        """
+        Download a file and attach it to a message.
+
+        When the file is too large, the message is marked as unsupported
+        instead. In lazy media mode, the file is attached as a proxy
+        that is downloaded in background, and errors are raised when the
+        file is read.
+
+        Args:
+            msg: Message to be attached to, with ``filename`` set
+            url: URL of the file, or a function to resolve it when not in cache
+            cache_key: Key of the file in media cache, if it should be cached
+            allow_lazy: If the file can be downloaded in background
 
-        blob_attachment: Dict[str, Any] = attachment.get('mercury', {}).get('blob_attachment', {})
-        attachment_type: str = blob_attachment.get("__typename", None)
-        if 'sticker_attachment' in attachment.get('mercury', {}):
-            attachment_type = '__Sticker'
-        if 'extensible_attachment' in attachment.get('mercury', {}):
-            attachment_type = '__Link'
-            extensible_type = get_value(attachment, ('mercury', 'extensible_attachment',
-                                                     'story_attachment', 'target', '__typename'))
-            if extensible_type == 'MessageLocation':
-                attachment_type = 'MessageLocation'
-            elif extensible_type == 'MessageLiveLocation':
-                attachment_type = 'MessageLocation'  # TODO: Change if live location is supported by framework.
-
-        self.logger.debug("[%s] The attachment has type %s", msg.uid, attachment_type)
-
-        msg.filename = attachment.get('filename', None)
-        msg.mime = attachment.get('mimeType', None)
-        if attachment_type == "MessageAudio":
-            msg.type = MsgType.Voice
-            msg.filename = msg.filename or 'audio.mp3'
-            msg.mime = msg.mime or 'audio/mpeg'
-            ext = os.path.splitext(msg.filename)[1]
-            msg.file = NamedTemporaryFile(suffix=ext)
-            msg.file.write(requests.get(blob_attachment['playable_url']).content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == 'MessageImage':
-            msg.type = MsgType.Image
-            msg.filename = msg.filename or 'image.png'
-            msg.mime = msg.mime or 'image/png'
-            attribution_app = get_value(blob_attachment, ('attribution_app', 'name'))
-            if attribution_app:
-                if msg.text:
-                    msg.text += " (via %s)" % attribution_app
-                else:
-                    msg.text = "via %s" % attribution_app
-            ext = os.path.splitext(msg.filename)[1]
-            msg.file = NamedTemporaryFile(suffix=ext)
-            url = self.fetchImageUrl(attachment['id'])
-            msg.file.write(requests.get(url).content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == 'MessageAnimatedImage':
-            msg.type = MsgType.Animation
-            msg.filename = msg.filename or 'image.gif'
-            msg.mime = msg.mime or 'image/gif'
-            ext = os.path.splitext(msg.filename)[1]
-            msg.file = NamedTemporaryFile(suffix=ext)
-            msg.file.write(requests.get(blob_attachment['animated_image']['uri'], allow_redirects=True).content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == 'MessageFile':
-            msg.type = MsgType.File
-            msg.filename = msg.filename or 'file'
-            msg.mime = msg.mime or 'application/octet-stream'
-            ext = os.path.splitext(msg.filename)[1]
-            msg.file = NamedTemporaryFile(suffix=ext)
-            msg.file.write(requests.get(self.process_url(blob_attachment['url'], True), allow_redirects=True).content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == 'MessageVideo':
-            msg.type = MsgType.Image
-            msg.filename = msg.filename or 'video.mp4'
-            msg.mime = msg.mime or 'video/mpeg'
-            ext = os.path.splitext(msg.filename)[1]
-            msg.file = NamedTemporaryFile(suffix=ext)
-            msg.file.write(requests.get(blob_attachment['playable_url'], allow_redirects=True).content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == '__Sticker':
-            if get_value(attachment, ('mercury', 'sticker_attachment', 'pack', 'id')) == "227877430692340":
-                self.logger.debug("[%s] Sticker received is a \"Like\" sticker. Converting message to text.", msg.uid)
-
-                sticker_id = get_value(attachment, ('mercury', 'sticker_attachment', 'id'))
-                for i in EmojiSize:
-                    if sticker_id == i.value:
-                        msg.type = MsgType.Text
-                        msg.text = "👍 (%s)" % i.name[0]
-                        return
-            msg.type = MsgType.Sticker
-            url = attachment['mercury']['sticker_attachment']['url']
-            msg.text = attachment['mercury']['sticker_attachment'].get('label', '')
-            filename = os.path.split(urllib.parse.urlparse(url).path)[1]
-            msg.filename = filename
-            ext = os.path.splitext(filename)[1]
-            response = requests.get(url)
-            msg.mime = response.headers['content-type']
-            msg.file = NamedTemporaryFile(suffix=ext)
-            msg.file.write(response.content)
-            msg.file.seek(0)
-            msg.path = Path(msg.file.name)
-        elif attachment_type == '__Link':
-            msg.type = MsgType.Link
-            link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
-            title = get_value(link_information, ('title_with_entities', 'text'), '')
-            description = get_value(link_information, ('description', 'text'), '')
-            source = get_value(link_information, ('source', 'text'), None)
-            if source:
-                description += " (via %s)" % source
-            preview = get_value(link_information, ('media', 'playable_url'), None) if \
-                get_value(link_information, ('media', 'is_playable'), False) else None
-            preview = preview or get_value(link_information, ('media', 'image', 'uri'), None)
-            url = link_information.get('url', preview)
-            msg.attributes = LinkAttribute(title=title,
-                                           description=description,
-                                           image=self.process_url(preview),
-                                           url=self.process_url(url))
-        elif attachment_type == 'MessageLocation':
-            msg.type = MsgType.Location
-            link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
-            title = get_value(link_information, ('title_with_entities', 'text'), '')
-            description = get_value(link_information, ('description', 'text'), '')
-            msg.text = '\n'.join([title, description])
-            preview = get_value(link_information, ('media', 'image', 'uri'), None)
-            matches = re.search(r'markers=([\d.-]+)%2C([\d.-]+)', preview)
-            if matches:
-                latitude, longitude = map(float, matches.groups())
+        Returns:
+            MIME type of the file reported by the server, if available.
+        """
+        ext = os.path.splitext(msg.filename or '')[1]
+        if allow_lazy and self.channel.flag('lazy_media_download'):
+            if self.downloader.engine is not None:
+                future = self.downloader.download_async(url, suffix=ext, cache_key=cache_key)
             else:
-                msg.type = MsgType.Unsupported
-                msg.text = self._("Message type unsupported.\n{content}").format(msg.text)
-                return
-            msg.attributes = LocationAttribute(
-                latitude=latitude, longitude=longitude
-            )
-        else:
+                future = self.attachment_pool.submit(self.downloader.download, url, suffix=ext, cache_key=cache_key)
+            future.add_done_callback(lambda f: self.report_download_error(f, msg.uid))
+            msg.file = LazyFile(future)
+            msg.path = None
+            return None
+        try:
+            download = self.downloader.download(url, suffix=ext, cache_key=cache_key)
+        except MediaTooLargeError as e:
+            self.logger.warning("[%s] Attachment is too large (%s bytes), skipped: %s", msg.uid, e.size, url)
             msg.type = MsgType.Unsupported
-            msg.text = self._("Message type unsupported.\n{content}").format(msg.text)
-
-    def send(self, *args, **kwargs):
-        result = super().send(*args, **kwargs)
-        if result.startswith('mid.$'):
-            self.sent_messages.add(result)
-        return result
+            msg.file = msg.path = msg.filename = msg.mime = None
+            msg.text = self._("Attachment is too large to be delivered ({size:.1f} MB).\n{content}").format(
+                size=e.size / 1024 / 1024, content=msg.text or "")
+            return None
+        msg.file = download.file
+        msg.path = Path(download.file.name)
+        return download.mime
+
+    def mark_attachment_failed(self, msg: EFBMessage, text: Optional[str]):
+        """Deliver a message as unsupported when its attachment failed to download."""
+        msg.type = MsgType.Unsupported
+        msg.file = msg.path = msg.filename = msg.mime = None
+        msg.text = self._("Failed to download attachment.\n{content}").format(content=text or "")
+
+    def report_download_error(self, future: Future, uid: str):
+        """Log the exception raised by a download in background, if any."""
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error("[%s] Failed to download attachment: %r", uid, future.exception())
 
     # Triggers
 
     def onMessage(self, *args, **kwargs):
-        """Migrate message precessing to another thread to prevent blocking."""
-        threading.Thread(target=self.on_message, args=args, kwargs=kwargs,
-                         name=f"EFMS slave message thread for {kwargs['mid']}").run()
+        """Migrate message precessing to the worker pool to prevent blocking."""
+        # Keyed by account as well, as the pool may be shared with other accounts.
+        future = self.inbound_pool.submit((self.channel.channel_id, kwargs.get('thread_id')),
+                                          self.on_message, *args, **kwargs)
+        future.add_done_callback(lambda f: self.report_task_error(f, kwargs.get('msg')))
+
+    def report_task_error(self, future: Future, msg: Dict[str, Any] = None):
+        """Report the exception raised by a task in the worker pool, if any."""
+        exception = future.exception()
+        if exception is not None:
+            self.onMessageError(exception=exception, msg=msg)
 
     def on_message(self, mid: str = '', author_id: str = '', message: str = '', message_object: Message = None,
                    thread_id: str = '', thread_type: str = ThreadType.USER, ts: str = '', metadata=None, msg=None):
@@ -379,31 +431,44 @@ class EFMSClient(Client):
         """
 
         # Ignore messages sent by EFMS
-        time.sleep(0.25)
-
-        if mid in self.sent_messages:
-            self.sent_messages.remove(mid)
+        if self.echo_suppressor.is_echo(mid, thread_id, from_self=author_id == self.uid):
+            self.logger.debug("[%s] Ignored message sent by EFMS.", mid)
             return
 
         self.logger.debug("[%s] Received message from Messenger: %s", mid, message_object)
 
         efb_msg = self.build_efb_msg(mid, thread_id, author_id, message_object)
+        self.remember_reactions(mid, {user_id: reaction.value
+                                      for user_id, reaction in (message_object.reactions or {}).items()})
 
         attachments = msg.get('attachments', [])
 
         if len(attachments) > 1:
             self.logger.debug("[%s] Multiple attachments detected. Splitting into %s messages.",
                               mid, len(attachments))
-            self.message_mappings[mid] = len(attachments)
+            self.message_store.save(mid, thread_id, parts=len(attachments))
+            # Download attachments in parallel, but deliver them in order.
+            sub_msgs: List[Tuple[EFBMessage, Future]] = []
             for idx, i in enumerate(attachments):
                 sub_msg = copy.copy(efb_msg)
                 sub_msg.uid = MessageID(f"{efb_msg.uid}.{idx}")
-                self.attach_media(sub_msg, i)
+                sub_msgs.append((sub_msg, self.attachment_pool.submit(self.attach_media, sub_msg, i)))
+            for sub_msg, future in sub_msgs:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.exception("[%s] Failed to attach media: %s", sub_msg.uid, e)
+                    self.mark_attachment_failed(sub_msg, efb_msg.text)
                 coordinator.send_message(sub_msg)
             return
 
         if attachments:
-            self.attach_media(efb_msg, attachments[0])
+            text = efb_msg.text
+            try:
+                self.attach_media(efb_msg, attachments[0])
+            except Exception as e:
+                self.logger.exception("[%s] Failed to attach media: %s", efb_msg.uid, e)
+                self.mark_attachment_failed(efb_msg, text)
 
         coordinator.send_message(efb_msg)
 
@@ -513,23 +578,85 @@ class EFMSClient(Client):
 
     def onReactionAdded(self, mid=None, reaction=None, author_id=None, thread_id=None, thread_type=None, ts=None,
                         msg=None):
-        self.on_message_reaction(thread_id, mid)
+        self.update_reaction(mid, author_id, reaction and reaction.value)
+        self.reaction_debouncer((thread_id, mid), thread_id, mid)
 
     def onReactionRemoved(self, mid=None, author_id=None, thread_id=None, thread_type=None, ts=None, msg=None):
-        self.on_message_reaction(thread_id, mid)
+        self.update_reaction(mid, author_id, None)
+        self.reaction_debouncer((thread_id, mid), thread_id, mid)
+
+    def remember_reactions(self, message_id: str, reactions: Dict[str, str]):
+        """Remember reactions of a message, as user ID to reaction."""
+        with self.reactions_lock:
+            self.reactions[message_id] = reactions
+
+    def update_reaction(self, message_id: str, author_id: str, reaction: Optional[str]):
+        """
+        Apply a reaction event to the known reactions of a message.
+
+        Reactions of the message are forgotten if they are inconsistent with
+        the event, and are to be fetched from the server again.
+
+        Args:
+            message_id: ID of the message reacted to
+            author_id: ID of the user reacting
+            reaction: Reaction added, ``None`` if removed
+        """
+        with self.reactions_lock:
+            reactions = self.reactions.get(message_id)
+            if reactions is None:
+                if message_id in self.reaction_fetches:
+                    # The reactions being fetched might not include this event.
+                    self.reaction_fetches[message_id] = True
+                return
+            reactions = reactions.copy()
+            if reaction:
+                reactions[author_id] = reaction
+            elif reactions.pop(author_id, None) is None:
+                self.logger.debug("[%s] Reaction removed by %s is unknown, reload reactions from server.",
+                                  message_id, author_id)
+                self.reactions.invalidate(message_id)
+                return
+            self.reactions[message_id] = reactions
+
+    def fetch_reactions(self, thread_id: str, message_id: str) -> Dict[str, str]:
+        """
+        Fetch reactions of a message from the server, as user ID to reaction.
+
+        Reactions fetched are only remembered if no reaction event arrived
+        during the fetch, otherwise they are fetched again next time.
+        """
+        with self.reactions_lock:
+            self.reaction_fetches.setdefault(message_id, False)
+        try:
+            thread_id, thread_type = self._getThread(thread_id, None)
+            msg_data = self._forcedFetch(thread_id, message_id).get("message")
+            msg: Message = Message._from_graphql(msg_data)
+        except BaseException:
+            with self.reactions_lock:
+                self.reaction_fetches.pop(message_id, None)
+            raise
+        reactions = {user_id: reaction.value for user_id, reaction in (msg.reactions or {}).items()}
+        with self.reactions_lock:
+            changed = self.reaction_fetches.pop(message_id, True)
+            if not changed and self.reactions.get(message_id) is None:
+                self.reactions[message_id] = reactions
+        return reactions
 
     def on_message_reaction(self, thread_id, message_id):
-        thread_id, thread_type = self._getThread(thread_id, None)
-        msg_data = self._forcedFetch(thread_id, message_id).get("message")
-        msg: Message = Message._from_graphql(msg_data)
+        with self.reactions_lock:
+            reactions_by_user = self.reactions.get(message_id)
+        if reactions_by_user is None:
+            self.logger.debug("[%s] Reactions are unknown, fetching from server.", message_id)
+            reactions_by_user = self.fetch_reactions(thread_id, message_id)
 
         chat = self.chat_manager.get_thread(thread_id)
 
         reactions = {}
-        if msg.reactions:
+        if reactions_by_user:
             reactions = defaultdict(list)
-            for user_id, reaction in msg.reactions.items():
-                reactions[reaction.value].append(chat.get_member(user_id))
+            for user_id, reaction in reactions_by_user.items():
+                reactions[reaction].append(chat.get_member(user_id))
 
         update = MessageReactionsUpdate(chat=chat, msg_id=message_id, reactions=reactions)
 
@@ -538,20 +665,28 @@ class EFMSClient(Client):
     def onMessageUnsent(self, mid=None, author_id=None, thread_id=None, thread_type=None, ts=None, msg=None):
         chat = self.chat_manager.get_thread(thread_id)
         author = chat.get_member(author_id)
-        if mid in self.message_mappings:
-            for i in range(self.message_mappings[mid]):
-                coordinator.send_status(
-                    MessageRemoval(source_channel=self.channel,
-                                   destination_channel=coordinator.master,
-                                   message=EFBMessage(chat=chat, author=author, uid=f"{mid}.{i}"))
-                )
-        else:
+        for uid in self.message_store.part_ids(mid):
             coordinator.send_status(
                 MessageRemoval(source_channel=self.channel,
                                destination_channel=coordinator.master,
-                               message=EFBMessage(chat=chat, author=author, uid=mid))
+                               message=EFBMessage(chat=chat, author=author, uid=uid))
             )
 
+    def onTitleChange(self, thread_id=None, **kwargs):
+        self.chat_manager.invalidate(thread_id)
+
+    def onImageChange(self, thread_id=None, **kwargs):
+        self.chat_manager.invalidate(thread_id)
+
+    def onNicknameChange(self, thread_id=None, **kwargs):
+        self.chat_manager.invalidate(thread_id)
+
+    def onPeopleAdded(self, thread_id=None, **kwargs):
+        self.chat_manager.invalidate(thread_id)
+
+    def onPersonRemoved(self, thread_id=None, **kwargs):
+        self.chat_manager.invalidate(thread_id)
+
     def onMessageError(self, exception=None, msg=None):
         self.logger.exception("Error %s occurred while parsing %s", exception, msg, exc_info=exception)
 
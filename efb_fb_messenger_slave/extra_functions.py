@@ -1,6 +1,8 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable, Collection, List, Optional
 
-from fbchat.models import ThreadType
+from fbchat.models import Thread, ThreadType
+
+from .search_index import SearchEntry
 
 if TYPE_CHECKING:
     from . import FBMessengerChannel
@@ -29,36 +31,51 @@ class ExtraFunctionsManager:
 
     @catch_exceptions
     def threads_list(self, args: str) -> str:
-        chats = self.channel.get_chats()
+        thread_ids = self.channel.thread_sync.thread_ids(self.channel.thread_locations)
         msg = self.ngettext("You have {0} thread in your thread list.",
                             "You have {0} threads in your thread list.",
-                            len(chats)).format(len(chats)) + "\n"
-        for i in chats:
+                            len(thread_ids)).format(len(thread_ids)) + "\n"
+        for i in thread_ids:
+            chat = self.chat_manager.cache.get(i)
+            if chat is None:
+                msg += "\n{id}: [{type}]".format(id=i, type=self.channel.thread_sync.threads[i]["type"])
+                continue
             msg += "\n{chat.id}: {chat.name} [{type}]" \
-                .format(chat=i,
-                        type=i.vendor_specific.get('chat_type'))
+                .format(chat=chat,
+                        type=chat.vendor_specific.get('chat_type'))
         return msg
 
+    def search(self, query: str, chat_types: Optional[Collection[str]],
+               remote_search: Callable[..., List[Thread]]) -> List[SearchEntry]:
+        """
+        Search chats in the local index, or with the remote search function
+        if nothing is found locally.
+        """
+        results = self.chat_manager.search_index.search(query, limit=10, chat_types=chat_types)
+        if results:
+            return results
+        return [SearchEntry(uid=i.uid, name=i.name, alias=getattr(i, 'nickname', None),
+                            chat_type=i.type.name.capitalize() if i.type else None)
+                for i in remote_search(query, limit=10)]
+
     @catch_exceptions
     def search_users(self, args: str) -> str:
-        users = list(map(self.chat_manager.build_chat_by_thread_obj,
-                         self.client.searchForUsers(args, limit=10)))
+        users = self.search(args, ("User",), self.client.searchForUsers)
         msg = self.ngettext("Found {} user.",
                             "Found {} users.",
                             len(users)).format(len(users)) + "\n"
         for i in users:
-            msg += "\n{chat.id}: {chat.name}".format(chat=i)
+            msg += "\n{chat.uid}: {chat.name}".format(chat=i)
         return msg
 
     @catch_exceptions
     def search_groups(self, args: str) -> str:
-        groups = list(map(self.chat_manager.build_chat_by_thread_obj,
-                          self.client.searchForGroups(args, limit=10)))
+        groups = self.search(args, ("Group",), self.client.searchForGroups)
         msg = self.ngettext("Found {} group.",
                             "Found {} groups.",
                             len(groups)).format(len(groups)) + "\n"
         for i in groups:
-            msg += "\n{chat.id}: {chat.name}".format(chat=i)
+            msg += "\n{chat.uid}: {chat.name}".format(chat=i)
         return msg
 
     @catch_exceptions
@@ -74,15 +91,12 @@ class ExtraFunctionsManager:
 
     @catch_exceptions
     def search_threads(self, args: str) -> str:
-        threads = list(map(self.chat_manager.build_chat_by_thread_obj,
-                           self.client.searchForThreads(args, limit=10)))
+        threads = self.search(args, None, self.client.searchForThreads)
         msg = self.ngettext("Found {} thread.",
                             "Found {} threads.",
                             len(threads)).format(len(threads)) + "\n"
         for i in threads:
-            msg += "\n{chat.id}: {chat.name} [{type}]" \
-                .format(chat=i,
-                        type=i.vendor_specific.get('chat_type'))
+            msg += "\n{chat.uid}: {chat.name} [{chat.chat_type}]".format(chat=i)
         return msg
 
     @catch_exceptions
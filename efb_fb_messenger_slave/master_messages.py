@@ -1,17 +1,23 @@
 # coding=utf-8
 
+import itertools
 import logging
 import threading
 import time
-from typing import TYPE_CHECKING, Tuple, List
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Tuple, List, Optional
 
 import emoji
-from fbchat.models import Thread, Message, TypingStatus, ThreadType, Mention, EmojiSize, Sticker, LocationAttachment
+import requests
+from urllib3.exceptions import NewConnectionError
+from fbchat import FBchatException, FBchatFacebookError
+from fbchat.models import Message, TypingStatus, ThreadType, Mention, EmojiSize, Sticker, LocationAttachment
 
 from ehforwarderbot import MsgType
 from ehforwarderbot.message import Message as EFBMessage
 from ehforwarderbot.exceptions import EFBMessageTypeNotSupported
 from ehforwarderbot.message import LinkAttribute, StatusAttribute, LocationAttribute
+from .workers import KeyedDebouncer, KeyedWorkerPool, TokenBucket
 
 if TYPE_CHECKING:
     from . import FBMessengerChannel
@@ -28,135 +34,204 @@ class MasterMessageManager:
                                MsgType.Status, MsgType.Unsupported,
                                MsgType.Location, MsgType.Animation}
 
+    mark_read_window = 1.0
+    """Seconds to collect messages sent to a thread before marking it as read."""
+
     def __init__(self, channel: 'FBMessengerChannel'):
         self.channel = channel
         self.client = channel.client
         self.flag = channel.flag
-
-    def send_message(self, msg: EFBMessage) -> Message:
+        self.chat_manager = channel.chat_manager
+        # Messages to the same thread are sent in order, and threads in parallel.
+        self.send_pool = KeyedWorkerPool(max_workers=self.flag('send_workers'),
+                                         max_queue_size=self.flag('send_queue_size'),
+                                         name="EFMS outbound")
+        self.rate_limiter = TokenBucket(rate=self.flag('send_rate_limit'),
+                                        capacity=self.flag('send_burst'))
+        self.mark_as_read = KeyedDebouncer(self._mark_as_read, window=self.mark_read_window)
+
+    def send_message(self, msg: EFBMessage) -> EFBMessage:
+        """
+        Send a message from the master channel, and wait until it is sent.
+
+        The master channel needs the ID of the message sent on return, to
+        edit, recall or reply to it later, so the message is not sent in
+        background. The queue still keeps messages to the same thread in
+        order, and bounds the number of uploads when the master channel
+        sends from multiple threads.
+        """
         self.logger.debug("Received message from master: %s", msg)
-
+        self.queue_message(msg).result()
+        return msg
+
+    def queue_message(self, msg: EFBMessage) -> 'Future[Optional[str]]':
+        """
+        Queue a message to be sent after messages queued before to the
+        same thread.
+
+        Returns:
+            A future resolving to the ID of the message sent, which is also
+            set to ``msg.uid``.
+        """
+        return self.send_pool.submit(str(msg.chat.uid), self._send_with_retries, msg)
+
+    def stop(self):
+        self.send_pool.shutdown()
+
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        """If a request failed with an error worth retrying."""
+        if isinstance(error, FBchatFacebookError):
+            code = error.request_status_code
+            return code is not None and (code == 429 or code >= 500)
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        # Only retry when the connection failed before the request is written.
+        # Connections dropped afterwards are not retried, as the message might have been sent.
+        if isinstance(error, requests.ConnectionError) and error.args:
+            reason = getattr(error.args[0], 'reason', None)
+            return isinstance(reason, NewConnectionError)
+        return False
+
+    def _send_with_retries(self, msg: EFBMessage) -> Optional[str]:
         try:
-            target_msg_offset = 0
-            prefix = ""
-
-            mentions = []
-
-            # Send message reaction
-            # if msg.target and msg.text.startswith('r`') and \
-            #         msg.target.uid.startswith("mid.$"):
-            #     self.logger.debug("[%s] Message is a reaction to another message: %s", msg.uid, msg.text)
-            #     msg_id = ".".join(msg.target.uid.split(".", 2)[:2])
-            #     if getattr(MessageReaction, msg.text[2:], None):
-            #         self.client.reactToMessage(msg_id, getattr(MessageReaction, msg.text[2:]))
-            #     else:
-            #         self.client.reactToMessage(msg_id, self.CustomReaction(msg.text[2:]))
-            #     msg.uid = "__reaction__"
-            #     return msg
-
-            # Message substitutions
-            if msg.substitutions:
-                self.logger.debug("[%s] Message has substitutions: %s", msg.uid, msg.substitutions)
-                for i in msg.substitutions:
-                    mentions.append(Mention(msg.substitutions[i].id,
-                                            target_msg_offset + i[0], i[1] - i[0]))
-                self.logger.debug("[%s] Translated to mentions: %s", msg.uid, mentions)
-
-            fb_msg = Message(text=prefix + msg.text, mentions=mentions)
-            thread: Thread = self.client.fetchThreadInfo(msg.chat.uid)[str(msg.chat.uid)]
-
-            if msg.target and msg.target.uid:
-                fb_msg.reply_to_id = msg.target.uid
-
-            if msg.type in (MsgType.Text, MsgType.Unsupported):
-                # Remove variation selector-16 (force colored emoji) for
-                # matching.
-                emoji_compare = msg.text.replace("\uFE0F", "")
-                if emoji_compare == "👍":
-                    fb_msg.sticker = Sticker(uid=EmojiSize.SMALL.value)
-                    if not prefix:
-                        fb_msg.text = None
-                elif emoji_compare[:-1] == "👍" and emoji_compare[-1] in 'SML':
-                    if emoji_compare[-1] == 'S':
-                        fb_msg.sticker = Sticker(uid=EmojiSize.SMALL.value)
-                    elif emoji_compare[-1] == 'M':
-                        fb_msg.sticker = Sticker(uid=EmojiSize.MEDIUM.value)
-                    elif emoji_compare[-1] == 'L':
-                        fb_msg.sticker = Sticker(uid=EmojiSize.LARGE.value)
-                    if not prefix:
-                        fb_msg.text = None
-                elif emoji_compare[:-1] in emoji.UNICODE_EMOJI and emoji_compare[-1] in 'SML':  # type: ignore
-                    self.logger.debug("[%s] Message is an Emoji message: %s", msg.uid, emoji_compare)
-                    if emoji_compare[-1] == 'S':
-                        fb_msg.emoji_size = EmojiSize.SMALL
-                    elif emoji_compare[-1] == 'M':
-                        fb_msg.emoji_size = EmojiSize.MEDIUM
-                    elif emoji_compare[-1] == 'L':
-                        fb_msg.emoji_size = EmojiSize.LARGE
-                    fb_msg.text = emoji_compare[:-1]
-                msg.uid = self.client.send(fb_msg, thread_id=thread.uid, thread_type=thread.type)
-            elif msg.type in (MsgType.Image, MsgType.Sticker, MsgType.Animation):
-                msg_uid = self.client.send_image_file(msg.filename, msg.file, msg.mime, message=fb_msg,
-                                                      thread_id=thread.uid, thread_type=thread.type)
-                if msg_uid.startswith('mid.$'):
-                    self.client.sent_messages.add(msg_uid)
-                    self.logger.debug("Sent message with ID %s", msg_uid)
-                msg.uid = msg_uid
-            elif msg.type == MsgType.Voice:
-                files = self.upload_file(msg, voice_clip=True)
-                msg_uid = self.client._sendFiles(files=files, message=fb_msg,
-                                                 thread_id=thread.uid, thread_type=thread.type)
-                if msg_uid.startswith('mid.$'):
-                    self.client.sent_messages.add(msg_uid)
-                    self.logger.debug("Sent message with ID %s", msg_uid)
-                msg.uid = msg_uid
-            elif msg.type in (MsgType.File, MsgType.Video):
-                files = self.upload_file(msg)
-                msg_uid = self.client._sendFiles(files=files, message=fb_msg,
-                                                 thread_id=thread.uid, thread_type=thread.type)
-                if msg_uid.startswith('mid.$'):
-                    self.client.sent_messages.add(msg_uid)
-                    self.logger.debug("Sent message with ID %s", msg_uid)
-                msg.uid = msg_uid
-            elif msg.type == MsgType.Status:
-                assert (isinstance(msg.attributes, StatusAttribute))
-                status: StatusAttribute = msg.attributes
-                if status.status_type in (StatusAttribute.Types.TYPING,
-                                          StatusAttribute.Types.UPLOADING_VOICE,
-                                          StatusAttribute.Types.UPLOADING_VIDEO,
-                                          StatusAttribute.Types.UPLOADING_IMAGE,
-                                          StatusAttribute.Types.UPLOADING_FILE):
-                    self.client.setTypingStatus(TypingStatus.TYPING, thread_id=thread.uid, thread_type=thread.type)
-                    threading.Timer(status.timeout / 1000, self.stop_typing, args=(thread.uid, thread.type)).start()
-            elif msg.type == MsgType.Link:
-                assert (isinstance(msg.attributes, LinkAttribute))
-                link: LinkAttribute = msg.attributes
-                if self.flag('send_link_with_description'):
-                    info: Tuple[str, ...] = (link.title,)
-                    if link.description:
-                        info += (link.description,)
-                    info += (link.url,)
-                    text = "\n".join(info)
-                else:
-                    text = link.url
-                if fb_msg.text:
-                    text = fb_msg.text + "\n" + text
-                fb_msg.text = text
-                msg.uid = self.client.send(fb_msg, thread_id=thread.uid, thread_type=thread.type)
-            elif msg.type == MsgType.Location:
-                assert (isinstance(msg.attributes, LocationAttribute))
-                location_attr: LocationAttribute = msg.attributes
-                location = LocationAttachment(latitude=location_attr.latitude,
-                                              longitude=location_attr.longitude)
-                self.client.sendPinnedLocation(location, fb_msg, thread_id=thread.uid, thread_type=thread.type)
-            else:
-                raise EFBMessageTypeNotSupported()
-            return msg
+            # Typing statuses are not limited, so that they do not delay messages.
+            # Retries reuse the token of the first attempt, as they are delayed by backoff.
+            if msg.type != MsgType.Status:
+                waited = self.rate_limiter.acquire()
+                if waited:
+                    self.logger.debug("[%s] Waited for %.3f s by rate limit.", msg.uid, waited)
+            for attempt in itertools.count():
+                try:
+                    return self._send(msg)
+                except (FBchatException, requests.RequestException) as e:
+                    if attempt >= self.flag('send_max_retries') or not self.is_transient_error(e):
+                        raise
+                    delay = self.flag('send_retry_delay') * 2 ** attempt
+                    self.logger.warning("[%s] Failed to send message, retrying in %.1f s: %r",
+                                        msg.uid, delay, e)
+                    time.sleep(delay)
+                    if msg.file and msg.file.seekable():
+                        msg.file.seek(0)
         finally:
             if msg.file and not msg.file.closed:
                 msg.file.close()
-            self.client.markAsSeen()
-            self.client.markAsRead(msg.chat.uid)
+            self.mark_as_read(str(msg.chat.uid), str(msg.chat.uid))
+
+    def _mark_as_read(self, thread_id: str):
+        self.client.markAsSeen()
+        self.client.markAsRead(thread_id)
+
+    def _send(self, msg: EFBMessage) -> Optional[str]:
+        """Send a message to Messenger, and return the ID of the message sent."""
+        target_msg_offset = 0
+        prefix = ""
+
+        mentions = []
+
+        # Send message reaction
+        # if msg.target and msg.text.startswith('r`') and \
+        #         msg.target.uid.startswith("mid.$"):
+        #     self.logger.debug("[%s] Message is a reaction to another message: %s", msg.uid, msg.text)
+        #     msg_id = ".".join(msg.target.uid.split(".", 2)[:2])
+        #     if getattr(MessageReaction, msg.text[2:], None):
+        #         self.client.reactToMessage(msg_id, getattr(MessageReaction, msg.text[2:]))
+        #     else:
+        #         self.client.reactToMessage(msg_id, self.CustomReaction(msg.text[2:]))
+        #     msg.uid = "__reaction__"
+        #     return msg
+
+        # Message substitutions
+        if msg.substitutions:
+            self.logger.debug("[%s] Message has substitutions: %s", msg.uid, msg.substitutions)
+            for i in msg.substitutions:
+                mentions.append(Mention(msg.substitutions[i].id,
+                                        target_msg_offset + i[0], i[1] - i[0]))
+            self.logger.debug("[%s] Translated to mentions: %s", msg.uid, mentions)
+
+        fb_msg = Message(text=prefix + msg.text, mentions=mentions)
+        thread_id = str(msg.chat.uid)
+        thread_type = self.chat_manager.get_thread_type(thread_id)
+
+        if msg.target and msg.target.uid:
+            fb_msg.reply_to_id, _ = self.client.message_store.resolve(msg.target.uid)
+
+        if msg.type in (MsgType.Text, MsgType.Unsupported):
+            # Remove variation selector-16 (force colored emoji) for
+            # matching.
+            emoji_compare = msg.text.replace("\uFE0F", "")
+            if emoji_compare == "👍":
+                fb_msg.sticker = Sticker(uid=EmojiSize.SMALL.value)
+                if not prefix:
+                    fb_msg.text = None
+            elif emoji_compare[:-1] == "👍" and emoji_compare[-1] in 'SML':
+                if emoji_compare[-1] == 'S':
+                    fb_msg.sticker = Sticker(uid=EmojiSize.SMALL.value)
+                elif emoji_compare[-1] == 'M':
+                    fb_msg.sticker = Sticker(uid=EmojiSize.MEDIUM.value)
+                elif emoji_compare[-1] == 'L':
+                    fb_msg.sticker = Sticker(uid=EmojiSize.LARGE.value)
+                if not prefix:
+                    fb_msg.text = None
+            elif emoji_compare[:-1] in emoji.UNICODE_EMOJI and emoji_compare[-1] in 'SML':  # type: ignore
+                self.logger.debug("[%s] Message is an Emoji message: %s", msg.uid, emoji_compare)
+                if emoji_compare[-1] == 'S':
+                    fb_msg.emoji_size = EmojiSize.SMALL
+                elif emoji_compare[-1] == 'M':
+                    fb_msg.emoji_size = EmojiSize.MEDIUM
+                elif emoji_compare[-1] == 'L':
+                    fb_msg.emoji_size = EmojiSize.LARGE
+                fb_msg.text = emoji_compare[:-1]
+            msg.uid = self.client.send(fb_msg, thread_id=thread_id, thread_type=thread_type)
+        elif msg.type in (MsgType.Image, MsgType.Sticker, MsgType.Animation):
+            msg_uid = self.client.send_image_file(msg.filename, msg.file, msg.mime, message=fb_msg,
+                                                  thread_id=thread_id, thread_type=thread_type)
+            msg.uid = msg_uid
+        elif msg.type == MsgType.Voice:
+            files = self.upload_file(msg, voice_clip=True)
+            msg_uid = self.client._sendFiles(files=files, message=fb_msg,
+                                             thread_id=thread_id, thread_type=thread_type)
+            msg.uid = msg_uid
+        elif msg.type in (MsgType.File, MsgType.Video):
+            files = self.upload_file(msg)
+            msg_uid = self.client._sendFiles(files=files, message=fb_msg,
+                                             thread_id=thread_id, thread_type=thread_type)
+            msg.uid = msg_uid
+        elif msg.type == MsgType.Status:
+            assert (isinstance(msg.attributes, StatusAttribute))
+            status: StatusAttribute = msg.attributes
+            if status.status_type in (StatusAttribute.Types.TYPING,
+                                      StatusAttribute.Types.UPLOADING_VOICE,
+                                      StatusAttribute.Types.UPLOADING_VIDEO,
+                                      StatusAttribute.Types.UPLOADING_IMAGE,
+                                      StatusAttribute.Types.UPLOADING_FILE):
+                self.client.setTypingStatus(TypingStatus.TYPING, thread_id=thread_id, thread_type=thread_type)
+                threading.Timer(status.timeout / 1000, self.stop_typing, args=(thread_id, thread_type)).start()
+        elif msg.type == MsgType.Link:
+            assert (isinstance(msg.attributes, LinkAttribute))
+            link: LinkAttribute = msg.attributes
+            if self.flag('send_link_with_description'):
+                info: Tuple[str, ...] = (link.title,)
+                if link.description:
+                    info += (link.description,)
+                info += (link.url,)
+                text = "\n".join(info)
+            else:
+                text = link.url
+            if fb_msg.text:
+                text = fb_msg.text + "\n" + text
+            fb_msg.text = text
+            msg.uid = self.client.send(fb_msg, thread_id=thread_id, thread_type=thread_type)
+        elif msg.type == MsgType.Location:
+            assert (isinstance(msg.attributes, LocationAttribute))
+            location_attr: LocationAttribute = msg.attributes
+            location = LocationAttachment(latitude=location_attr.latitude,
+                                          longitude=location_attr.longitude)
+            msg.uid = self.client.sendPinnedLocation(location, fb_msg,
+                                                     thread_id=thread_id, thread_type=thread_type)
+        else:
+            raise EFBMessageTypeNotSupported()
+        return msg.uid
 
     def stop_typing(self, timeout: int, thread_uid: str, thread_type: ThreadType):
         """Wait for a number of milliseconds, and stop typing."""
@@ -0,0 +1,516 @@
+# coding=utf-8
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import suppress
+from pathlib import Path
+from tempfile import NamedTemporaryFile, mkstemp
+from typing import IO, TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Mapping, NamedTuple, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ehforwarderbot.exceptions import EFBException
+from .cache import LRUCache
+
+if TYPE_CHECKING:
+    from .async_engine import AsyncEngine
+
+
+class MediaTooLargeError(EFBException):
+    """Raised when a file to download exceeds the size limit."""
+
+    def __init__(self, url: str, size: int):
+        super().__init__(url, size)
+        self.url = url
+        self.size = size
+
+
+class DownloadedFile(NamedTuple):
+    file: IO[bytes]
+    """Temporary file with the content downloaded, seeked to the beginning."""
+    mime: Optional[str]
+    """MIME type reported by the server."""
+    size: int
+    """Size of the file in bytes."""
+
+
+class LazyFile:
+    """
+    A read-only file-like proxy of a file being downloaded in background.
+
+    Operations on the file wait until the download is finished, and raise
+    the exception of the download if it failed.
+    """
+
+    def __init__(self, future: 'Future[DownloadedFile]', timeout: Optional[float] = None):
+        """
+        Args:
+            future: Future of the download
+            timeout: Max seconds to wait for the download, ``None`` to wait forever
+        """
+        self.future = future
+        self.timeout = timeout
+        self.closed = False
+
+    @property
+    def file(self) -> IO[bytes]:
+        """The downloaded file, waiting for the download to finish."""
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        return self.future.result(self.timeout).file
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def readable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.future.add_done_callback(self._close_download)
+
+    @staticmethod
+    def _close_download(future: 'Future[DownloadedFile]'):
+        if not future.cancelled() and future.exception() is None:
+            future.result().file.close()
+
+    def __getattr__(self, item):
+        return getattr(self.file, item)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        state = "closed" if self.closed else "done" if self.future.done() else "downloading"
+        return f"<LazyFile: {state}>"
+
+
+class FetchResult(NamedTuple):
+    status: int
+    """HTTP status code of the response."""
+    headers: Mapping[str, str]
+    """Headers of the response, case-insensitive."""
+    download: Optional[DownloadedFile]
+    """Content of the response, ``None`` if not modified."""
+
+
+class MediaCache:
+    """
+    A size-bounded cache of downloaded files on the disk.
+
+    Files are stored by the hash of a key, like a sticker ID, an attachment
+    ID or a URL. When the total size exceeds the limit, least recently used
+    files are evicted. Files already in the directory are indexed on
+    startup, ordered by their modification time.
+    """
+
+    logger = logging.getLogger("MediaCache")
+
+    def __init__(self, path: Path, max_size: int):
+        """
+        Args:
+            path: Directory to store cached files
+            max_size: Maximum total size of files in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Name of files by key hash, and their sizes, from the least recently used.
+        self._entries: 'OrderedDict[str, Tuple[str, int]]' = OrderedDict()
+        self.total_size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        for i in self.path.iterdir():
+            if i.is_file() and not i.name.startswith('.'):
+                stat = i.stat()
+                files.append((stat.st_mtime, i.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name.split('.', 1)[0]] = (name, size)
+            self.total_size += size
+        self.logger.debug("Indexed %s cached files, %s bytes in total.", len(self._entries), self.total_size)
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _hash(key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key: str, suffix: str = '') -> Optional[DownloadedFile]:
+        """
+        Get a copy of a cached file in a temporary file.
+
+        Returns:
+            The file, or ``None`` if not in cache.
+        """
+        key_hash = self._hash(key)
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            name, size = entry
+            # Opened under the lock, so that the file is still readable when
+            # it is evicted or replaced during the copy below.
+            try:
+                cached = (self.path / name).open('rb')
+                os.utime(str(self.path / name))
+            except OSError:
+                self.logger.exception("Failed to open cached file %s for %s.", name, key)
+                self._discard(key_hash, entry)
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+        file = NamedTemporaryFile(suffix=suffix)
+        try:
+            with cached:
+                shutil.copyfileobj(cached, file)
+        except OSError:
+            self.logger.exception("Failed to read cached file %s for %s.", name, key)
+            file.close()
+            with self._lock:
+                self._discard(key_hash, entry)
+            return None
+        file.seek(0)
+        return DownloadedFile(file=file, mime=mimetypes.guess_type(name)[0], size=size)
+
+    def _discard(self, key_hash: str, entry: Tuple[str, int]):
+        """Remove an entry from the index, unless it is replaced since then."""
+        if self._entries.get(key_hash) == entry:
+            del self._entries[key_hash]
+            self.total_size -= entry[1]
+
+    def put(self, key: str, download: DownloadedFile):
+        """Save a copy of a downloaded file to the cache."""
+        if download.size > self.max_size:
+            return
+        key_hash = self._hash(key)
+        ext = mimetypes.guess_extension(download.mime.split(';')[0].strip()) if download.mime else None
+        name = key_hash + (ext or '')
+        try:
+            fd, temp_path = mkstemp(dir=str(self.path), prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(download.file, f)
+        except OSError:
+            self.logger.exception("Failed to save %s to media cache.", key)
+            return
+        finally:
+            download.file.seek(0)
+        with self._lock:
+            old = self._entries.pop(key_hash, None)
+            if old is not None:
+                self.total_size -= old[1]
+                if old[0] != name:
+                    with suppress(FileNotFoundError):
+                        (self.path / old[0]).unlink()
+            os.replace(temp_path, str(self.path / name))
+            self._entries[key_hash] = (name, download.size)
+            self.total_size += download.size
+            self._evict()
+
+    def _evict(self):
+        while self.total_size > self.max_size and self._entries:
+            _, (name, size) = self._entries.popitem(last=False)
+            self.total_size -= size
+            with suppress(FileNotFoundError):
+                (self.path / name).unlink()
+            self.logger.debug("Evicted %s from media cache.", name)
+
+
+class MediaDownloader:
+    """
+    Download files into temporary files through a shared HTTP session.
+
+    Content is streamed to the disk in chunks, and connections to the same
+    host are kept alive and reused across downloads. When :attr:`engine` is
+    set, :meth:`download_async` runs transfers on its event loop, so that
+    no thread is held while waiting for the server.
+    """
+
+    logger = logging.getLogger("MediaDownloader")
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, max_size: int = 0, timeout: float = 30, pool_size: int = 10,
+                 cache: Optional[MediaCache] = None, engine: Optional['AsyncEngine'] = None):
+        """
+        Args:
+            max_size: Maximum size of a file in bytes, 0 for unlimited
+            timeout: Seconds to wait for the server to connect or send data
+            pool_size: Maximum number of connections kept alive per host
+            cache: Cache for files downloaded with a cache key
+            engine: Async engine to run downloads in, if supported
+        """
+        self.max_size = max_size
+        self.cache = cache
+        self.engine = engine if engine is not None and engine.native_http else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        """Close connections kept alive."""
+        self.session.close()
+
+    def download(self, url: Union[str, Callable[[], str]], suffix: str = '',
+                 cache_key: Optional[str] = None) -> DownloadedFile:
+        """
+        Download a file into a temporary file.
+
+        Args:
+            url: URL of the file, or a function resolving the URL that
+                is only called when the file is not in cache
+            suffix: Suffix of the temporary file name
+            cache_key: Key to look up and save the file in cache
+
+        Raises:
+            MediaTooLargeError: If the file is larger than the size limit
+            requests.RequestException: If the request failed
+        """
+        if self.cache is not None and cache_key:
+            cached = self.cache.get(cache_key, suffix)
+            if cached is not None:
+                self.logger.debug("Found %s in cache.", cache_key)
+                return cached
+        if callable(url):
+            url = url()
+        download = self._download(url, suffix)
+        if self.cache is not None and cache_key:
+            self.cache.put(cache_key, download)
+        return download
+
+    def _download(self, url: str, suffix: str) -> DownloadedFile:
+        download = self.fetch(url, suffix).download
+        assert download is not None
+        return download
+
+    def download_async(self, url: Union[str, Callable[[], str]], suffix: str = '',
+                       cache_key: Optional[str] = None) -> 'Future[DownloadedFile]':
+        """
+        Download a file into a temporary file in the async engine.
+
+        The file is transferred on the event loop of the engine. Looking up
+        the cache, resolving the URL and saving to the cache are run in the
+        executor of the engine.
+
+        Arguments are the same as :meth:`download`.
+
+        Returns:
+            A future of the file downloaded, raising the same errors as
+            :meth:`download`, or :exc:`aiohttp.ClientError` if the request failed.
+        """
+        engine = self.engine
+        if engine is None:
+            raise RuntimeError("Async engine with aiohttp is required to download files asynchronously.")
+        result: 'Future[DownloadedFile]' = Future()
+
+        def forward_error(future: Future):
+            if future.exception() is not None and not result.done():
+                result.set_exception(future.exception())
+
+        def start():
+            if self.cache is not None and cache_key:
+                cached = self.cache.get(cache_key, suffix)
+                if cached is not None:
+                    self.logger.debug("Found %s in cache.", cache_key)
+                    result.set_result(cached)
+                    return
+            fetch = engine.fetch(url() if callable(url) else url, suffix=suffix, max_size=self.max_size,
+                                 timeout=self.timeout, chunk_size=self.chunk_size)
+            fetch.add_done_callback(lambda f: engine.run_blocking(finish, f).add_done_callback(forward_error))
+
+        def finish(fetch: Future):
+            download = fetch.result().download
+            assert download is not None
+            if self.cache is not None and cache_key:
+                self.cache.put(cache_key, download)
+            result.set_result(download)
+
+        engine.run_blocking(start).add_done_callback(forward_error)
+        return result
+
+    def fetch(self, url: str, suffix: str = '', headers: Optional[Mapping[str, str]] = None) -> FetchResult:
+        """
+        Send a GET request, and download the response into a temporary file.
+
+        Args:
+            url: URL of the file
+            suffix: Suffix of the temporary file name
+            headers: Additional request headers
+
+        Returns:
+            The response, without content if it is not modified (304).
+
+        Raises:
+            MediaTooLargeError: If the file is larger than the size limit
+            requests.RequestException: If the request failed
+        """
+        self.logger.debug("Downloading %s", url)
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout,
+                              allow_redirects=True) as response:
+            if response.status_code == 304:
+                return FetchResult(status=response.status_code, headers=response.headers, download=None)
+            response.raise_for_status()
+            length = response.headers.get('content-length')
+            if self.max_size and length and length.isdecimal() and int(length) > self.max_size:
+                raise MediaTooLargeError(url, int(length))
+            file = NamedTemporaryFile(suffix=suffix)
+            size = 0
+            try:
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if self.max_size and size > self.max_size:
+                        raise MediaTooLargeError(url, size)
+                    file.write(chunk)
+            except BaseException:
+                file.close()
+                raise
+            file.seek(0)
+            self.logger.debug("Downloaded %s bytes from %s", size, url)
+            download = DownloadedFile(file=file, mime=response.headers.get('content-type'), size=size)
+            return FetchResult(status=response.status_code, headers=response.headers, download=download)
+
+
+class AvatarCache:
+    """
+    Cache of chat pictures on the disk, revalidated with the server.
+
+    Pictures are returned without a request while the URL is unchanged and
+    the picture was checked within ``max_age`` seconds. Older pictures are
+    revalidated with ``ETag`` and ``Last-Modified`` headers. Chats without
+    a picture are remembered for ``negative_ttl`` seconds.
+    """
+
+    logger = logging.getLogger("AvatarCache")
+
+    def __init__(self, path: Path, downloader: MediaDownloader,
+                 max_age: float = 86400, negative_ttl: float = 3600):
+        """
+        Args:
+            path: Directory to store pictures
+            downloader: Downloader to use the HTTP session of
+            max_age: Seconds before a picture is revalidated
+            negative_ttl: Seconds to remember a chat has no picture
+        """
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.downloader = downloader
+        self.max_age = max_age
+        self.missing: LRUCache[str, bool] = LRUCache(max_size=10000, ttl=negative_ttl)
+
+    def _paths(self, uid: str) -> Tuple[Path, Path]:
+        name = hashlib.sha1(uid.encode()).hexdigest()
+        return self.path / name, self.path / (name + ".json")
+
+    def _load_meta(self, uid: str) -> Dict[str, Any]:
+        picture_path, meta_path = self._paths(uid)
+        if not picture_path.exists():
+            return {}
+        try:
+            with meta_path.open() as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_meta(self, meta_path: Path, meta: Dict[str, Any]):
+        # Replaced as a whole, so that readers never see a partially written file.
+        fd, temp_path = mkstemp(dir=str(self.path), prefix='.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            os.replace(temp_path, str(meta_path))
+        except Exception:
+            with suppress(OSError):
+                os.unlink(temp_path)
+            raise
+
+    def mark_missing(self, uid: str):
+        """Remember that a chat has no picture."""
+        self.missing[uid] = True
+
+    def is_missing(self, uid: str) -> bool:
+        """Check if a chat is recently known to have no picture."""
+        return uid in self.missing
+
+    def get_cached(self, uid: str, url: str) -> Optional[BinaryIO]:
+        """Get the picture of a chat from the cache if it is still fresh."""
+        meta = self._load_meta(uid)
+        if meta.get("url") == url and time.time() - meta.get("checked_at", 0) < self.max_age:
+            self.logger.debug("[%s] Picture found in cache.", uid)
+            return self._paths(uid)[0].open('rb')
+        return None
+
+    def get(self, uid: str, url: str) -> BinaryIO:
+        """
+        Get the picture of a chat, from the cache if it is still fresh,
+        or from the server otherwise.
+
+        Raises:
+            requests.RequestException: If the request failed
+        """
+        cached = self.get_cached(uid, url)
+        if cached is not None:
+            return cached
+
+        picture_path, meta_path = self._paths(uid)
+        meta = self._load_meta(uid)
+        headers = {}
+        if meta.get("url") == url:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        result = self.downloader.fetch(url, headers=headers)
+        if result.download is None:
+            self.logger.debug("[%s] Picture in cache is not modified.", uid)
+        else:
+            with result.download.file:
+                fd, temp_path = mkstemp(dir=str(self.path), prefix='.')
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(result.download.file, f)
+            os.replace(temp_path, str(picture_path))
+            meta = {
+                "url": url,
+                "etag": result.headers.get("ETag"),
+                "last_modified": result.headers.get("Last-Modified"),
+            }
+            self.logger.debug("[%s] Picture downloaded: %s", uid, meta)
+        meta["checked_at"] = time.time()
+        self._save_meta(meta_path, meta)
+        self.missing.invalidate(uid)
+        return picture_path.open('rb')
@@ -0,0 +1,127 @@
+# coding=utf-8
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class StoredMessage(NamedTuple):
+    mid: str
+    """ID of the message on Messenger."""
+    thread_id: str
+    """ID of the thread of the message."""
+    parts: int
+    """Number of EFB messages the message is split into."""
+
+
+class MessageStore:
+    """
+    A persistent store of messages split into multiple EFB messages, in
+    an SQLite database.
+
+    EFB messages split from a Messenger message have IDs of the Messenger
+    message followed by ``.N``, where ``N`` is the index of the part.
+    Records are removed ``retention`` seconds after they are saved.
+    """
+
+    logger = logging.getLogger("MessageStore")
+
+    prune_interval = 3600
+    """Seconds between removals of expired records."""
+
+    def __init__(self, path: Path, retention: float = 30 * 86400):
+        """
+        Args:
+            path: Path of the database file
+            retention: Seconds to keep a record, 0 to keep forever
+        """
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                         "mid TEXT PRIMARY KEY, thread_id TEXT NOT NULL, parts INTEGER NOT NULL, "
+                         "saved_at REAL NOT NULL) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_saved_at ON messages (saved_at)")
+        self._pruned_at = 0.0
+        self._closed = False
+        self.prune()
+
+    def save(self, mid: str, thread_id: str, parts: int):
+        """Save the record of a message, replacing the existing one."""
+        with self._lock:
+            if self._closed:
+                return
+            self._db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                             (mid, str(thread_id), parts, time.time()))
+        if time.monotonic() - self._pruned_at > self.prune_interval:
+            self.prune()
+
+    def get(self, mid: str) -> Optional[StoredMessage]:
+        """Get the record of a message by its ID on Messenger."""
+        with self._lock:
+            if self._closed:
+                return None
+            row = self._db.execute("SELECT mid, thread_id, parts FROM messages WHERE mid = ?",
+                                   (mid,)).fetchone()
+        if row is None:
+            return None
+        return StoredMessage(mid=row[0], thread_id=row[1], parts=row[2])
+
+    def part_ids(self, mid: str) -> List[str]:
+        """IDs of EFB messages of a Messenger message."""
+        record = self.get(mid)
+        if record is None or record.parts <= 1:
+            return [mid]
+        return [f"{mid}.{i}" for i in range(record.parts)]
+
+    def resolve(self, uid: str) -> Tuple[str, Optional[int]]:
+        """
+        Find the Messenger message of an EFB message ID.
+
+        Messages not in the store are assumed to be split if their IDs end
+        with ``.N``.
+
+        Returns:
+            ID of the Messenger message, and the index of the part if split.
+        """
+        if self.get(uid) is not None:
+            return uid, None
+        mid, sep, index = uid.rpartition('.')
+        if not sep or not mid or not index.isdecimal():
+            return uid, None
+        record = self.get(mid)
+        if record is not None and int(index) >= record.parts:
+            return uid, None
+        return mid, int(index)
+
+    def prune(self):
+        """Remove expired records."""
+        self._pruned_at = time.monotonic()
+        if not self.retention:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            count = self._db.execute("DELETE FROM messages WHERE saved_at < ?",
+                                     (time.time() - self.retention,)).rowcount
+        if count:
+            self.logger.debug("Removed %s expired message records.", count)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def close(self):
+        """
+        Close the database. Messages still being processed after that are
+        not recorded.
+        """
+        with self._lock:
+            self._closed = True
+            self._db.close()
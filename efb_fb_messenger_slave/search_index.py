@@ -0,0 +1,146 @@
+# coding=utf-8
+
+import re
+import threading
+import unicodedata
+from typing import Collection, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+CJK_CHARACTERS = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+"""Kana, CJK ideographs and Hangul syllables, indexed character by character."""
+
+TOKEN_PATTERN = re.compile(f'[{CJK_CHARACTERS}]|[^\\W{CJK_CHARACTERS}]+')
+
+
+class SearchEntry(NamedTuple):
+    uid: str
+    """ID of the chat."""
+    name: str
+    """Name of the chat."""
+    alias: Optional[str]
+    """Alias or nickname of the chat."""
+    chat_type: Optional[str]
+    """Type of the thread, as in the ``chat_type`` vendor-specific option."""
+    keywords: Tuple[str, ...] = ()
+    """Other names to find the chat by, like names and nicknames of members of a group."""
+
+
+class ChatSearchIndex:
+    """
+    An in-memory index to search chats by their names, aliases and keywords.
+
+    Words are indexed by their prefixes of up to 2 characters and by their
+    trigrams, and CJK characters are indexed individually as they are not
+    separated by spaces. Candidates from the index are then checked for
+    every word of the query as a substring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, SearchEntry] = dict()
+        # Normalized text of entries
+        self._texts: Dict[str, str] = dict()
+        # IDs of entries by index key
+        self._keys: Dict[str, Set[str]] = dict()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return unicodedata.normalize('NFKC', text).casefold()
+
+    @staticmethod
+    def _token_keys(token: str) -> Iterator[str]:
+        if len(token) == 1 and re.match(f'[{CJK_CHARACTERS}]', token):
+            yield token
+            return
+        yield '^' + token[:1]
+        if len(token) > 1:
+            yield '^' + token[:2]
+        for i in range(len(token) - 2):
+            yield token[i:i + 3]
+
+    @classmethod
+    def _keys_of(cls, text: str) -> Set[str]:
+        return {key for token in TOKEN_PATTERN.findall(text) for key in cls._token_keys(token)}
+
+    @staticmethod
+    def _query_keys(token: str) -> List[str]:
+        if len(token) < 3:
+            return [token if re.match(f'[{CJK_CHARACTERS}]', token) else '^' + token]
+        return [token[i:i + 3] for i in range(len(token) - 2)]
+
+    def add(self, entry: SearchEntry):
+        """Add or update an entry."""
+        text = self.normalize(' '.join(filter(None, (entry.name, entry.alias) + entry.keywords)))
+        with self._lock:
+            if self._texts.get(entry.uid) != text:
+                self._remove(entry.uid)
+                self._texts[entry.uid] = text
+                for key in self._keys_of(text):
+                    self._keys.setdefault(key, set()).add(entry.uid)
+            self._entries[entry.uid] = entry
+
+    def remove(self, uid: str):
+        """Remove an entry if exists."""
+        with self._lock:
+            self._remove(uid)
+
+    def _remove(self, uid: str):
+        text = self._texts.pop(uid, None)
+        self._entries.pop(uid, None)
+        if text is None:
+            return
+        for key in self._keys_of(text):
+            ids = self._keys.get(key)
+            if ids is not None:
+                ids.discard(uid)
+                if not ids:
+                    del self._keys[key]
+
+    def search(self, query: str, limit: int = 10,
+               chat_types: Optional[Collection[str]] = None) -> List[SearchEntry]:
+        """
+        Search entries with all words of the query in their names, aliases
+        or keywords.
+
+        Results are sorted by exact matches first, followed by entries
+        starting with the query, and then shorter names.
+
+        Args:
+            query: Words to search for
+            limit: Maximum number of results
+            chat_types: Types of chats to include, all types if ``None``
+        """
+        query = self.normalize(query).strip()
+        tokens = TOKEN_PATTERN.findall(query)
+        if not tokens:
+            return []
+        # Look up the rarest keys first to keep intersections small.
+        with self._lock:
+            key_sets = [self._keys.get(key, set()) for token in tokens for key in self._query_keys(token)]
+            key_sets.sort(key=len)
+            candidates = set(key_sets[0])
+            for ids in key_sets[1:]:
+                if not candidates:
+                    break
+                candidates &= ids
+            segments = query.split()
+            results = [(self._texts[uid], self._entries[uid]) for uid in candidates
+                       if all(i in self._texts[uid] for i in segments)]
+        if chat_types is not None:
+            results = [i for i in results if i[1].chat_type in chat_types]
+
+        def rank(item):
+            text, entry = item
+            names = [self.normalize(i) for i in (entry.name, entry.alias) if i]
+            if query in names:
+                order = 0
+            elif text.startswith(query) or any(i.startswith(query) for i in names):
+                order = 1
+            else:
+                order = 2
+            return order, len(entry.name or ''), entry.uid
+
+        results.sort(key=rank)
+        return [entry for _, entry in results[:limit]]
+
+    def __len__(self):
+        return len(self._entries)
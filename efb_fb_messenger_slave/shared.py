@@ -0,0 +1,86 @@
+# coding=utf-8
+
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Set, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class SharedResources:
+    """
+    A registry of resources shared by channel instances in the same process.
+
+    A resource is created by the first instance acquiring it by name, and
+    reused by all instances acquiring it later. When the last instance
+    using it releases, the resource is closed and removed.
+    """
+
+    logger = logging.getLogger("SharedResources")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Resources and their closing functions by name
+        self._resources: Dict[str, Tuple[Any, Optional[Callable[[Any], None]]]] = dict()
+        # Owners of resources by name
+        self._owners: Dict[str, Set[str]] = dict()
+
+    def acquire(self, name: str, owner: str, factory: Callable[[], T],
+                close: Optional[Callable[[T], None]] = None) -> T:
+        """
+        Get a resource by name, creating it if not exists.
+
+        Args:
+            name: Name of the resource
+            owner: ID of the instance using the resource
+            factory: Function to create the resource
+            close: Function to close the resource when no longer used
+        """
+        with self._lock:
+            if name in self._resources:
+                self._owners[name].add(owner)
+                return self._resources[name][0]
+        # Create outside of the lock, as creating may take a while.
+        self.logger.debug("Creating shared resource %s for %s.", name, owner)
+        resource = factory()
+        with self._lock:
+            duplicate = name in self._resources
+            if not duplicate:
+                self._resources[name] = (resource, close)
+                self._owners[name] = set()
+            self._owners[name].add(owner)
+            shared = self._resources[name][0]
+        if duplicate:
+            self.logger.debug("Shared resource %s is created by another instance, closing the one of %s.",
+                              name, owner)
+            self._close(name, resource, close)
+        return shared
+
+    def release(self, owner: str):
+        """Release all resources used by an instance, closing those no longer used."""
+        to_close = []
+        with self._lock:
+            for name in list(self._owners):
+                self._owners[name].discard(owner)
+                if not self._owners[name]:
+                    del self._owners[name]
+                    to_close.append((name, self._resources.pop(name)))
+        for name, (resource, close) in to_close:
+            self.logger.debug("Closing shared resource %s released by %s.", name, owner)
+            self._close(name, resource, close)
+
+    def _close(self, name: str, resource: Any, close: Optional[Callable[[Any], None]]):
+        if close is not None:
+            try:
+                close(resource)
+            except Exception as e:
+                self.logger.exception("Error occurred while closing %s: %s", name, e)
+
+    def owners(self, name: str) -> Set[str]:
+        """IDs of instances using a resource."""
+        with self._lock:
+            return set(self._owners.get(name, ()))
+
+
+shared_resources = SharedResources()
+"""Resources shared by all instances of EFMS in this process."""
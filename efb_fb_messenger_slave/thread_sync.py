@@ -0,0 +1,231 @@
+# coding=utf-8
+
+import heapq
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+from queue import Full, Queue
+from tempfile import mkstemp
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional
+
+from fbchat import ThreadLocation
+from fbchat.models import Thread
+
+if TYPE_CHECKING:
+    from .efms_client import EFMSClient
+
+_END = object()
+"""Marks the end of threads of a location in a queue."""
+
+
+class ThreadListSync:
+    """
+    Synchronize the thread list of the account page by page.
+
+    Each location is paged concurrently from the latest thread with the
+    ``before`` timestamp cursor. The first sync pages through the entire list, and
+    later syncs stop at the newest timestamp seen by the previous sync
+    (the high-water mark), so that only threads updated since then are
+    fetched. IDs, locations and timestamps of all threads seen are kept in
+    an index persisted along with the high-water marks.
+
+    Threads moved to another location without a new message are not
+    noticed until they are updated again.
+    """
+
+    logger = logging.getLogger("ThreadListSync")
+
+    INDEX_VERSION = 1
+    """Version of the format of the index file, bumped on incompatible changes."""
+
+    page_size = 20
+    """Number of threads per request, at most 20 as capped by ``fbchat``."""
+
+    def __init__(self, client: 'EFMSClient', path: Path, max_threads: int = 0):
+        """
+        Args:
+            client: Client to fetch threads with
+            path: Path of the index file
+            max_threads: Maximum number of threads to fetch per location
+                in a sync, 0 for unlimited
+        """
+        self.client = client
+        self.path = path
+        self.max_threads = max_threads
+        self._lock = threading.Lock()
+        # High-water marks by location name
+        self.marks: Dict[str, int] = dict()
+        # Location, timestamp and type of threads by thread ID
+        self.threads: Dict[str, Dict[str, Any]] = dict()
+        self.load()
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+            if data.get("version") != self.INDEX_VERSION:
+                self.logger.info("Thread index is in version %s, expecting %s. Ignored.",
+                                 data.get("version"), self.INDEX_VERSION)
+                return
+            self.marks = data["marks"]
+            self.threads = data["threads"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            self.logger.exception("Failed to load thread index from %s.", self.path)
+            self.marks = dict()
+            self.threads = dict()
+
+    def save(self):
+        data = {
+            "version": self.INDEX_VERSION,
+            "marks": self.marks,
+            "threads": self.threads,
+        }
+        fd, temp_path = mkstemp(dir=str(self.path.parent), prefix='.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(temp_path, str(self.path))
+        except Exception:
+            with suppress(OSError):
+                os.unlink(temp_path)
+            raise
+
+    @staticmethod
+    def _timestamp(thread: Thread) -> Optional[int]:
+        ts = getattr(thread, 'last_message_timestamp', None)
+        return int(ts) if ts else None
+
+    def sync(self, locations: Iterable[ThreadLocation]) -> List[Thread]:
+        """
+        Fetch threads updated since the last sync in all locations.
+
+        Returns:
+            Threads fetched, from the latest updated.
+        """
+        return list(self.iter_sync(locations))
+
+    def iter_sync(self, locations: Iterable[ThreadLocation]) -> Iterator[Thread]:
+        """
+        Fetch threads updated since the last sync in all locations,
+        and yield them as pages arrive.
+
+        Locations are fetched concurrently, each in its own thread, and
+        their threads are merged from the latest updated. Locations fully
+        fetched are updated in the index, even if iteration stops early.
+        """
+        locations = list(locations)
+        stop = threading.Event()
+        queues: List['Queue[Any]'] = [Queue(maxsize=self.page_size * 2) for _ in locations]
+        streams = [self._stream(q) for q in queues]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(locations)),
+                                    thread_name_prefix="EFMS thread list sync") as pool:
+                for location, q in zip(locations, queues):
+                    pool.submit(self._sync_location, location, q, stop)
+                try:
+                    yield from heapq.merge(*streams, key=lambda t: -(self._timestamp(t) or 0))
+                finally:
+                    stop.set()
+        finally:
+            with self._lock:
+                self.save()
+
+    @staticmethod
+    def _stream(q: 'Queue[Any]') -> Iterator[Thread]:
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    @staticmethod
+    def _put(q: 'Queue[Any]', item: Any, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _sync_location(self, location: ThreadLocation, q: 'Queue[Any]', stop: threading.Event):
+        try:
+            threads = self._fetch_location(location, q, stop)
+        except Exception as e:
+            self.logger.exception("[%s] Error occurred while syncing thread list.", location.name)
+            self._put(q, e, stop)
+            return
+        if threads is None:
+            return
+        self._put(q, _END, stop)
+        mark = self.marks.get(location.name)
+        with self._lock:
+            for uid, thread in threads.items():
+                self.threads[uid] = {
+                    "location": location.name,
+                    "timestamp": self._timestamp(thread),
+                    "type": thread.type.name if thread.type else None,
+                }
+            timestamps = [ts for ts in map(self._timestamp, threads.values()) if ts is not None]
+            if timestamps:
+                self.marks[location.name] = max(timestamps + ([mark] if mark is not None else []))
+        self.logger.debug("[%s] Synced %s threads since %s.", location.name, len(threads), mark)
+
+    def _fetch_location(self, location: ThreadLocation, q: 'Queue[Any]',
+                        stop: threading.Event) -> Optional[Dict[str, Thread]]:
+        """
+        Fetch threads of a location into a queue, from the latest updated.
+
+        Returns:
+            Threads fetched, or ``None`` if stopped before finishing.
+        """
+        mark = self.marks.get(location.name)
+        threads: Dict[str, Thread] = dict()
+        before: Optional[int] = None
+        while True:
+            page = self.client.fetchThreadList(limit=self.page_size, thread_location=(location,),
+                                               before=before)
+            oldest: Optional[int] = None
+            for thread in page:
+                ts = self._timestamp(thread)
+                if mark is not None and ts is not None and ts <= mark:
+                    continue
+                if thread.uid in threads:
+                    continue
+                if self.max_threads and len(threads) >= self.max_threads:
+                    break
+                threads[thread.uid] = thread
+                if ts is not None:
+                    oldest = ts if oldest is None else min(oldest, ts)
+                if not self._put(q, thread, stop):
+                    return None
+            self.logger.debug("[%s] Fetched %s threads before %s, %s in total.",
+                              location.name, len(page), before, len(threads))
+            if len(page) < self.page_size or oldest is None or oldest == before:
+                break
+            if any(i.uid not in threads for i in page):
+                # Reached threads synced before, or the limit.
+                break
+            # The thread at the cursor is included again in the next page.
+            before = oldest
+        return threads
+
+    def thread_ids(self, locations: Optional[Iterable[ThreadLocation]] = None) -> List[str]:
+        """IDs of threads in the index, from the latest updated, optionally in some locations only."""
+        names = None if locations is None else {i.name for i in locations}
+        with self._lock:
+            items = [(uid, info) for uid, info in self.threads.items()
+                     if names is None or info["location"] in names]
+        items.sort(key=lambda i: i[1]["timestamp"] or 0, reverse=True)
+        return [uid for uid, _ in items]
+
+    def __len__(self):
+        return len(self.threads)
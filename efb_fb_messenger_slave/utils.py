@@ -1,9 +1,8 @@
 # coding=utf-8
 import collections
 import logging
-from collections import deque
 from logging import LogRecord
-from typing import TYPE_CHECKING, Dict, Any, Hashable, Union, Sequence
+from typing import TYPE_CHECKING, Dict, Any, Callable, Hashable, Union, Sequence
 
 if TYPE_CHECKING:
     from . import FBMessengerChannel
@@ -18,6 +17,30 @@ class ExperimentalFlagsManager:
         'send_link_with_description': False,  # Send link messages with descriptions
         'show_pending_threads': False,  # Show threads pending approval in the thread list
         'show_archived_threads': False,  # Show archived threads in the thread list
+        'inbound_worker_threads': 4,  # Number of threads processing messages from Messenger
+        'inbound_queue_size': 100,  # Max number of messages from Messenger waiting to be processed
+        'media_max_size': 0,  # Max size of attachments to download in MiB, 0 for unlimited
+        'media_download_timeout': 30,  # Seconds to wait for the server when downloading attachments
+        'attachment_download_workers': 4,  # Max number of attachments of a message to download in parallel
+        'chat_cache_size': 10000,  # Max number of chats to keep in memory, 0 for unlimited
+        'chat_cache_ttl': 86400,  # Seconds before a chat in cache is reloaded from server, 0 for never
+        'user_info_batch_size': 50,  # Max number of users to look up in one request
+        'lazy_group_members_threshold': 50,  # Load members of named groups larger than this on demand, 0 to disable
+        'reaction_coalesce_window': 1.0,  # Seconds to collect reactions of a message into one update
+        'media_cache_size': 100,  # Max size of stickers and images cached on disk in MiB, 0 to disable
+        'async_engine': False,  # Run downloads in lazy media mode on an event loop, requires aiohttp
+        'thread_sync_max_threads': 0,  # Max number of threads to sync per location, 0 for unlimited
+        'chat_build_workers': 4,  # Number of threads to fetch users and build chats with while syncing
+        'message_store_retention_days': 30,  # Days to remember split messages, 0 to keep forever
+        'lazy_media_download': False,  # Deliver attachments before they are downloaded
+        'image_quality': 'original',  # Quality of images to download: original, large or preview
+        'send_workers': 4,  # Number of threads sending messages to Messenger
+        'send_queue_size': 100,  # Max number of messages to Messenger waiting to be sent
+        'send_rate_limit': 0,  # Messages sent per second in average, 0 for unlimited
+        'send_burst': 5,  # Max number of messages sent at once before the rate limit applies
+        'send_max_retries': 3,  # Times to retry sending a message on temporary errors
+        'send_retry_delay': 1.0,  # Seconds before retrying to send a message, doubled on each retry
+        'share_resources': False,  # Share pools and caches with other accounts in the same process
     }
 
     def __init__(self, channel: 'FBMessengerChannel'):
@@ -46,16 +69,68 @@ def get_value(source: Union[Dict, Sequence],
     """
 
     data: Any = source
-    stack = deque(path)
-    while stack:
-        key = stack.popleft()
-        try:
-            data = data.__getitem__(key)
-        except (AttributeError, KeyError, IndexError, TypeError):
-            return default
+    try:
+        for key in path:
+            data = data[key]
+    except (AttributeError, KeyError, IndexError, TypeError):
+        return default
     return data
 
 
+def compile_path(path: Sequence[Hashable], default: Any = None) -> Callable[[Union[Dict, Sequence]], Any]:
+    """
+    Compile a path of keys into a function getting the value from a source,
+    as :func:`get_value` does.
+
+    Use this instead of :func:`get_value` for paths looked up repeatedly.
+
+    Args:
+        path: Path to get value from
+        default: Default value if the value is not found
+
+    Returns:
+        A function taking the data source, and returning the value found
+        or the default value.
+    """
+    path = tuple(path)
+    errors = (AttributeError, KeyError, IndexError, TypeError)
+
+    # Short paths are unrolled, as most paths have no more than 3 keys.
+    if len(path) == 1:
+        k0, = path
+
+        def getter(source):
+            try:
+                return source[k0]
+            except errors:
+                return default
+    elif len(path) == 2:
+        k0, k1 = path
+
+        def getter(source):
+            try:
+                return source[k0][k1]
+            except errors:
+                return default
+    elif len(path) == 3:
+        k0, k1, k2 = path
+
+        def getter(source):
+            try:
+                return source[k0][k1][k2]
+            except errors:
+                return default
+    else:
+        def getter(source):
+            try:
+                for key in path:
+                    source = source[key]
+            except errors:
+                return default
+            return source
+    return getter
+
+
 class PahoMQTTPingFilter(logging.Filter):
 
     blacklist = {"Sending PINGREQ", "Received PINGRESP"}
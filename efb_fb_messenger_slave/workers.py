@@ -0,0 +1,241 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Hashable, List, Tuple
+
+
+class KeyedWorkerPool:
+    """
+    A bounded pool of worker threads that keeps tasks of the same key in order.
+
+    Tasks submitted with the same key are run one after another in the order
+    they are submitted, while tasks of different keys are run in parallel by up
+    to ``max_workers`` threads. At most ``max_queue_size`` tasks can be pending
+    at the same time, further submissions block until a slot is freed.
+    """
+
+    logger = logging.getLogger("KeyedWorkerPool")
+
+    def __init__(self, max_workers: int = 4, max_queue_size: int = 100,
+                 name: str = "EFMS worker"):
+        """
+        Args:
+            max_workers: Maximum number of worker threads
+            max_queue_size: Maximum number of tasks pending or running
+            name: Prefix of the names of worker threads
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.name = name
+
+        self._slots = threading.BoundedSemaphore(self.max_queue_size)
+        self._condition = threading.Condition(threading.Lock())
+        self._threads: List[threading.Thread] = []
+        self._idle_workers = 0
+        self._shutdown = False
+
+        # Keys with a pending task that are not being worked on.
+        self._ready: Deque[Hashable] = deque()
+        # Pending tasks of keys that are either ready or being worked on.
+        self._queues: Dict[Hashable, Deque[Tuple[Future, Callable, tuple, dict, float]]] = dict()
+
+        # Metrics
+        self.queue_length = 0
+        self.tasks_done = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Schedule ``fn(*args, **kwargs)`` to run after all tasks previously
+        submitted with the same ``key``.
+
+        Blocks when the queue is full.
+
+        Returns:
+            A future resolving to the result of the task.
+        """
+        if self._shutdown:
+            raise RuntimeError("Cannot submit tasks to a pool that is shut down.")
+        self._slots.acquire()
+        future: Future = Future()
+        with self._condition:
+            self.queue_length += 1
+            entry = (future, fn, args, kwargs, time.monotonic())
+            if key in self._queues:
+                self._queues[key].append(entry)
+            else:
+                self._queues[key] = deque((entry,))
+                self._ready.append(key)
+            if len(self._ready) > self._idle_workers and len(self._threads) < self.max_workers:
+                self._start_worker()
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait: bool = False):
+        """
+        Stop accepting new tasks. Workers exit after all pending tasks are done.
+
+        Args:
+            wait: Wait for all workers to exit.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Snapshot of queue length and wait time statistics of the pool."""
+        with self._condition:
+            return {
+                "queue_length": self.queue_length,
+                "active_keys": len(self._queues),
+                "workers": len(self._threads),
+                "tasks_done": self.tasks_done,
+                "average_wait_time": self.total_wait_time / self.tasks_done if self.tasks_done else 0.0,
+                "max_wait_time": self.max_wait_time,
+            }
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._worker,
+                                  name=f"{self.name} {len(self._threads)}",
+                                  daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    if self._shutdown:
+                        return
+                    self._idle_workers += 1
+                    self._condition.wait()
+                    self._idle_workers -= 1
+                key = self._ready.popleft()
+                future, fn, args, kwargs, queued_at = self._queues[key].popleft()
+                wait_time = time.monotonic() - queued_at
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+            self.logger.debug("[%s] Task started after waiting for %.3f s, %s tasks in queue.",
+                              key, wait_time, self.queue_length)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._condition:
+                self.queue_length -= 1
+                self.tasks_done += 1
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._condition.notify()
+                else:
+                    del self._queues[key]
+            self._slots.release()
+
+    def __repr__(self):
+        return f"<KeyedWorkerPool {self.name!r}: {self.metrics!r}>"
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter shared by threads.
+
+    Tokens are added at ``rate`` per second, up to ``capacity`` tokens.
+    Each call of :meth:`acquire` takes a token, waiting until one is
+    available. Callers are served in the order they call.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        Args:
+            rate: Number of tokens added per second, 0 for unlimited
+            capacity: Maximum number of tokens, i.e. the size of a burst
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def acquire(self) -> float:
+        """
+        Take a token, waiting until one is available.
+
+        Returns:
+            Seconds waited.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Reserve the token before waiting, so that later callers wait after this one.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class KeyedDebouncer:
+    """
+    Collapse calls with the same key within a time window into one.
+
+    The first call of a key schedules ``fn`` to run after ``window`` seconds
+    with the arguments of that call. Further calls of the same key before
+    it runs are dropped.
+    """
+
+    logger = logging.getLogger("KeyedDebouncer")
+
+    def __init__(self, fn: Callable, window: float):
+        """
+        Args:
+            fn: Function to call
+            window: Seconds to wait for more calls, 0 to call immediately
+        """
+        self.fn = fn
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending: Dict[Hashable, threading.Timer] = dict()
+
+        # Metrics
+        self.calls = 0
+        self.runs = 0
+
+    def __call__(self, key: Hashable, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            if key in self._pending:
+                self.logger.debug("[%s] Call collapsed into a scheduled one.", key)
+                return
+            if self.window <= 0:
+                self.runs += 1
+            else:
+                timer = threading.Timer(self.window, self._run, args=(key, args, kwargs))
+                timer.daemon = True
+                self._pending[key] = timer
+                timer.start()
+                return
+        self.fn(*args, **kwargs)
+
+    def _run(self, key: Hashable, args: tuple, kwargs: dict):
+        with self._lock:
+            del self._pending[key]
+            self.runs += 1
+        try:
+            self.fn(*args, **kwargs)
+        except Exception as e:
+            self.logger.exception("[%s] Error occurred while running %s: %s", key, self.fn, e)
@@ -43,6 +43,9 @@ setup(
         "bullet",
         "cjkwrap"
     ],
+    extras_require={
+        "async": ["aiohttp>=3.6"]
+    },
     entry_points={
         "console_scripts": ["efms-auth = efb_fb_messenger_slave.__main__:main"],
         "ehforwarderbot.slave": ["blueset.fbmessenger = efb_fb_messenger_slave:FBMessengerChannel"],
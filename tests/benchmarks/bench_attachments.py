@@ -0,0 +1,95 @@
+"""
+Benchmark of classifying attachments of incoming messages.
+
+Run with ``python -m tests.benchmarks.bench_attachments`` from the root of
+the repository.
+"""
+import json
+import os
+import re
+import timeit
+import urllib.parse
+from pathlib import Path
+
+from fbchat.models import EmojiSize
+
+from efb_fb_messenger_slave.attachments import classify_attachment
+from efb_fb_messenger_slave.utils import get_value
+
+PAYLOADS = json.loads((Path(__file__).parent.parent / "fixtures" / "attachments.json").read_text())
+
+NUMBER = 20000
+REPEAT = 5
+
+
+def legacy_classify(attachment):
+    """Classification and field extraction of ``attach_media`` before the dispatch table was introduced."""
+    blob_attachment = attachment.get('mercury', {}).get('blob_attachment', {})
+    attachment_type = blob_attachment.get("__typename", None)
+    if 'sticker_attachment' in attachment.get('mercury', {}):
+        attachment_type = '__Sticker'
+    if 'extensible_attachment' in attachment.get('mercury', {}):
+        attachment_type = '__Link'
+        extensible_type = get_value(attachment, ('mercury', 'extensible_attachment',
+                                                 'story_attachment', 'target', '__typename'))
+        if extensible_type in ('MessageLocation', 'MessageLiveLocation'):
+            attachment_type = 'MessageLocation'
+    filename = attachment.get('filename', None)
+    mime = attachment.get('mimeType', None)
+    if attachment_type == "MessageAudio":
+        return filename or 'audio.mp3', mime or 'audio/mpeg', blob_attachment['playable_url']
+    elif attachment_type == 'MessageImage':
+        return filename or 'image.png', mime or 'image/png', get_value(blob_attachment, ('attribution_app', 'name'))
+    elif attachment_type == 'MessageAnimatedImage':
+        return filename or 'image.gif', mime or 'image/gif', blob_attachment['animated_image']['uri']
+    elif attachment_type == 'MessageFile':
+        return filename or 'file', mime or 'application/octet-stream', blob_attachment['url']
+    elif attachment_type == 'MessageVideo':
+        return filename or 'video.mp4', mime or 'video/mpeg', blob_attachment['playable_url']
+    elif attachment_type == '__Sticker':
+        if get_value(attachment, ('mercury', 'sticker_attachment', 'pack', 'id')) == "227877430692340":
+            sticker_id = get_value(attachment, ('mercury', 'sticker_attachment', 'id'))
+            for i in EmojiSize:
+                if sticker_id == i.value:
+                    return "👍 (%s)" % i.name[0]
+        url = attachment['mercury']['sticker_attachment']['url']
+        text = attachment['mercury']['sticker_attachment'].get('label', '')
+        filename = os.path.split(urllib.parse.urlparse(url).path)[1]
+        sticker_id = get_value(attachment, ('mercury', 'sticker_attachment', 'id'))
+        return url, text, filename, sticker_id
+    elif attachment_type == '__Link':
+        link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
+        title = get_value(link_information, ('title_with_entities', 'text'), '')
+        description = get_value(link_information, ('description', 'text'), '')
+        source = get_value(link_information, ('source', 'text'), None)
+        if source:
+            description += " (via %s)" % source
+        preview = get_value(link_information, ('media', 'playable_url'), None) if \
+            get_value(link_information, ('media', 'is_playable'), False) else None
+        preview = preview or get_value(link_information, ('media', 'image', 'uri'), None)
+        url = link_information.get('url', preview)
+        return title, description, preview, url
+    elif attachment_type == 'MessageLocation':
+        link_information = get_value(attachment, ('mercury', 'extensible_attachment', 'story_attachment'), {})
+        title = get_value(link_information, ('title_with_entities', 'text'), '')
+        description = get_value(link_information, ('description', 'text'), '')
+        text = '\n'.join([title, description])
+        preview = get_value(link_information, ('media', 'image', 'uri'), None)
+        matches = re.search(r'markers=([\d.-]+)%2C([\d.-]+)', preview)
+        if matches:
+            return text, tuple(map(float, matches.groups()))
+        return text
+    return None
+
+
+def main():
+    print(f"{'Payload':<16} {'legacy (us)':>12} {'dispatch (us)':>14}")
+    for name, payload in PAYLOADS.items():
+        # Best of several runs, as single runs are skewed by other processes.
+        legacy = min(timeit.repeat(lambda: legacy_classify(payload), number=NUMBER, repeat=REPEAT)) / NUMBER
+        dispatch = min(timeit.repeat(lambda: classify_attachment(payload), number=NUMBER, repeat=REPEAT)) / NUMBER
+        print(f"{name:<16} {legacy * 1e6:12.3f} {dispatch * 1e6:14.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark of the latency added to each incoming message by echo suppression.
+
+Run with ``python -m tests.benchmarks.bench_echo_suppression`` from the
+root of the repository.
+"""
+import threading
+import time
+
+from efb_fb_messenger_slave.echo import EchoSuppressor
+
+MESSAGES = 20
+
+
+def fixed_sleep(mid: str, sent: set) -> bool:
+    """Echo suppression before EchoSuppressor was introduced."""
+    time.sleep(0.25)
+    if mid in sent:
+        sent.remove(mid)
+        return True
+    return False
+
+
+def measure(name, fn):
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        fn(i)
+    elapsed = (time.perf_counter() - start) / MESSAGES
+    print(f"{name:<45} {elapsed * 1000:10.3f} ms/message")
+
+
+def main():
+    sent: set = set()
+    measure("Fixed 0.25 s sleep", lambda i: fixed_sleep(f"mid.$other{i}", sent))
+
+    suppressor = EchoSuppressor()
+    measure("Message from others", lambda i: suppressor.is_echo(f"mid.$other{i}", "thread", False))
+    measure("Message from self, no sending in progress",
+            lambda i: suppressor.is_echo(f"mid.$self{i}", "thread", True))
+
+    def echo_before_send_returns(i):
+        # Echo arrives 5 ms before the send request returns.
+        mid = f"mid.$echo{i}"
+        started = threading.Event()
+
+        def send():
+            with suppressor.sending("thread"):
+                started.set()
+                time.sleep(0.005)
+                suppressor.register(mid)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        started.wait()
+        assert suppressor.is_echo(mid, "thread", True)
+        thread.join()
+
+    measure("Echo received while sending (5 ms in flight)", echo_before_send_returns)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of looking up values by paths of keys in nested payloads.
+
+Run with ``python -m tests.benchmarks.bench_get_value`` from the root of
+the repository.
+"""
+import timeit
+from collections import deque
+
+from efb_fb_messenger_slave.utils import compile_path, get_value
+
+NUMBER = 200000
+
+SOURCE = {
+    "messaging_actor": {
+        "id": "100000000000001",
+        "name": "Alice",
+        "big_image_src": {"uri": "https://scontent.example.com/alice.jpg"},
+    },
+    "thread_key": {"thread_fbid": "2000000000000001"},
+    "all_participants": {
+        "nodes": [{"messaging_actor": {"id": "100000000000001",
+                                       "attribution": {"app": {"name": {"text": "Messenger"}}}}}],
+    },
+}
+
+PATHS = [
+    ("hit, 2 keys", ('thread_key', 'thread_fbid')),
+    ("hit, 3 keys", ('messaging_actor', 'big_image_src', 'uri')),
+    ("hit, 9 keys", ('all_participants', 'nodes', 0, 'messaging_actor', 'attribution', 'app', 'name', 'text')),
+    ("miss at the 1st key", ('image', 'uri')),
+    ("miss at the 3rd key", ('messaging_actor', 'big_image_src', 'url')),
+    ("miss at the 8th key", ('all_participants', 'nodes', 0, 'messaging_actor', 'attribution', 'app', 'id', 'text')),
+]
+
+
+def legacy_get_value(source, path, default=None):
+    """``get_value`` before the fast path was introduced."""
+    data = source
+    stack = deque(path)
+    while stack:
+        key = stack.popleft()
+        try:
+            data = data.__getitem__(key)
+        except (AttributeError, KeyError, IndexError, TypeError):
+            return default
+    return data
+
+
+def measure(fn):
+    return min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER * 1e9
+
+
+def main():
+    print(f"{'Path':<22} {'legacy (ns)':>12} {'get_value (ns)':>15} {'compiled (ns)':>14}")
+    for name, path in PATHS:
+        getter = compile_path(path)
+        assert legacy_get_value(SOURCE, path) == get_value(SOURCE, path) == getter(SOURCE)
+        legacy = measure(lambda: legacy_get_value(SOURCE, path))
+        current = measure(lambda: get_value(SOURCE, path))
+        compiled = measure(lambda: getter(SOURCE))
+        print(f"{name:<22} {legacy:12.1f} {current:15.1f} {compiled:14.1f}")
+
+
+if __name__ == '__main__':
+    main()
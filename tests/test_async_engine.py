@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from efb_fb_messenger_slave.async_engine import AsyncEngine
+from efb_fb_messenger_slave.media import MediaCache, MediaDownloader, MediaTooLargeError
+
+from conftest import CONTENT
+
+pytest.importorskip("aiohttp")
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncEngine(max_connections=4, executor_workers=2)
+    yield engine
+    engine.stop()
+
+
+def test_async_engine_run_blocking(engine):
+    future = engine.run_blocking(threading.current_thread)
+    assert future.result(timeout=5) is not threading.current_thread()
+
+
+def test_async_engine_concurrent_downloads(engine, server_url):
+    futures = [engine.fetch(server_url + "/image", suffix=".png") for _ in range(10)]
+    for future in futures:
+        result = future.result(timeout=10)
+        assert result.status == 200
+        assert result.download.mime == "image/png"
+        assert result.download.file.read() == CONTENT
+        result.download.file.close()
+
+
+def test_downloader_in_async_engine(engine, server_url, tmp_path):
+    downloader = MediaDownloader(max_size=1000, engine=engine)
+    assert downloader.engine is engine
+    with pytest.raises(MediaTooLargeError):
+        downloader.download_async(server_url + "/chunked").result(timeout=10)
+
+    downloader = MediaDownloader(cache=MediaCache(tmp_path, max_size=1024 * 1024), engine=engine)
+    download = downloader.download_async(lambda: server_url + "/image", suffix=".png",
+                                         cache_key="image:1").result(timeout=10)
+    assert download.file.name.endswith(".png")
+    assert download.file.read() == CONTENT
+    download.file.close()
+
+    def fail():
+        raise AssertionError("URL should not be resolved for cached files.")
+
+    cached = downloader.download_async(fail, cache_key="image:1").result(timeout=10)
+    assert cached.file.read() == CONTENT
+    cached.file.close()
+
+
+def test_downloader_without_async_engine():
+    with pytest.raises(RuntimeError):
+        MediaDownloader().download_async("http://127.0.0.1/")
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from ehforwarderbot import MsgType
+from efb_fb_messenger_slave.attachments import classify_attachment
+
+PAYLOADS = json.loads((Path(__file__).parent / "fixtures" / "attachments.json").read_text())
+
+
+@pytest.mark.parametrize("name, attachment_type, msg_type", [
+    ("audio", "MessageAudio", MsgType.Voice),
+    ("image", "MessageImage", MsgType.Image),
+    ("animated_image", "MessageAnimatedImage", MsgType.Animation),
+    ("file", "MessageFile", MsgType.File),
+    ("video", "MessageVideo", MsgType.Image),
+    ("sticker", "__Sticker", MsgType.Sticker),
+    ("like_sticker", "__Sticker", MsgType.Text),
+    ("link", "__Link", MsgType.Link),
+    ("location", "MessageLocation", MsgType.Location),
+    ("live_location", "MessageLocation", MsgType.Location),
+    ("unsupported", "MessagePoll", MsgType.Unsupported),
+])
+def test_classify_attachment_types(name, attachment_type, msg_type):
+    info = classify_attachment(PAYLOADS[name])
+    assert info.type == attachment_type
+    assert info.msg_type == msg_type
+    assert info.id == PAYLOADS[name]["id"]
+
+
+def test_classify_attachment_fields():
+    image = classify_attachment(PAYLOADS["image"])
+    assert (image.filename, image.mime, image.attribution_app) == \
+        ("image-1002", "image/jpeg", "Facebook for Android")
+    assert image.blob["large_preview"]["width"] == 2048
+
+    sticker = classify_attachment(PAYLOADS["sticker"])
+    assert sticker.filename == "851557_144885022352431_n.png"
+    assert (sticker.text, sticker.sticker_id) == ("Pusheen waving", "144885022352431")
+    assert classify_attachment(PAYLOADS["like_sticker"]).text == "👍 (S)"
+
+    link = classify_attachment(PAYLOADS["link"])
+    assert link.title == "EH Forwarder Bot"
+    assert link.description == "An extensible message tunneling chat bot framework. (via github.com)"
+    assert link.url.startswith("https://l.facebook.com/")
+    assert link.preview.startswith("https://external.xx.fbcdn.net/safe_image.php")
+
+    location = classify_attachment(PAYLOADS["location"])
+    assert (location.latitude, location.longitude) == (-33.8688197, 151.2092955)
+    assert location.text == "Pinned Location\nSydney NSW, Australia"
+
+
+def test_classify_attachment_defaults():
+    audio = classify_attachment({"mercury": {"blob_attachment": {"__typename": "MessageAudio"}}})
+    assert (audio.filename, audio.mime, audio.url) == ("audio.mp3", "audio/mpeg", None)
+    location = classify_attachment({"mercury": {"extensible_attachment": {"story_attachment": {
+        "target": {"__typename": "MessageLocation"}}}}})
+    assert location.msg_type == MsgType.Unsupported
+    assert classify_attachment({}).msg_type == MsgType.Unsupported
+
+
+def test_classify_attachment_without_mercury():
+    blob = PAYLOADS["file"]["mercury"]["blob_attachment"]
+    info = classify_attachment(dict(blob, id="1"))
+    assert (info.type, info.msg_type, info.id) == ("MessageFile", MsgType.File, "1")
+    assert info.url == blob["url"]
+    assert (info.title, info.description, info.latitude) == ('', '', None)
@@ -0,0 +1,46 @@
+import time
+
+from efb_fb_messenger_slave.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache["a"] == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert list(cache) == ["a", "c"]
+    assert cache.stats == {"size": 2, "hits": 1, "misses": 0, "evictions": 1}
+
+
+def test_lru_cache_on_evict():
+    evicted = []
+    cache = LRUCache(max_size=2, on_evict=lambda key, value: evicted.append((key, value)))
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"] = 3
+    assert evicted == []
+    cache["c"] = 4
+    cache.invalidate("a")
+    assert evicted == [("b", 2)]
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(ttl=0.05)
+    cache["a"] = 1
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.items() == [("b", 2)]
+    assert cache.misses == 1
+
+
+def test_lru_cache_invalidate():
+    cache = LRUCache()
+    cache["a"] = 1
+    assert cache.invalidate("a") == 1
+    assert cache.invalidate("a") is None
+    assert len(cache) == 0
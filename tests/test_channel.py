@@ -0,0 +1,38 @@
+import threading
+from types import SimpleNamespace
+
+from fbchat.models import User
+
+from efb_fb_messenger_slave import FBMessengerChannel
+from efb_fb_messenger_slave.utils import ExperimentalFlagsManager
+
+
+def make_channel(threads, fetch_all_users):
+    channel = FBMessengerChannel.__new__(FBMessengerChannel)
+    channel.flag = ExperimentalFlagsManager.DEFAULT_VALUES.copy().__getitem__
+    channel.client = SimpleNamespace(uid="self", fetchAllUsers=fetch_all_users)
+    channel.thread_sync = SimpleNamespace(iter_sync=lambda locations: iter(threads),
+                                          thread_ids=lambda locations: [])
+    channel.primed = []
+    resolver = SimpleNamespace(batch_size=50, prime=channel.primed.append, resolve=list)
+    channel.chat_manager = SimpleNamespace(user_resolver=resolver, cache={},
+                                           is_lazy_group=lambda thread: False,
+                                           build_and_cache_thread=lambda thread: SimpleNamespace(uid=thread.uid))
+    return channel
+
+
+def test_iter_chats_does_not_wait_for_friends():
+    arrived = threading.Event()
+    friends = [User("1", name="Thread"), User("100", name="Friend")]
+
+    def fetch_all_users():
+        assert arrived.wait(timeout=5)
+        return friends
+
+    channel = make_channel([User(str(i), name=str(i)) for i in range(30)], fetch_all_users)
+    chats = channel.iter_chats()
+    assert next(chats).uid == "0"
+    assert channel.primed == []
+    arrived.set()
+    assert [i.uid for i in chats] == [str(i) for i in range(1, 30)] + ["100"]
+    assert channel.primed == [friends]
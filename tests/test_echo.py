@@ -0,0 +1,36 @@
+import threading
+import time
+
+from efb_fb_messenger_slave.echo import EchoSuppressor
+
+
+def test_echo_suppressor_ignores_registered_messages():
+    suppressor = EchoSuppressor()
+    suppressor.register("mid.$1")
+    assert suppressor.is_echo("mid.$1", "thread", True)
+    assert not suppressor.is_echo("mid.$1", "thread", True)
+    assert not suppressor.is_echo("mid.$2", "thread", False)
+
+
+def test_echo_suppressor_waits_for_sending_messages():
+    suppressor = EchoSuppressor(wait_timeout=5)
+    started = threading.Event()
+
+    def send():
+        with suppressor.sending("thread"):
+            started.set()
+            time.sleep(0.05)
+            suppressor.register("mid.$1")
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    started.wait()
+    assert suppressor.is_echo("mid.$1", "thread", True)
+    thread.join()
+
+
+def test_echo_suppressor_expires_messages():
+    suppressor = EchoSuppressor(ttl=0)
+    suppressor.register("mid.$1")
+    assert not suppressor.is_echo("mid.$1", "thread", False)
+    assert len(suppressor) == 0
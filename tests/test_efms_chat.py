@@ -0,0 +1,339 @@
+import gzip
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from fbchat.models import Group, ThreadType, User
+
+from ehforwarderbot import MsgType, coordinator
+from ehforwarderbot.channel import MasterChannel, SlaveChannel
+from ehforwarderbot.chat import GroupChat, PrivateChat
+from ehforwarderbot.message import Message
+from ehforwarderbot.types import ChatID
+
+from efb_fb_messenger_slave.efms_chat import EFMSChatManager, LazyGroupChat, UserInfo, UserInfoResolver
+from efb_fb_messenger_slave.utils import ExperimentalFlagsManager
+
+
+class FakeResolver:
+    batch_size = 10
+
+    def __init__(self):
+        self.calls = []
+
+    def resolve(self, user_ids):
+        user_ids = list(user_ids)
+        self.calls.append(user_ids)
+        return {i: SimpleNamespace(name=f"User {i}", nickname=None, own_nickname=None) for i in user_ids}
+
+
+class FakeMaster(MasterChannel):
+    channel_name = "Fake master"
+    channel_emoji = "🧪"
+    channel_id = "tests.fake_master"
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def send_message(self, msg):
+        self.messages.append(msg)
+        return msg
+
+    def send_status(self, status):
+        pass
+
+    def poll(self):
+        pass
+
+    def stop_polling(self):
+        pass
+
+    def get_message_by_id(self, chat, msg_id):
+        pass
+
+
+def make_group(resolver, size=100):
+    chat = LazyGroupChat(module_id="tests.fake_slave", module_name="Fake slave", channel_emoji="🧪",
+                         name="Group", uid=ChatID("group"), resolver=resolver,
+                         participants={ChatID(str(i)): None for i in range(size)})
+    chat.self.uid = "self"
+    return chat
+
+
+def test_lazy_group_get_member_loads_one_member():
+    resolver = FakeResolver()
+    chat = make_group(resolver)
+    assert chat.get_member(ChatID("42")).name == "User 42"
+    assert chat.get_member(ChatID("42")).name == "User 42"
+    assert resolver.calls == [["42"]]
+    assert len(chat.pending_members) == 99
+    with pytest.raises(KeyError):
+        chat.get_member(ChatID("unknown"))
+
+
+def test_lazy_group_verify_does_not_load_members():
+    resolver = FakeResolver()
+    chat = make_group(resolver)
+    chat.verify()
+    assert chat.has_self
+    assert resolver.calls == []
+    assert len(chat.pending_members) == 100
+
+
+def test_lazy_group_repr_does_not_load_members():
+    resolver = FakeResolver()
+    chat = make_group(resolver)
+    chat.get_member(ChatID("42"))
+    assert "pending_members=99" in repr(chat)
+    assert "User 42" in repr(chat)
+    assert "Group" in str(chat)
+    assert resolver.calls == [["42"]]
+
+
+def test_lazy_group_enumerating_members_loads_all():
+    resolver = FakeResolver()
+    chat = make_group(resolver, size=25)
+    assert len(chat.members) == 26
+    assert [len(i) for i in resolver.calls] == [10, 10, 5]
+    assert not chat.pending_members
+
+
+def test_lazy_group_delivering_message_does_not_load_members(monkeypatch):
+    resolver = FakeResolver()
+    chat = make_group(resolver)
+    master = FakeMaster()
+    monkeypatch.setattr(coordinator, "master", master, raising=False)
+    monkeypatch.setattr(coordinator, "middlewares", [])
+    msg = Message(uid="mid.1", chat=chat, author=chat.get_member(ChatID("1")),
+                  type=MsgType.Text, text="Hello", deliver_to=master)
+    coordinator.send_message(msg)
+    assert master.messages == [msg]
+    assert resolver.calls == [["1"]]
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def fetchThreadInfo(self, *user_ids):
+        self.calls.append(list(user_ids))
+        return {i: SimpleNamespace(uid=i, name=f"User {i}", nickname=f"Nick {i}", own_nickname=None)
+                for i in user_ids}
+
+
+def test_user_resolver_batches_and_deduplicates():
+    client = FakeClient()
+    resolver = UserInfoResolver(client, batch_size=2)
+    users = resolver.resolve(["1", "2", "1", "3", "2"])
+    assert list(users) == ["1", "2", "3"]
+    assert client.calls == [["1", "2"], ["3"]]
+    assert set(resolver.resolve(["3", "4", "4"])) == {"3", "4"}
+    assert client.calls == [["1", "2"], ["3"], ["4"]]
+
+
+def test_user_resolver_primes_names_only():
+    client = FakeClient()
+    resolver = UserInfoResolver(client, batch_size=10)
+    resolver.resolve(["1"])
+    resolver.prime([SimpleNamespace(uid="1", name="Renamed", photo=None, nickname=None),
+                    SimpleNamespace(uid="2", name="User 2", photo="https://example.com/2.jpg", nickname=None)])
+    users = resolver.resolve(["1", "2"])
+    assert client.calls == [["1"]]
+    # Records with nicknames are not replaced by primed ones.
+    assert users["1"].nickname == "Nick 1"
+    assert users["2"] == UserInfo(uid="2", name="User 2", photo="https://example.com/2.jpg")
+
+
+def test_lazy_group_member_aliases_from_group_nicknames():
+    client = FakeClient()
+    resolver = UserInfoResolver(client, batch_size=10)
+    resolver.prime([SimpleNamespace(uid="1", name="User 1", photo=None),
+                    SimpleNamespace(uid="2", name="User 2", photo=None)])
+    chat = LazyGroupChat(module_id="tests.fake_slave", module_name="Fake slave", channel_emoji="🧪",
+                         name="Group", uid=ChatID("group"), resolver=resolver,
+                         participants={ChatID("1"): "Group nick", ChatID("2"): None})
+    assert chat.get_member(ChatID("1")).alias == "Group nick"
+    assert chat.get_member(ChatID("2")).alias is None
+    assert client.calls == []
+
+
+class FakeThreadClient:
+    uid = "self"
+
+    def __init__(self, threads=()):
+        self.threads = {i.uid: i for i in threads}
+        self.threads[self.uid] = User(self.uid, name="Me")
+        self.calls = []
+
+    def fetchThreadInfo(self, *thread_ids):
+        self.calls.append(list(thread_ids))
+        return {i: self.threads[i] for i in thread_ids}
+
+
+class FakeSlave(SlaveChannel):
+    channel_name = "Fake slave"
+    channel_emoji = "🧪"
+    channel_id = "tests.fake_slave"
+    flag = staticmethod(ExperimentalFlagsManager.DEFAULT_VALUES.get)
+    ngettext = None
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def _(self, text):
+        return text
+
+    def send_message(self, msg):
+        pass
+
+    def send_status(self, status):
+        pass
+
+    def poll(self):
+        pass
+
+    def stop_polling(self):
+        pass
+
+    def get_message_by_id(self, chat, msg_id):
+        pass
+
+    def get_chat_picture(self, chat):
+        pass
+
+    def get_chat(self, chat_uid):
+        pass
+
+    def get_chats(self):
+        pass
+
+
+@pytest.fixture
+def make_chat_manager(tmp_path, monkeypatch):
+    monkeypatch.setenv("EFB_DATA_PATH", str(tmp_path))
+    monkeypatch.setattr(coordinator, "send_status", lambda status: None)
+    monkeypatch.setattr(coordinator, "master", None, raising=False)
+
+    def make(*threads):
+        return EFMSChatManager(FakeSlave(FakeThreadClient(threads)))
+
+    return make
+
+
+def test_chat_cache_round_trip(make_chat_manager):
+    manager = make_chat_manager()
+    assert not manager.cache_loaded
+    user = PrivateChat(channel=manager.channel, name="User 1", alias="Nick 1", uid=ChatID("1"),
+                       vendor_specific={"chat_type": "User"})
+    group = GroupChat(channel=manager.channel, name="Group", uid=ChatID("2"), description="Topic")
+    group.add_member(name="User 1", alias="Nick 1", uid=ChatID("1"))
+    lazy = LazyGroupChat(channel=manager.channel, name="Lazy group", uid=ChatID("3"),
+                         resolver=manager.user_resolver,
+                         participants={ChatID("1"): "Group nick", ChatID("4"): None})
+    lazy.self.uid = manager.client.uid
+    manager.user_resolver.prime([SimpleNamespace(uid="1", name="User 1", photo=None)])
+    lazy.get_member(ChatID("1"))
+    for chat in (user, group, lazy):
+        manager.cache_chat(chat)
+    manager.save_cache()
+    assert [i.name for i in manager.cache_path.parent.iterdir()] == ["chats.json.gz"]
+
+    loaded = make_chat_manager()
+    assert loaded.cache_loaded
+    for chat in (user, group, lazy):
+        assert loaded.export_chat(loaded.cache.get(chat.uid)) == manager.export_chat(chat)
+    loaded_lazy = loaded.cache.get(lazy.uid)
+    assert isinstance(loaded_lazy, LazyGroupChat)
+    assert loaded_lazy.pending_members == {"4": None}
+    assert loaded_lazy.self.uid == "self"
+    assert loaded.client.calls == []
+
+
+def test_chat_cache_concurrent_saves(make_chat_manager):
+    manager = make_chat_manager()
+    for i in range(100):
+        manager.cache_chat(PrivateChat(channel=manager.channel, name=f"User {i}", uid=ChatID(str(i))))
+    threads = [threading.Thread(target=manager.save_cache) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [i.name for i in manager.cache_path.parent.iterdir()] == ["chats.json.gz"]
+    assert make_chat_manager().cache.get("99").name == "User 99"
+
+
+def test_chat_cache_version_mismatch(make_chat_manager):
+    manager = make_chat_manager()
+    manager.cache_chat(PrivateChat(channel=manager.channel, name="User 1", uid=ChatID("1")))
+    with gzip.open(str(manager.cache_path), 'wt', encoding='utf-8') as f:
+        json.dump({"version": manager.CACHE_VERSION - 1, "chats": [manager.export_chat(manager.cache.get("1"))]}, f)
+    loaded = make_chat_manager()
+    assert not loaded.cache_loaded
+    assert loaded.cache.get("1") is None
+
+
+@pytest.mark.parametrize("content", [b"not gzip", gzip.compress(b"{not json"), gzip.compress(b'{"version": 2}')],
+                         ids=["not gzip", "not json", "no chats"])
+def test_chat_cache_corrupt_file(make_chat_manager, content):
+    manager = make_chat_manager()
+    manager.cache_path.write_bytes(content)
+    loaded = make_chat_manager()
+    assert not loaded.cache_loaded
+    loaded.save_cache()
+    assert make_chat_manager().cache_loaded
+
+
+def test_get_thread_type(make_chat_manager):
+    manager = make_chat_manager(Group("2", name="Group", participants={"self", "1"}),
+                                Group("3", name="Group", participants={"self", "1"}))
+    manager.client.calls.clear()
+    # From the cached chat first, even without a chat type.
+    manager.cache_chat(PrivateChat(channel=manager.channel, name="User 1", uid=ChatID("1")))
+    manager.cache_chat(GroupChat(channel=manager.channel, name="Group", uid=ChatID("2")))
+    manager.thread_types["1"] = ThreadType.GROUP
+    assert manager.get_thread_type("1") == ThreadType.USER
+    assert manager.get_thread_type("2") == ThreadType.GROUP
+    assert manager.client.calls == []
+
+    # Fetched from the server once when not cached.
+    assert manager.get_thread_type("3") == ThreadType.GROUP
+    assert manager.get_thread_type("3") == ThreadType.GROUP
+    assert manager.client.calls == [["3"]]
+
+    # Invalidated chats fall back to remembered types, then the server.
+    manager.invalidate("1")
+    manager.invalidate("2")
+    assert manager.get_thread_type("1") == ThreadType.GROUP
+    assert manager.get_thread_type("2") == ThreadType.GROUP
+    assert manager.client.calls == [["3"], ["2"]]
+
+
+def test_search_index_follows_chat_cache(make_chat_manager):
+    manager = make_chat_manager()
+    group = GroupChat(channel=manager.channel, name="Book club", uid=ChatID("2"))
+    group.add_member(name="Carol", alias="Caz", uid=ChatID("1"))
+    manager.cache_chat(group)
+    lazy = LazyGroupChat(channel=manager.channel, name="Chess club", uid=ChatID("3"),
+                         resolver=manager.user_resolver, participants={ChatID("4"): "Knight", ChatID("5"): None})
+    manager.cache_chat(lazy)
+    assert [i.uid for i in manager.search_index.search("caz")] == ["2"]
+    assert [i.uid for i in manager.search_index.search("knight")] == ["3"]
+    assert len(lazy.pending_members) == 2
+
+    # Renamed groups are no longer found by their old names.
+    manager.invalidate("2")
+    assert manager.search_index.search("book") == []
+    group.name = "Reading club"
+    manager.cache_chat(group)
+    assert manager.search_index.search("book") == []
+    assert [i.uid for i in manager.search_index.search("reading")] == ["2"]
+
+    # Chats evicted from cache are removed from the index.
+    assert list(manager.cache) == ["self", "3", "2"]
+    manager.cache.max_size = 2
+    manager.cache_chat(PrivateChat(channel=manager.channel, name="Dave", uid=ChatID("6")))
+    assert manager.search_index.search("chess") == []
+    assert [i.uid for i in manager.search_index.search("dave")] == ["6"]
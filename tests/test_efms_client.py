@@ -0,0 +1,147 @@
+import copy
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from ehforwarderbot import MsgType, coordinator
+from ehforwarderbot.chat import GroupChat
+from ehforwarderbot.message import Message as EFBMessage
+from ehforwarderbot.types import MessageID
+from fbchat import Client
+from fbchat._exception import FBchatUserError
+
+from efb_fb_messenger_slave.cache import LRUCache
+from efb_fb_messenger_slave.efms_client import EFMSClient
+from efb_fb_messenger_slave.media import MediaDownloader
+from efb_fb_messenger_slave.shared import shared_resources
+from efb_fb_messenger_slave.utils import ExperimentalFlagsManager
+
+PAYLOADS = json.loads((Path(__file__).parent / "fixtures" / "attachments.json").read_text())
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """A client with enough state to process incoming messages, without logging in."""
+    client = EFMSClient.__new__(EFMSClient)
+    config = ExperimentalFlagsManager.DEFAULT_VALUES.copy()
+    chat = GroupChat(module_id="tests.efms", module_name="EFMS", channel_emoji="🧪", name="Group", uid="1")
+    for i in ("u1", "u2", "u3"):
+        chat.add_member(name=i, uid=i)
+    client.channel = SimpleNamespace(channel_id="tests.efms", flag=config.__getitem__,
+                                     chat_manager=SimpleNamespace(get_thread=lambda thread_id: chat))
+    client.logger = logging.getLogger(__name__)
+    client._ = lambda text: text
+    client._uid = "self"
+    client.echo_suppressor = SimpleNamespace(is_echo=lambda *args, **kwargs: False)
+    client.reactions = LRUCache(max_size=100)
+    client.reactions_lock = threading.Lock()
+    client.reaction_fetches = dict()
+    client.downloader = MediaDownloader(timeout=5)
+    client.attachment_pool = ThreadPoolExecutor(max_workers=2)
+    client.delivered = []
+    client.markAsDelivered = lambda mid, thread_id: client.delivered.append(mid)
+    client.build_efb_msg = lambda mid, thread_id, author_id, message_object: \
+        EFBMessage(uid=MessageID(mid), text=message_object.text, type=MsgType.Text)
+    client.sent = []
+    client.statuses = []
+    monkeypatch.setattr(coordinator, "send_message", client.sent.append)
+    monkeypatch.setattr(coordinator, "send_status", client.statuses.append)
+    monkeypatch.setattr(coordinator, "master", None, raising=False)
+    yield client
+    client.attachment_pool.shutdown()
+    client.downloader.close()
+
+
+def test_on_message_delivers_attachment_failed_to_download(client, server_url):
+    attachment = copy.deepcopy(PAYLOADS["file"])
+    attachment["mercury"]["blob_attachment"]["url"] = server_url + "/missing"
+    client.on_message(mid="mid.1", author_id="1", thread_id="1",
+                      message_object=SimpleNamespace(text="See attached", reactions=None),
+                      msg={"attachments": [attachment]})
+    assert len(client.sent) == 1
+    msg = client.sent[0]
+    assert msg.uid == "mid.1"
+    assert msg.type == MsgType.Unsupported
+    assert msg.file is None and msg.filename is None
+    assert msg.text == "Failed to download attachment.\nSee attached"
+    assert client.delivered == ["mid.1"]
+
+
+def graphql_message(mid, reactions):
+    return {"message_id": mid, "message_sender": {"id": "u1"},
+            "message_reactions": [{"user": {"id": user_id}, "reaction": reaction}
+                                  for user_id, reaction in reactions.items()]}
+
+
+def test_update_reaction_add_and_remove(client):
+    client.remember_reactions("mid.1", {"u1": "😍"})
+    client.update_reaction("mid.1", "u2", "👍")
+    assert client.reactions["mid.1"] == {"u1": "😍", "u2": "👍"}
+    client.update_reaction("mid.1", "u1", None)
+    assert client.reactions["mid.1"] == {"u2": "👍"}
+    # Messages with unknown reactions are left to be fetched.
+    client.update_reaction("mid.2", "u1", "😍")
+    assert "mid.2" not in client.reactions
+
+
+def test_update_reaction_unknown_removal_invalidates(client):
+    client.remember_reactions("mid.1", {"u1": "😍"})
+    client.update_reaction("mid.1", "u2", None)
+    assert "mid.1" not in client.reactions
+
+
+def test_on_message_reaction_fetches_unknown_reactions(client):
+    fetches = []
+
+    def forced_fetch(thread_id, mid):
+        fetches.append(mid)
+        return {"message": graphql_message(mid, {"u1": "😍", "u2": "😍"})}
+
+    client._getThread = lambda thread_id, thread_type: (thread_id, None)
+    client._forcedFetch = forced_fetch
+    client.on_message_reaction("1", "mid.1")
+    client.on_message_reaction("1", "mid.1")
+    assert fetches == ["mid.1"]
+    assert client.reactions["mid.1"] == {"u1": "😍", "u2": "😍"}
+    assert [i.uid for i in client.statuses[-1].reactions["😍"]] == ["u1", "u2"]
+
+
+def test_reaction_during_fetch_is_not_overwritten(client):
+    fetches = []
+
+    def forced_fetch(thread_id, mid):
+        fetches.append(mid)
+        if len(fetches) == 1:
+            # A reaction arrives while the message is being fetched.
+            client.update_reaction(mid, "u3", "👍")
+            return {"message": graphql_message(mid, {"u1": "😍"})}
+        return {"message": graphql_message(mid, {"u1": "😍", "u3": "👍"})}
+
+    client._getThread = lambda thread_id, thread_type: (thread_id, None)
+    client._forcedFetch = forced_fetch
+    client.on_message_reaction("1", "mid.1")
+    assert "mid.1" not in client.reactions
+    client.on_message_reaction("1", "mid.1")
+    assert fetches == ["mid.1", "mid.1"]
+    assert client.reactions["mid.1"] == {"u1": "😍", "u3": "👍"}
+    assert not client.reaction_fetches
+
+
+def test_failed_login_releases_resources(tmp_path, monkeypatch):
+    monkeypatch.setenv("EFB_DATA_PATH", str(tmp_path))
+
+    def login(self, *args, **kwargs):
+        raise FBchatUserError("Login failed")
+
+    monkeypatch.setattr(Client, "__init__", login)
+    config = ExperimentalFlagsManager.DEFAULT_VALUES.copy()
+    channel = SimpleNamespace(channel_id="tests.efms#login", flag=config.__getitem__, _=None, ngettext=None)
+    with pytest.raises(FBchatUserError):
+        EFMSClient(channel, None, None)
+    for name in ("inbound_pool", "downloader", "attachment_pool"):
+        assert shared_resources.owners(f"tests.efms#login:{name}") == set()
@@ -0,0 +1,41 @@
+from efb_fb_messenger_slave.cache import LRUCache
+from efb_fb_messenger_slave.efms_client import EFMSClient
+
+BLOB = {
+    "original_dimensions": {"width": 2048, "height": 1536},
+    "large_preview": {"uri": "https://example.com/large.jpg", "width": 1280, "height": 960},
+    "preview": {"uri": "https://example.com/preview.jpg", "width": 280, "height": 210},
+}
+
+
+def make_client():
+    client = EFMSClient.__new__(EFMSClient)
+    client.image_urls = LRUCache(max_size=10)
+    client.requests = []
+
+    def fetch_image_url(image_id):
+        client.requests.append(image_id)
+        return "https://example.com/original.jpg"
+
+    client.fetchImageUrl = fetch_image_url
+    return client
+
+
+def test_image_url_prefers_payload():
+    client = make_client()
+    assert client.get_image_url("1", BLOB, "large") == "https://example.com/large.jpg"
+    assert client.get_image_url("1", BLOB, "preview") == "https://example.com/preview.jpg"
+    assert client.get_image_url("1", {"preview": BLOB["preview"]}, "large") == "https://example.com/preview.jpg"
+
+    full_size = dict(BLOB, original_dimensions={"width": 1280, "height": 960})
+    assert client.get_image_url("1", full_size) == "https://example.com/large.jpg"
+    assert client.requests == []
+
+
+def test_image_url_resolves_original_once():
+    client = make_client()
+    resolve = client.get_image_url("1", BLOB)
+    assert callable(resolve)
+    assert resolve() == "https://example.com/original.jpg"
+    assert client.get_image_url("1", {}, "large")() == "https://example.com/original.jpg"
+    assert client.requests == ["1"]
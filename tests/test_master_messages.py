@@ -0,0 +1,139 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from fbchat import FBchatFacebookError
+
+from ehforwarderbot import MsgType
+from ehforwarderbot.message import Message, LinkAttribute, StatusAttribute
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from efb_fb_messenger_slave.master_messages import MasterMessageManager
+from efb_fb_messenger_slave.utils import ExperimentalFlagsManager
+
+
+class FakeClient:
+    def __init__(self, failures=()):
+        self.lock = threading.Lock()
+        self.sent = []
+        self.read = []
+        # Errors to raise on the first attempts
+        self.failures = list(failures)
+
+    def send(self, message, thread_id, thread_type):
+        time.sleep(0.001)
+        with self.lock:
+            if self.failures:
+                raise self.failures.pop(0)
+            self.sent.append((thread_id, message.text))
+            return f"mid.{len(self.sent)}"
+
+    def setTypingStatus(self, status, thread_id, thread_type):
+        with self.lock:
+            self.sent.append((thread_id, status))
+
+    def markAsSeen(self):
+        pass
+
+    def markAsRead(self, thread_id):
+        with self.lock:
+            self.read.append(thread_id)
+
+
+def make_manager(client, **flags):
+    config = ExperimentalFlagsManager.DEFAULT_VALUES.copy()
+    config.update(send_retry_delay=0.01, **flags)
+    channel = SimpleNamespace(client=client, flag=config.__getitem__,
+                              chat_manager=SimpleNamespace(get_thread_type=lambda thread_id: None))
+    return MasterMessageManager(channel)
+
+
+def make_message(thread_id, url):
+    return Message(chat=SimpleNamespace(uid=thread_id), type=MsgType.Link, text="",
+                   attributes=LinkAttribute(title=url, url=url))
+
+
+def test_send_message_keeps_order_per_thread():
+    client = FakeClient()
+    manager = make_manager(client)
+    messages = [make_message(thread, f"https://example.com/{thread}/{i}")
+                for i in range(10) for thread in ("1", "2")]
+    futures = [manager.queue_message(i) for i in messages]
+    for future, msg in zip(futures, messages):
+        assert future.result(timeout=5) == msg.uid
+    manager.stop()
+
+    for thread in ("1", "2"):
+        assert [text for tid, text in client.sent if tid == thread] == \
+               [f"https://example.com/{thread}/{i}" for i in range(10)]
+    assert len({i.uid for i in messages}) == 20
+
+
+def test_send_message_retries_transient_errors():
+    client = FakeClient([FBchatFacebookError("Got 503 response.", request_status_code=503),
+                         requests.ConnectTimeout()])
+    manager = make_manager(client)
+    msg = make_message("1", "https://example.com/")
+    assert manager.send_message(msg) is msg
+    assert msg.uid == "mid.1"
+    assert client.sent == [("1", "https://example.com/")]
+    manager.stop()
+
+
+def test_send_message_does_not_retry_other_errors():
+    client = FakeClient([FBchatFacebookError("Got 404 response.", request_status_code=404)])
+    manager = make_manager(client)
+    with pytest.raises(FBchatFacebookError):
+        manager.send_message(make_message("1", "https://example.com/"))
+    assert client.sent == []
+    manager.stop()
+
+
+def test_send_message_gives_up_after_max_retries():
+    client = FakeClient([requests.ConnectTimeout()] * 3)
+    manager = make_manager(client, send_max_retries=2)
+    with pytest.raises(requests.ConnectTimeout):
+        manager.send_message(make_message("1", "https://example.com/"))
+    assert client.failures == []
+    manager.stop()
+
+
+def test_transient_errors():
+    assert MasterMessageManager.is_transient_error(FBchatFacebookError("", request_status_code=429))
+    assert MasterMessageManager.is_transient_error(FBchatFacebookError("", request_status_code=502))
+    assert not MasterMessageManager.is_transient_error(FBchatFacebookError("", request_status_code=400))
+    assert not MasterMessageManager.is_transient_error(FBchatFacebookError(""))
+    assert MasterMessageManager.is_transient_error(requests.ConnectTimeout())
+    refused = MaxRetryError(None, "/", NewConnectionError(None, "Connection refused"))
+    assert MasterMessageManager.is_transient_error(requests.ConnectionError(refused))
+    # The request might have been sent before the connection is dropped.
+    aborted = ProtocolError("Connection aborted.", ConnectionResetError())
+    assert not MasterMessageManager.is_transient_error(requests.ConnectionError(aborted))
+    assert not MasterMessageManager.is_transient_error(requests.ConnectionError())
+    assert not MasterMessageManager.is_transient_error(requests.ReadTimeout())
+
+
+def test_typing_status_skips_rate_limit():
+    client = FakeClient()
+    manager = make_manager(client, send_rate_limit=0.001, send_burst=1)
+    manager.stop_typing = lambda *args: None
+    manager.send_message(make_message("1", "https://example.com/"))
+    status = Message(chat=SimpleNamespace(uid="1"), type=MsgType.Status, text="",
+                     attributes=StatusAttribute(StatusAttribute.Types.TYPING, timeout=1))
+    start = time.monotonic()
+    manager.send_message(status)
+    assert time.monotonic() - start < 1
+    assert len(client.sent) == 2
+    manager.stop()
+
+
+def test_retry_reuses_rate_limit_token():
+    client = FakeClient([requests.ConnectTimeout()])
+    manager = make_manager(client, send_rate_limit=0.001, send_burst=1)
+    start = time.monotonic()
+    manager.send_message(make_message("1", "https://example.com/"))
+    assert time.monotonic() - start < 1
+    assert client.sent == [("1", "https://example.com/")]
+    manager.stop()
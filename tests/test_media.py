@@ -0,0 +1,136 @@
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from efb_fb_messenger_slave.media import AvatarCache, DownloadedFile, LazyFile, MediaCache, MediaDownloader, \
+    MediaTooLargeError
+
+from conftest import CONTENT, REQUESTS
+
+
+def test_media_downloader_streams_to_file(server_url):
+    download = MediaDownloader().download(server_url + "/image", suffix=".png")
+    assert download.file.name.endswith(".png")
+    assert download.mime == "image/png"
+    assert download.size == len(CONTENT)
+    assert download.file.read() == CONTENT
+    download.file.close()
+
+
+def test_media_downloader_size_limit(server_url):
+    downloader = MediaDownloader(max_size=1000)
+    with pytest.raises(MediaTooLargeError):
+        downloader.download(server_url + "/image")
+    with pytest.raises(MediaTooLargeError):
+        downloader.download(server_url + "/chunked")
+
+
+def make_download(content: bytes, mime: str = "image/png") -> DownloadedFile:
+    file = tempfile.NamedTemporaryFile()
+    file.write(content)
+    file.seek(0)
+    return DownloadedFile(file=file, mime=mime, size=len(content))
+
+
+def test_media_cache_hit_and_eviction(tmp_path):
+    cache = MediaCache(tmp_path, max_size=10)
+    cache.put("sticker:1", make_download(b"123456"))
+    cached = cache.get("sticker:1", suffix=".png")
+    assert cached.file.read() == b"123456"
+    assert cached.mime == "image/png"
+    assert cache.get("sticker:2") is None
+
+    cache.put("sticker:2", make_download(b"abcdef"))
+    assert cache.get("sticker:1") is None
+    assert cache.get("sticker:2").file.read() == b"abcdef"
+    assert cache.total_size == 6
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_media_cache_copies_outside_lock(tmp_path, monkeypatch):
+    cache = MediaCache(tmp_path, max_size=10)
+    cache.put("sticker:1", make_download(b"123456"))
+    copy = shutil.copyfileobj
+    evicted = []
+
+    def copy_and_evict(src, dst):
+        if not evicted:
+            # Other lookups and writes are not blocked by the copy.
+            evicted.append(True)
+            cache.put("sticker:2", make_download(b"abcdef"))
+            assert cache.get("sticker:2").file.read() == b"abcdef"
+        copy(src, dst)
+
+    monkeypatch.setattr(shutil, "copyfileobj", copy_and_evict)
+    # The file evicted during the copy is still read in full.
+    assert cache.get("sticker:1").file.read() == b"123456"
+    assert cache.get("sticker:1") is None
+
+
+def test_media_cache_indexes_existing_files(tmp_path):
+    MediaCache(tmp_path, max_size=100).put("sticker:1", make_download(b"123456"))
+    cache = MediaCache(tmp_path, max_size=100)
+    assert cache.total_size == 6
+    assert cache.get("sticker:1").file.read() == b"123456"
+
+
+def test_media_downloader_uses_cache(server_url, tmp_path):
+    downloader = MediaDownloader(cache=MediaCache(tmp_path, max_size=1024 * 1024))
+    downloader.download(server_url + "/image", cache_key="image:1")
+
+    def fail():
+        raise AssertionError("URL should not be resolved on cache hit.")
+
+    assert downloader.download(fail, cache_key="image:1").file.read() == CONTENT
+
+
+def test_avatar_cache_revalidation(server_url, tmp_path):
+    REQUESTS.clear()
+    url = server_url + "/avatar"
+    cache = AvatarCache(tmp_path, MediaDownloader(), max_age=60)
+    assert cache.get("1", url).read() == b"avatar"
+    assert cache.get_cached("1", url).read() == b"avatar"
+    assert cache.get_cached("1", url + "?changed") is None
+    assert REQUESTS == [None]
+
+    cache.max_age = 0
+    assert cache.get("1", url).read() == b"avatar"
+    assert REQUESTS == [None, '"v1"']
+    # Only the picture and its metadata are left, without temporary files.
+    assert sorted(i.suffix for i in tmp_path.iterdir()) == ["", ".json"]
+
+
+def test_avatar_cache_missing(tmp_path):
+    cache = AvatarCache(tmp_path, MediaDownloader(), negative_ttl=60)
+    assert not cache.is_missing("1")
+    cache.mark_missing("1")
+    assert cache.is_missing("1")
+
+
+def test_lazy_file(server_url):
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        file = LazyFile(pool.submit(MediaDownloader().download, server_url + "/image"))
+        assert file.read(10) == CONTENT[:10]
+        assert file.tell() == 10
+        file.seek(0)
+        assert file.read() == CONTENT
+        download = file.future.result()
+        file.close()
+        assert download.file.closed
+        with pytest.raises(ValueError):
+            file.read()
+
+        file = LazyFile(pool.submit(MediaDownloader(max_size=1000).download, server_url + "/image"))
+        with pytest.raises(MediaTooLargeError):
+            file.read()
+
+
+def test_lazy_file_closed_before_download():
+    future: Future = Future()
+    file = LazyFile(future)
+    file.close()
+    download = make_download(b"123456")
+    future.set_result(download)
+    assert download.file.closed
@@ -0,0 +1,52 @@
+import time
+
+from efb_fb_messenger_slave.message_store import MessageStore
+
+
+def test_message_store_persists(tmp_path):
+    store = MessageStore(tmp_path / "messages.sqlite3")
+    store.save("mid.$abc", "1", parts=3)
+    store.save("mid.$def", "1", parts=1)
+    store.close()
+
+    store = MessageStore(tmp_path / "messages.sqlite3")
+    assert store.get("mid.$abc").parts == 3
+    assert store.get("mid.$def").parts == 1
+    assert store.get("mid.$ghi") is None
+    assert store.part_ids("mid.$abc") == ["mid.$abc.0", "mid.$abc.1", "mid.$abc.2"]
+    assert store.part_ids("mid.$def") == ["mid.$def"]
+    assert store.part_ids("mid.$ghi") == ["mid.$ghi"]
+
+
+def test_message_store_resolve(tmp_path):
+    store = MessageStore(tmp_path / "messages.sqlite3")
+    store.save("mid.$abc", "1", parts=2)
+    store.save("mid.$1234", "1", parts=1)
+    assert store.resolve("mid.$abc.1") == ("mid.$abc", 1)
+    assert store.resolve("mid.$abc.2") == ("mid.$abc.2", None)
+    assert store.resolve("mid.$abc") == ("mid.$abc", None)
+    assert store.resolve("mid.$1234") == ("mid.$1234", None)
+    # Messages not in store are split by their suffix.
+    assert store.resolve("mid.$xyz.3") == ("mid.$xyz", 3)
+    assert store.resolve("mid.$xyz") == ("mid.$xyz", None)
+
+
+def test_message_store_retention(tmp_path):
+    store = MessageStore(tmp_path / "messages.sqlite3", retention=60)
+    store.save("mid.$abc", "1", parts=2)
+    store._db.execute("UPDATE messages SET saved_at = ?", (time.time() - 120,))
+    store.save("mid.$def", "1", parts=1)
+    store.prune()
+    assert len(store) == 1
+    assert store.get("mid.$abc") is None
+
+
+def test_message_store_closed(tmp_path):
+    store = MessageStore(tmp_path / "messages.sqlite3")
+    store.save("mid.$abc", "1", parts=2)
+    store.close()
+    store.close()
+    # Messages processed during shutdown are not recorded, without errors.
+    store.save("mid.$def", "1", parts=2)
+    assert store.get("mid.$abc") is None
+    assert store.resolve("mid.$abc.1") == ("mid.$abc", 1)
@@ -0,0 +1,53 @@
+from efb_fb_messenger_slave.search_index import ChatSearchIndex, SearchEntry
+
+
+def make_index():
+    index = ChatSearchIndex()
+    index.add(SearchEntry("1", "Alice Smith", None, "User"))
+    index.add(SearchEntry("2", "Bob", "Bobby", "User"))
+    index.add(SearchEntry("3", "張三的群組", None, "Group"))
+    index.add(SearchEntry("4", "Ａｌｉｃｅ fans", None, "Group"))
+    index.add(SearchEntry("5", "Smithsonian", None, "Page"))
+    return index
+
+
+def uids(results):
+    return [i.uid for i in results]
+
+
+def test_search_prefix_and_substring():
+    index = make_index()
+    assert uids(index.search("ali")) == ["4", "1"]
+    assert uids(index.search("a s")) == ["1"]
+    assert uids(index.search("mith")) == ["1", "5"]
+    assert uids(index.search("smith")) == ["5", "1"]
+    assert uids(index.search("bobby")) == ["2"]
+    assert index.search("zz") == []
+    assert index.search("  ") == []
+
+
+def test_search_cjk():
+    index = make_index()
+    assert uids(index.search("張三")) == ["3"]
+    assert uids(index.search("三的")) == ["3"]
+    assert index.search("三張") == []
+
+
+def test_search_filters_and_updates():
+    index = make_index()
+    assert uids(index.search("ali", chat_types=("User",))) == ["1"]
+    assert uids(index.search("smith", limit=1)) == ["5"]
+
+    index.add(SearchEntry("1", "Carol", None, "User"))
+    assert uids(index.search("ali")) == ["4"]
+    assert uids(index.search("carol")) == ["1"]
+    index.remove("1")
+    assert index.search("carol") == []
+    assert len(index) == 4
+
+
+def test_search_keywords():
+    index = make_index()
+    index.add(SearchEntry("6", "Book club", None, "Group", keywords=("Carol", "Caz")))
+    assert uids(index.search("caz")) == ["6"]
+    assert uids(index.search("book carol")) == ["6"]
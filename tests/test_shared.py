@@ -0,0 +1,48 @@
+import threading
+
+from efb_fb_messenger_slave.shared import SharedResources
+
+
+def test_shared_resources_reused_until_released():
+    resources = SharedResources()
+    closed = []
+    first = resources.acquire("pool", "a", object, close=closed.append)
+    second = resources.acquire("pool", "b", object, close=closed.append)
+    assert first is second
+    assert resources.owners("pool") == {"a", "b"}
+
+    resources.release("a")
+    assert closed == []
+    resources.release("b")
+    assert closed == [first]
+    assert resources.owners("pool") == set()
+    assert resources.acquire("pool", "a", object) is not first
+
+
+def test_shared_resources_separate_names():
+    resources = SharedResources()
+    assert resources.acquire("a:pool", "a", object) is not resources.acquire("b:pool", "b", object)
+    resources.release("a")
+    assert resources.owners("b:pool") == {"b"}
+
+
+def test_shared_resources_created_outside_lock():
+    resources = SharedResources()
+    barrier = threading.Barrier(2, timeout=5)
+    closed = []
+    results = []
+
+    def factory():
+        # Both threads can only pass if neither holds the lock while creating.
+        barrier.wait()
+        return object()
+
+    threads = [threading.Thread(target=lambda owner=owner: results.append(
+        resources.acquire("pool", owner, factory, close=closed.append))) for owner in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 2 and results[0] is results[1]
+    assert len(closed) == 1 and closed[0] is not results[0]
+    assert resources.owners("pool") == {"a", "b"}
@@ -0,0 +1,69 @@
+from fbchat import ThreadLocation
+from fbchat.models import Group, User
+
+from efb_fb_messenger_slave.thread_sync import ThreadListSync
+
+
+class FakeClient:
+    def __init__(self, threads, archived=()):
+        self.threads = threads
+        self.archived = list(archived)
+        self.requests = []
+
+    def fetchThreadList(self, limit=20, thread_location=(ThreadLocation.INBOX,), before=None):
+        self.requests.append(before)
+        # Locations are a collection, as in EFMSClient.fetchThreadList.
+        tags = [i.value for i in thread_location]
+        threads = self.archived if tags == [ThreadLocation.ARCHIVED.value] else self.threads
+        threads = [i for i in threads
+                   if before is None or int(i.last_message_timestamp) <= before]
+        threads.sort(key=lambda i: int(i.last_message_timestamp), reverse=True)
+        return threads[:limit]
+
+
+def make_threads(count, start=0):
+    return [(Group if i % 2 else User)(str(i), last_message_timestamp=str(1000 + i))
+            for i in range(start, start + count)]
+
+
+def test_thread_sync_pages_through_list(tmp_path):
+    client = FakeClient(make_threads(45))
+    sync = ThreadListSync(client, tmp_path / "threads.json")
+    threads = sync.sync([ThreadLocation.INBOX])
+    assert len(threads) == 45
+    assert client.requests == [None, 1025, 1006]
+    assert sync.thread_ids()[:2] == ["44", "43"]
+    assert sync.marks == {"INBOX": 1044}
+    assert [i.name for i in tmp_path.iterdir()] == ["threads.json"]
+
+
+def test_thread_sync_incremental(tmp_path):
+    client = FakeClient(make_threads(45))
+    ThreadListSync(client, tmp_path / "threads.json").sync([ThreadLocation.INBOX])
+
+    client.threads += make_threads(3, start=45)
+    client.requests.clear()
+    sync = ThreadListSync(client, tmp_path / "threads.json")
+    assert [i.uid for i in sync.sync([ThreadLocation.INBOX])] == ["47", "46", "45"]
+    assert client.requests == [None]
+    assert len(sync) == 48
+
+    client.requests.clear()
+    assert sync.sync([ThreadLocation.INBOX]) == []
+    assert client.requests == [None]
+
+
+def test_thread_sync_max_threads(tmp_path):
+    client = FakeClient(make_threads(100))
+    sync = ThreadListSync(client, tmp_path / "threads.json", max_threads=30)
+    assert [i.uid for i in sync.sync([ThreadLocation.INBOX])][-1] == "70"
+    assert sync.thread_ids([ThreadLocation.ARCHIVED]) == []
+
+
+def test_thread_sync_merges_locations(tmp_path):
+    client = FakeClient(make_threads(30), archived=make_threads(30, start=30))
+    sync = ThreadListSync(client, tmp_path / "threads.json")
+    threads = sync.sync([ThreadLocation.INBOX, ThreadLocation.ARCHIVED])
+    assert [i.uid for i in threads] == [str(i) for i in range(59, -1, -1)]
+    assert sync.thread_ids([ThreadLocation.ARCHIVED])[-1] == "30"
+    assert sync.marks == {"INBOX": 1029, "ARCHIVED": 1059}
@@ -15,3 +15,38 @@ def test_utils_get_value():
     assert utils.get_value(source, ('second', "inner", 1, "entry"), "fallback") == "value"
     assert utils.get_value(source, ('second', 0), "fallback") == "fallback"
     assert utils.get_value(source, ('1', 0, 2), None) is None
+
+
+def test_utils_compile_path():
+    source = {
+        "first": ['a', 'b', 'c', 'd'],
+        "second": {
+            "inner": [
+                {"entry": "name"},
+                {"entry": "value", "deep": {"deeper": {"deepest": "found"}}}
+            ]
+        }
+    }
+    paths = [
+        (),
+        ('first',),
+        ('first', 0),
+        ('second', 'inner', 1),
+        ('second', 'inner', 1, 'entry'),
+        ('second', 'inner', 1, 'deep', 'deeper', 'deepest'),
+        ('missing',),
+        ('second', 0),
+        ('first', 10),
+        ('first', 0, 'key'),
+        ('1', 0, 2),
+        ('second', 'inner', 0, 'deep', 'deeper', 'deepest'),
+    ]
+    for path in paths:
+        getter = utils.compile_path(path, "fallback")
+        assert getter(source) == utils.get_value(source, path, "fallback"), path
+        # Compiled paths are reusable with other sources.
+        assert getter(None) == utils.get_value(None, path, "fallback"), path
+    assert utils.compile_path(('first', 1))(source) == "b"
+    assert utils.compile_path(('first', 1, 0, 0))(source) == "b"
+    assert utils.compile_path(('missing', 'key'))(source) is None
+    assert utils.compile_path(iter(['second', 'inner', 0, 'entry']))(source) == "name"
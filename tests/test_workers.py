@@ -0,0 +1,84 @@
+import threading
+import time
+
+from efb_fb_messenger_slave.workers import KeyedWorkerPool, KeyedDebouncer, TokenBucket
+
+
+def test_keyed_worker_pool_keeps_order_per_key():
+    pool = KeyedWorkerPool(max_workers=4, max_queue_size=50)
+    results = {"a": [], "b": []}
+
+    def task(key, value):
+        time.sleep(0.001)
+        results[key].append(value)
+
+    futures = [pool.submit(key, task, key, i) for i in range(20) for key in ("a", "b")]
+    for i in futures:
+        i.result(timeout=5)
+    pool.shutdown(wait=True)
+
+    assert results["a"] == list(range(20))
+    assert results["b"] == list(range(20))
+    assert pool.metrics["tasks_done"] == 40
+    assert pool.metrics["queue_length"] == 0
+
+
+def test_keyed_worker_pool_runs_keys_in_parallel():
+    pool = KeyedWorkerPool(max_workers=2, max_queue_size=10)
+    barrier = threading.Barrier(2, timeout=5)
+
+    futures = [pool.submit(key, barrier.wait) for key in ("a", "b")]
+    for i in futures:
+        i.result(timeout=5)
+    pool.shutdown(wait=True)
+
+
+def test_keyed_worker_pool_propagates_exceptions():
+    pool = KeyedWorkerPool(max_workers=1, max_queue_size=10)
+
+    def fail():
+        raise ValueError("failed")
+
+    future = pool.submit("a", fail)
+    assert isinstance(future.exception(timeout=5), ValueError)
+    assert pool.submit("a", lambda: 42).result(timeout=5) == 42
+    pool.shutdown(wait=True)
+
+
+def test_keyed_debouncer_collapses_calls():
+    calls = []
+    done = threading.Event()
+
+    def fn(value):
+        calls.append(value)
+        done.set()
+
+    debouncer = KeyedDebouncer(fn, window=0.05)
+    for i in range(10):
+        debouncer("a", i)
+    assert done.wait(5)
+    assert calls == [0]
+    assert (debouncer.calls, debouncer.runs) == (10, 1)
+
+
+def test_keyed_debouncer_without_window():
+    calls = []
+    debouncer = KeyedDebouncer(calls.append, window=0)
+    debouncer("a", 1)
+    debouncer("a", 2)
+    assert calls == [1, 2]
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, capacity=5)
+    start = time.monotonic()
+    waits = [bucket.acquire() for _ in range(10)]
+    elapsed = time.monotonic() - start
+    # A burst of 5 goes through at once, and the remaining 5 are paced.
+    assert waits[:5] == [0.0] * 5
+    assert elapsed >= 0.2
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(rate=0)
+    assert all(bucket.acquire() == 0.0 for _ in range(100))